@@ -1,13 +1,61 @@
-from flask import Flask, render_template, jsonify
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
 import requests
+import asyncio
+import contextvars
+import functools
+import gzip
 import json
+import logging
 import os
 import urllib.parse
 import time
 import random
 import base64
 import re
-from typing import List, Dict, Any
+import hashlib
+import hmac
+import zlib
+import inspect
+import sqlite3
+import threading
+import heapq
+import math
+import multiprocessing
+from bisect import bisect_left, bisect_right
+import queue
+import tempfile
+import struct
+from array import array
+from collections import OrderedDict, deque
+from itertools import islice
+from contextlib import contextmanager
+from concurrent.futures import (Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait,
+                                TimeoutError as FuturesTimeoutError)
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無ければ array ベースで計算
+    np = None
+
+try:
+    import httpx
+except ImportError:  # 非同期モード（asgi.py）を使わなければ不要
+    httpx = None
+
+try:
+    import brotli
+except ImportError:  # brotli が無ければ gzip だけで圧縮
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:  # Windows ではプロセス間ロックなし
+    fcntl = None
+
+logger = logging.getLogger('ebay_analyzer')
 
 # .envファイルを読み込む関数
 def load_env():
@@ -22,25 +70,981 @@ def load_env():
                     clean_value = value.strip().replace('\r', '').replace('\n', '')
                     os.environ[key] = clean_value
     else:
-        print("警告: .envファイルが見つかりません")
+        logger.warning(".envファイルが見つかりません")
 
 # .envファイルを読み込み
 load_env()
 
 app = Flask(__name__)
 
+# ログレベル（DEBUG にすると各クエリやトークン生成の詳細も出力する）
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(format='%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s')
+logger.setLevel(LOG_LEVEL)
+
 # 環境変数
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 EBAY_APP_ID = os.getenv('EBAY_APP_ID')
 EBAY_CLIENT_SECRET = os.getenv('EBAY_CLIENT_SECRET')
 EBAY_OAUTH_TOKEN = os.getenv('EBAY_OAUTH_TOKEN')
 
+# 接続先（スタブサーバーでのベンチマーク用に差し替え可能）
+EBAY_API_BASE_URL = os.getenv('EBAY_API_BASE_URL', 'https://api.ebay.com').rstrip('/')
+GEMINI_API_BASE_URL = os.getenv('GEMINI_API_BASE_URL', 'https://generativelanguage.googleapis.com').rstrip('/')
+
+# 検索クエリの並列実行設定（同時実行数の上限と1回の取得全体の締め切り秒数）
+EBAY_SEARCH_CONCURRENCY = max(1, int(os.getenv('EBAY_SEARCH_CONCURRENCY', '6')))
+EBAY_SEARCH_DEADLINE = float(os.getenv('EBAY_SEARCH_DEADLINE', '20'))
+
+# 共有HTTPクライアントの設定（ホスト別コネクションプールとリトライ）
+HTTP_MAX_RETRIES = max(0, int(os.getenv('HTTP_MAX_RETRIES', '2')))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '8'))
+# トークンキャッシュの設定（期限切れの何秒前に更新するか、ワーカー間共有ファイル）
+EBAY_TOKEN_REFRESH_MARGIN = float(os.getenv('EBAY_TOKEN_REFRESH_MARGIN', '300'))
+EBAY_TOKEN_CACHE_PATH = os.getenv('EBAY_TOKEN_CACHE_PATH')
+EBAY_STATIC_TOKEN_TTL = float(os.getenv('EBAY_STATIC_TOKEN_TTL', '1800'))
+
+# キーワード照合を単語境界単位で行うか（デフォルトは従来通りの部分一致）
+KEYWORD_WORD_BOUNDARY = os.getenv('KEYWORD_WORD_BOUNDARY', 'false').lower() in ('1', 'true', 'yes')
+
+# /api/analyze の結果キャッシュ（TTL秒と、期限切れ後も古い結果を返しつつ裏で更新する秒数）
+ANALYZE_CACHE_TTL = float(os.getenv('ANALYZE_CACHE_TTL', '300'))
+ANALYZE_CACHE_STALE_TTL = float(os.getenv('ANALYZE_CACHE_STALE_TTL', '900'))
+
+# Gemini市場分析のメモ化（統計の指紋ごと、LRU件数・TTL秒・任意のSQLite永続化先）
+GEMINI_CACHE_SIZE = int(os.getenv('GEMINI_CACHE_SIZE', '128'))
+GEMINI_CACHE_TTL = float(os.getenv('GEMINI_CACHE_TTL', '21600'))
+GEMINI_CACHE_PATH = os.getenv('GEMINI_CACHE_PATH')
+GEMINI_CACHE_PRICE_BUCKET = float(os.getenv('GEMINI_CACHE_PRICE_BUCKET', '10'))
+
+# ページ送りによる深いクロール（クエリごと・全体の取得上限、ページサイズ、早期打ち切り条件）
+EBAY_CRAWL_PER_QUERY = int(os.getenv('EBAY_CRAWL_PER_QUERY', '1000'))
+EBAY_CRAWL_BUDGET = int(os.getenv('EBAY_CRAWL_BUDGET', '5000'))
+EBAY_CRAWL_PAGE_SIZE = min(200, int(os.getenv('EBAY_CRAWL_PAGE_SIZE', '200')))
+EBAY_CRAWL_MIN_NEW_RATIO = float(os.getenv('EBAY_CRAWL_MIN_NEW_RATIO', '0.1'))
+EBAY_CRAWL_STALE_PAGES = int(os.getenv('EBAY_CRAWL_STALE_PAGES', '2'))
+EBAY_CRAWL_CONCURRENCY = max(1, int(os.getenv('EBAY_CRAWL_CONCURRENCY', '4')))
+# /api/analyze/deep で誰でも指定できる上限の組（"クエリごと:全体" のカンマ区切り、既定は上の既定値だけ）
+EBAY_CRAWL_ALLOWED_BUDGETS = frozenset(
+    tuple(int(value) for value in pair.split(':'))
+    for pair in os.getenv('EBAY_CRAWL_ALLOWED_BUDGETS', f'{EBAY_CRAWL_PER_QUERY}:{EBAY_CRAWL_BUDGET}').split(',')
+    if pair.strip()
+)
+
+# 管理用トークン（X-Admin-Token ヘッダーで渡すと、深いクロールの任意の上限と refresh=1 を許可する。未設定なら誰にも許可しない）
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# 市場統計の価格帯の区切り（ドル、カンマ区切り）と分位点スケッチの相対誤差
+MARKET_PRICE_EDGES = tuple(float(edge) for edge in os.getenv('MARKET_PRICE_EDGES', '50,100,300,500').split(','))
+MARKET_QUANTILE_ACCURACY = float(os.getenv('MARKET_QUANTILE_ACCURACY', '0.01'))
+
+# 分析済み商品の永続ストア（SQLite、未設定なら保存しない）と、ストアから回答する際の鮮度（秒）
+ITEM_STORE_PATH = os.getenv('ITEM_STORE_PATH')
+ITEM_STORE_MAX_AGE = float(os.getenv('ITEM_STORE_MAX_AGE', '86400'))
+
+# 商品詳細のキャッシュ（件数上限、TTL秒、任意のSQLiteパス）と分析後に先読みする上位件数
+ITEM_DETAIL_CACHE_SIZE = int(os.getenv('ITEM_DETAIL_CACHE_SIZE', '2000'))
+ITEM_DETAIL_CACHE_TTL = float(os.getenv('ITEM_DETAIL_CACHE_TTL', '900'))
+ITEM_DETAIL_CACHE_PATH = os.getenv('ITEM_DETAIL_CACHE_PATH')
+ITEM_DETAIL_PREFETCH = int(os.getenv('ITEM_DETAIL_PREFETCH', '20'))
+# 詳細取得のタイムアウト秒（getItems の1回あたり）
+ITEM_DETAIL_TIMEOUT = float(os.getenv('ITEM_DETAIL_TIMEOUT', '15'))
+
+# 価格・人気度の時系列記録（保存先ディレクトリ、生データ保持日数、全体の保持日数、集約間隔秒）
+TIMESERIES_DIR = os.getenv('TIMESERIES_DIR')
+TIMESERIES_RAW_RETENTION_DAYS = float(os.getenv('TIMESERIES_RAW_RETENTION_DAYS', '7'))
+TIMESERIES_RETENTION_DAYS = float(os.getenv('TIMESERIES_RETENTION_DAYS', '365'))
+TIMESERIES_ROLLUP_SECONDS = float(os.getenv('TIMESERIES_ROLLUP_SECONDS', '86400'))
+
+# 上流ごとのクライアント側レート制限（名前=毎秒/バースト/1日の上限、上限0は無制限、空文字で無効）
+RATE_LIMITS = os.getenv('RATE_LIMITS', 'ebay_search=10/20/5000,ebay_item=10/20/5000,'
+                                       'ebay_oauth=1/5/1000,gemini=0.25/4/1500')
+# レート制限の状態をワーカー間で共有する SQLite パス（未設定ならプロセス内のみ）と空きを待つ最大秒数
+RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH')
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '5'))
+
+# 検索するマーケットプレイス（カンマ区切り、先頭が既定）
+EBAY_MARKETPLACES = [m.strip() for m in os.getenv('EBAY_MARKETPLACES', 'EBAY_US').split(',') if m.strip()] or ['EBAY_US']
+# 価格をドルに揃えるための為替レート（1通貨あたりのドル、通貨=レートのカンマ区切り）
+CURRENCY_RATES_USD = dict(
+    {'USD': 1.0},
+    **{code.strip(): float(rate) for code, rate in
+       (pair.split('=') for pair in os.getenv('CURRENCY_RATES_USD', 'GBP=1.27,EUR=1.08,AUD=0.66').split(',') if pair)}
+)
+
+# 分析結果をバックグラウンドで定期計算する間隔（秒、0で無効）、間隔のゆらぎ（割合）、クエリを投げる間隔（秒）
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', '0'))
+REFRESH_JITTER = float(os.getenv('REFRESH_JITTER', '0.1'))
+REFRESH_STAGGER = float(os.getenv('REFRESH_STAGGER', '0.2'))
+# 定期計算が失敗したときのバックオフ（初回秒数と上限秒数）
+REFRESH_BACKOFF_BASE = float(os.getenv('REFRESH_BACKOFF_BASE', '30'))
+REFRESH_BACKOFF_MAX = float(os.getenv('REFRESH_BACKOFF_MAX', '1800'))
+# ワーカー間で共有する分析結果のスナップショット（リーダー選出のロックは「パス.lock」）
+ANALYSIS_SNAPSHOT_PATH = os.getenv('ANALYSIS_SNAPSHOT_PATH',
+                                   os.path.join(tempfile.gettempdir(), 'ebay-analysis-snapshot.json'))
+
+# /metrics の集計（ワーカー間で合算する場合の書き出し先ディレクトリと書き出し間隔秒）
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '15'))
+
+# 分析結果レスポンスの圧縮（これより小さい本体は圧縮しない、バイト）とプロセス内で保持する本体の数
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESSION_MIN_BYTES', '1024'))
+RESPONSE_BODY_CACHE_SIZE = int(os.getenv('RESPONSE_BODY_CACHE_SIZE', '32'))
+
+# ローカル分析を一括で行うプロセスプールのワーカー数（既定はコア数、1コアなら 0 = 使わない）、
+# 1チャンクの商品数、プールを使う最小件数（これより少なければ呼び出し元のスレッドで処理する）
+BULK_ENRICH_WORKERS = int(os.getenv('BULK_ENRICH_WORKERS', str(os.cpu_count() if (os.cpu_count() or 1) > 1 else 0)))
+BULK_ENRICH_CHUNK_SIZE = max(1, int(os.getenv('BULK_ENRICH_CHUNK_SIZE', '500')))
+BULK_ENRICH_MIN_ITEMS = int(os.getenv('BULK_ENRICH_MIN_ITEMS', '2000'))
+# ワーカーの起動方式（スレッドを多数持つプロセスからの fork は避ける）
+BULK_ENRICH_START_METHOD = os.getenv('BULK_ENRICH_START_METHOD') or (
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# 学習済みのカテゴリ分類器（train_classifier.py で作る .npz、未設定ならキーワード分類のみ）
+LOCAL_CLASSIFIER_PATH = os.getenv('LOCAL_CLASSIFIER_PATH')
+
+# ウォームアップ失敗時に再試行するまでの秒数
+WARMUP_RETRY_INTERVAL = float(os.getenv('WARMUP_RETRY_INTERVAL', '10'))
+
+HTTP_POOL_SIZES = {
+    EBAY_API_BASE_URL: int(os.getenv('HTTP_POOL_SIZE_EBAY',
+                                     str(max(10, EBAY_SEARCH_CONCURRENCY * len(EBAY_MARKETPLACES))))),
+    GEMINI_API_BASE_URL: int(os.getenv('HTTP_POOL_SIZE_GEMINI', '4')),
+}
+
+# URL の先頭一致でレート制限のバケットを決める（上から順に判定）
+RATE_LIMIT_ROUTES = [
+    (f"{EBAY_API_BASE_URL}/identity/", 'ebay_oauth'),
+    (f"{EBAY_API_BASE_URL}/buy/browse/v1/item_summary/", 'ebay_search'),
+    (f"{EBAY_API_BASE_URL}/buy/browse/v1/item", 'ebay_item'),
+    (GEMINI_API_BASE_URL, 'gemini'),
+]
+
+def to_usd(price_info: Optional[Dict[str, Any]]) -> Optional[float]:
+    """Browse API の価格（value と currency）をドルに換算する（換算できなければ None）"""
+    if not price_info or 'value' not in price_info:
+        return None
+    rate = CURRENCY_RATES_USD.get(price_info.get('currency') or 'USD')
+    if rate is None:
+        return None
+    try:
+        return float(price_info['value']) * rate
+    except (TypeError, ValueError):
+        return None
+
+def parse_rate_limits(spec: str) -> Dict[str, Tuple[float, float, int]]:
+    """'名前=毎秒/バースト/1日の上限,...' を {名前: (毎秒, バースト, 1日の上限)} にする"""
+    limits = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, values = entry.split('=', 1)
+        rate, burst, daily = values.split('/')
+        limits[name.strip()] = (float(rate), max(1.0, float(burst)), int(daily))
+    return limits
+
 # 環境変数の確認
 if not all([GEMINI_API_KEY, EBAY_APP_ID, EBAY_CLIENT_SECRET]):
-    print("エラー: 必要な環境変数が設定されていません")
-    print(f"GEMINI_API_KEY: {'✓' if GEMINI_API_KEY else '✗'}")
-    print(f"EBAY_APP_ID: {'✓' if EBAY_APP_ID else '✗'}")
-    print(f"EBAY_CLIENT_SECRET: {'✓' if EBAY_CLIENT_SECRET else '✗'}")
+    logger.error("必要な環境変数が設定されていません (GEMINI_API_KEY: %s, EBAY_APP_ID: %s, EBAY_CLIENT_SECRET: %s)",
+                 '✓' if GEMINI_API_KEY else '✗', '✓' if EBAY_APP_ID else '✗', '✓' if EBAY_CLIENT_SECRET else '✗')
+
+class RateLimitExceeded(requests.RequestException):
+    """レート制限の待ち時間上限、または1日のクォータを超えた"""
+
+    def __init__(self, bucket: str, reason: str, retry_after: Optional[float] = None):
+        self.bucket = bucket
+        self.reason = reason
+        self.retry_after = retry_after
+        detail = f"（{retry_after:.1f}秒後に再試行可能）" if retry_after else ''
+        super().__init__(f"{bucket}: {reason}{detail}")
+
+class RateLimiter:
+    """上流ごとのトークンバケットと1日のクォータ（path を渡すと SQLite でワーカー間共有）
+
+    空きが無ければ max_wait 秒まで待ってから通す。429 を受けたら Retry-After の間は
+    全ワーカーで止めて補充レートを半分にし、成功が続くと設定値まで徐々に戻す。
+    """
+
+    FIELDS = ('tokens', 'updated', 'blocked_until', 'rate_scale', 'day', 'day_count')
+    MIN_RATE_SCALE = 0.1
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, limits: Dict[str, Tuple[float, float, int]], path: Optional[str] = None,
+                 max_wait: float = 5.0):
+        self.limits = dict(limits)
+        self.path = path
+        self.max_wait = max_wait
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+        if path:
+            with self._connect() as conn:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS rate_limits (name TEXT PRIMARY KEY, tokens REAL, '
+                             'updated REAL, blocked_until REAL, rate_scale REAL, day TEXT, day_count INTEGER)')
+
+    def _reset(self):
+        """ロックと統計を初期化（fork 後の子プロセスでも呼ばれる）"""
+        self._lock = threading.Lock()
+        self._states: Dict[str, Dict[str, Any]] = {}
+        self._counters: Dict[str, Dict[str, float]] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        # トランザクションは BEGIN IMMEDIATE で明示的に張る
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def _initial_state(self, name: str, now: float) -> Dict[str, Any]:
+        return {'tokens': self.limits[name][1], 'updated': now, 'blocked_until': 0.0, 'rate_scale': 1.0,
+                'day': time.strftime('%Y-%m-%d', time.gmtime(now)), 'day_count': 0}
+
+    @contextmanager
+    def _state(self, name: str, now: float):
+        """バケットの状態を読み書きする（SQLite なら書き込みロックでワーカー間を直列化）"""
+        if not self.path:
+            with self._lock:
+                yield self._states.setdefault(name, self._initial_state(name, now))
+            return
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(f"SELECT {', '.join(self.FIELDS)} FROM rate_limits WHERE name = ?", (name,)).fetchone()
+            state = dict(zip(self.FIELDS, row)) if row else self._initial_state(name, now)
+            yield state
+            conn.execute('INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (name, *(state[field] for field in self.FIELDS)))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _count(self, name: str, key: str, amount: float = 1):
+        with self._lock:
+            counters = self._counters.setdefault(name, {'granted': 0, 'queued': 0, 'waited_seconds': 0.0,
+                                                        'rejected': 0, 'throttled': 0})
+            counters[key] += amount
+
+    def _reserve(self, name: str, now: float) -> Optional[float]:
+        """トークンを1つ取る。取れたら 0、足りなければ待つべき秒数、クォータ切れなら None"""
+        rate, burst, daily = self.limits[name]
+        with self._state(name, now) as state:
+            today = time.strftime('%Y-%m-%d', time.gmtime(now))
+            if state['day'] != today:
+                state['day'], state['day_count'] = today, 0
+            if daily and state['day_count'] >= daily:
+                return None
+
+            effective_rate = rate * state['rate_scale']
+            state['tokens'] = min(burst, state['tokens'] + max(0.0, now - state['updated']) * effective_rate)
+            state['updated'] = now
+            if now < state['blocked_until']:
+                return state['blocked_until'] - now
+            if state['tokens'] < 1:
+                return (1 - state['tokens']) / effective_rate
+
+            state['tokens'] -= 1
+            state['day_count'] += 1
+            state['rate_scale'] = min(1.0, state['rate_scale'] + self.RECOVERY_STEP)
+            return 0.0
+
+    def acquire(self, name: str) -> float:
+        """name の枠が空くまで待って1回分を確保し、待った秒数を返す"""
+        if name not in self.limits:
+            return 0.0
+        deadline = time.monotonic() + self.max_wait
+        waited = 0.0
+        while True:
+            wait_seconds = self._attempt(name, deadline, waited)
+            if wait_seconds is None:
+                return waited
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+    async def acquire_async(self, name: str) -> float:
+        """acquire の asyncio 版（待つ間イベントループを止めない）"""
+        if name not in self.limits:
+            return 0.0
+        deadline = time.monotonic() + self.max_wait
+        waited = 0.0
+        while True:
+            wait_seconds = await self._offload(self._attempt, name, deadline, waited)
+            if wait_seconds is None:
+                return waited
+            await asyncio.sleep(wait_seconds)
+            waited += wait_seconds
+
+    def _attempt(self, name: str, deadline: float, waited: float) -> Optional[float]:
+        """1回分を取りにいく。確保できたら None、待つべきならその秒数を返す（待てなければ例外）"""
+        try:
+            wait_seconds = self._reserve(name, time.time())
+        except sqlite3.Error as e:
+            # 共有状態が壊れていてもリクエスト自体は止めない
+            logger.warning("⚠️ レート制限の状態を読めません（%s）: %s", name, e)
+            return None
+
+        if wait_seconds is None:
+            self._count(name, 'rejected')
+            raise RateLimitExceeded(name, '1日のクォータを使い切りました')
+        if wait_seconds <= 0:
+            self._count(name, 'granted')
+            if waited:
+                self._count(name, 'queued')
+                self._count(name, 'waited_seconds', waited)
+            return None
+        if time.monotonic() + wait_seconds > deadline:
+            self._count(name, 'rejected')
+            raise RateLimitExceeded(name, 'レート制限の待ち時間上限を超えました', wait_seconds)
+        return wait_seconds
+
+    def penalize(self, name: str, retry_after: float):
+        """429 を受けたバケットを retry_after 秒止め、補充レートを半分に落とす"""
+        if name not in self.limits:
+            return
+        now = time.time()
+        try:
+            with self._state(name, now) as state:
+                state['blocked_until'] = max(state['blocked_until'], now + retry_after)
+                state['tokens'] = 0.0
+                state['rate_scale'] = max(self.MIN_RATE_SCALE, state['rate_scale'] / 2)
+        except sqlite3.Error as e:
+            logger.warning("⚠️ レート制限の状態を更新できません（%s）: %s", name, e)
+        self._count(name, 'throttled')
+
+    async def penalize_async(self, name: str, retry_after: float):
+        """penalize の asyncio 版"""
+        await self._offload(self.penalize, name, retry_after)
+
+    async def _offload(self, func, *args):
+        """SQLite の共有状態はロック待ちがあるのでスレッドで読み書きする（メモリ上ならその場で）"""
+        if self.path:
+            return await asyncio.to_thread(func, *args)
+        return func(*args)
+
+    def counters(self) -> Dict[str, Dict[str, float]]:
+        """このプロセスでのバケットごとの許可・待ち・拒否回数"""
+        with self._lock:
+            return {name: dict(values) for name, values in self._counters.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        """バケットごとの設定、現在の状態、このプロセスでの待ち・拒否回数"""
+        result = {}
+        now = time.time()
+        for name, (rate, burst, daily) in self.limits.items():
+            try:
+                with self._state(name, now) as state:
+                    snapshot = dict(state)
+            except sqlite3.Error:
+                snapshot = {}
+            counters = self.counters().get(name, {})
+            result[name] = {
+                'rate_per_second': rate, 'burst': burst, 'daily_quota': daily,
+                'effective_rate': round(rate * snapshot.get('rate_scale', 1.0), 4),
+                'used_today': snapshot.get('day_count', 0),
+                'blocked_for': round(max(0.0, snapshot.get('blocked_until', 0.0) - now), 3),
+                'process': counters,
+            }
+        return {'shared': bool(self.path), 'max_wait': self.max_wait, 'buckets': result}
+
+# 上流ごとのレート制限（RATE_LIMIT_PATH があればワーカー間で共有）
+rate_limiter = RateLimiter(parse_rate_limits(RATE_LIMITS), path=RATE_LIMIT_PATH, max_wait=RATE_LIMIT_MAX_WAIT)
+
+# 実行中の分析のステージ別所要時間（Metrics.run_timings の中でだけ設定される）
+_run_timings: contextvars.ContextVar = contextvars.ContextVar('run_timings', default=None)
+
+class Metrics:
+    """プロセス内のカウンターとヒストグラム（Prometheus のテキスト形式で出力する）
+
+    timer() はステージの所要時間をヒストグラムに記録し、run_timings() の中なら
+    その実行の合計にも足し込む（スレッドプールへは contextvars.copy_context で引き継ぐ）。
+    dump_dir を渡すとプロセスごとの値を JSON に書き出し、render() で全ワーカー分を合算する
+    （終了したワーカーの分は1つのファイルに畳み込む）。
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    HELP = {
+        'upstream_requests_total': ('counter', '上流APIへのリクエスト数（ステータス別、ERROR は接続失敗）'),
+        'upstream_request_seconds': ('histogram', '上流APIの応答時間（秒）'),
+        'stage_seconds': ('histogram', '分析ステージごとの所要時間（秒）'),
+        'cache_hits_total': ('counter', 'キャッシュのヒット数'),
+        'cache_misses_total': ('counter', 'キャッシュのミス数'),
+        'cache_hit_ratio': ('gauge', 'キャッシュのヒット率'),
+        'analysis_cache_requests_total': ('counter', '分析結果キャッシュの応答（hit/stale/miss/coalesced）'),
+        'rate_limit_events_total': ('counter', 'クライアント側レート制限の許可・待ち・拒否'),
+        'gemini_calls_total': ('counter', 'Gemini API の呼び出し回数'),
+    }
+
+    def __init__(self, dump_dir: Optional[str] = None, flush_interval: float = 15.0):
+        self.dump_dir = dump_dir
+        self.flush_interval = flush_interval
+        self._collectors = []
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """値を初期化（fork 後の子プロセスでは親の値を引き継がない）"""
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+        self._flusher_started = False
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """ヒストグラムに1件記録する（バケットごとの件数・合計・件数を持つ）"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            histogram[bisect_left(self.BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, stage: str):
+        """with ブロックの所要時間を stage_seconds{stage} と実行中の分析の内訳に記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('stage_seconds', elapsed, stage=stage)
+            timings = _run_timings.get()
+            if timings is not None:
+                with self._lock:
+                    entry = timings.setdefault(stage, {'seconds': 0.0, 'calls': 0})
+                    entry['seconds'] += elapsed
+                    entry['calls'] += 1
+
+    @contextmanager
+    def run_timings(self):
+        """ブロック内（引き継いだスレッドを含む）の timer() をまとめた辞書を返す"""
+        timings: Dict[str, Dict[str, float]] = {}
+        token = _run_timings.set(timings)
+        try:
+            yield timings
+        finally:
+            _run_timings.reset(token)
+
+    def format_timings(self, timings: Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+        """run_timings の結果を JSON 用に丸める（並列ステージの seconds はスレッドの合計）"""
+        with self._lock:
+            return {stage: {'seconds': round(entry['seconds'], 4), 'calls': entry['calls']}
+                    for stage, entry in timings.items()}
+
+    def register_collector(self, collector):
+        """出力時に呼ぶ関数を登録する（(名前, ラベル辞書, 値) の列を返す。累計値はカウンターとして扱う）"""
+        self._collectors.append(collector)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """このプロセスの値（コレクター分を含む）"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    key = self._key(name, labels)
+                    counters[key] = counters.get(key, 0.0) + value
+            except Exception as e:
+                logger.warning("⚠️ メトリクス収集エラー: %s", e)
+        return self._to_snapshot(counters, histograms)
+
+    def _dump_path(self, pid: int) -> str:
+        return os.path.join(self.dump_dir, f"metrics-{pid}.json")
+
+    def flush(self):
+        """このプロセスの値を dump_dir に書き出す"""
+        if not self.dump_dir:
+            return
+        os.makedirs(self.dump_dir, exist_ok=True)
+        path = self._dump_path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_flusher(self):
+        """dump_dir があれば定期的に書き出すスレッドを起動する（何度呼んでもよい）"""
+        if not self.dump_dir or self._flusher_started:
+            return
+        with self._lock:
+            if self._flusher_started:
+                return
+            self._flusher_started = True
+
+        def run():
+            while True:
+                try:
+                    self.flush()
+                except OSError as e:
+                    logger.warning("⚠️ メトリクス書き出しエラー: %s", e)
+                time.sleep(self.flush_interval)
+
+        threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+    # 終了したワーカーの書き出しを畳み込んだファイル（カウンターが再起動で減らないように残す）
+    EXITED_DUMP = 'metrics-exited.json'
+
+    @contextmanager
+    def _dump_lock(self):
+        """dump_dir を読む・畳み込む間のプロセス間ロック（fcntl が無い環境ではロックなし）"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.dump_dir, 'metrics.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    @staticmethod
+    def _load_dump(path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _merged_snapshots(self) -> List[Dict[str, Any]]:
+        """このプロセスの最新値と、dump_dir にある他のワーカーの書き出し"""
+        snapshots = [self.snapshot()]
+        if not self.dump_dir:
+            return snapshots
+        try:
+            with self._dump_lock():
+                snapshots.extend(self._read_dumps())
+        except OSError as e:
+            logger.warning("⚠️ メトリクス読み込みエラー: %s", e)
+        return snapshots
+
+    def _read_dumps(self) -> List[Dict[str, Any]]:
+        """他のワーカーの書き出しを読む（_dump_lock の中で呼ぶ）
+
+        PID が既に無いワーカーの書き出しは EXITED_DUMP に足し込んでから消すので、
+        再起動のたびに同じ値を数え直すことも、合計が減ることもない。
+        """
+        live, exited = [], []
+        for name in os.listdir(self.dump_dir):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                pid = int(name[len('metrics-'):-len('.json')])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            path = os.path.join(self.dump_dir, name)
+            snapshot = self._load_dump(path)
+            if snapshot is None:
+                continue
+            if self._is_alive(pid):
+                live.append(snapshot)
+            else:
+                exited.append((path, snapshot))
+
+        exited_path = os.path.join(self.dump_dir, self.EXITED_DUMP)
+        folded = self._load_dump(exited_path)
+        if exited:
+            counters, histograms = self._accumulate(([folded] if folded else []) + [s for _, s in exited])
+            folded = self._to_snapshot(counters, histograms)
+            _write_atomic(exited_path, json.dumps(folded).encode('utf-8'))
+            for path, _ in exited:
+                os.remove(path)
+            logger.info("🧹 終了したワーカーのメトリクス%s件を畳み込みました", len(exited))
+        return live + ([folded] if folded else [])
+
+    @staticmethod
+    def _format_labels(labels, extra: Tuple = ()) -> str:
+        pairs = [tuple(pair) for pair in labels] + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in pairs) + '}'
+
+    def _merge(self) -> Tuple[Dict[Tuple[str, Tuple], float], Dict[Tuple[str, Tuple], List[float]]]:
+        """全ワーカー分を合算した (カウンター, ヒストグラム)"""
+        return self._accumulate(self._merged_snapshots())
+
+    @staticmethod
+    def _to_snapshot(counters: Dict[Tuple[str, Tuple], float],
+                     histograms: Dict[Tuple[str, Tuple], List[float]]) -> Dict[str, Any]:
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), values] for (name, labels), values in histograms.items()],
+        }
+
+    @staticmethod
+    def _accumulate(snapshots: Iterable[Dict[str, Any]]) -> Tuple[Dict[Tuple[str, Tuple], float],
+                                                                  Dict[Tuple[str, Tuple], List[float]]]:
+        """書き出しの列を合算した (カウンター, ヒストグラム)"""
+        counters: Dict[Tuple[str, Tuple], float] = {}
+        histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                counters[key] = counters.get(key, 0.0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                merged = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    merged[i] += value
+        return counters, histograms
+
+    @staticmethod
+    def _hit_ratios(counters: Dict[Tuple[str, Tuple], float]) -> Dict[Tuple[str, Tuple], float]:
+        """ヒット数とミス数からヒット率を出す（合算後に計算するのでワーカー全体の比率になる）"""
+        ratios = {}
+        for (name, labels), hits in counters.items():
+            if name == 'cache_hits_total':
+                total = hits + counters.get(('cache_misses_total', labels), 0.0)
+                ratios[('cache_hit_ratio', labels)] = hits / total if total else 0.0
+        return ratios
+
+    def cache_hit_ratios(self) -> Dict[str, float]:
+        """キャッシュごとのヒット率（全ワーカー分）"""
+        counters, _ = self._merge()
+        return {dict(labels).get('cache', ''): round(ratio, 4)
+                for (_, labels), ratio in sorted(self._hit_ratios(counters).items())}
+
+    def render(self) -> str:
+        """全ワーカー分を合算した Prometheus テキスト形式"""
+        counters, histograms = self._merge()
+        ratios = self._hit_ratios(counters)
+
+        lines = []
+        for metric in sorted({name for name, _ in list(counters) + list(histograms) + list(ratios)}):
+            kind, help_text = self.HELP.get(metric, ('counter', metric))
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for (name, labels), value in sorted(list(counters.items()) + list(ratios.items())):
+                if name == metric:
+                    lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+            for (name, labels), values in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + (float('inf'),), values[:-1]):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', le),))} {cumulative:g}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {values[-1]:.6f}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {cumulative:g}")
+        return '\n'.join(lines) + '\n'
+
+# 全体で共有するメトリクス
+metrics = Metrics(METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL)
+
+class PooledHTTPClient:
+    """ホストごとのKeep-Aliveコネクションプールを共有するHTTPクライアント
+
+    5xx/429 とコネクションエラーはジッター付き指数バックオフでリトライする。リトライするのは
+    冪等なメソッドだけで、POST などは呼び出し側が retry=True を渡したときだけ再送する。
+    試行ごとのステータスと応答時間は metrics に上流（バケット名かホスト）別で記録する。
+    rate_limiter を渡すと、送信前に URL に対応するバケットの枠を確保し、
+    429 の Retry-After をバケットに反映する（待ち時間の上限を超えるならすぐ諦める）。
+    fork 後の子プロセスでは親のソケットを使わないようセッションを作り直す。
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+    IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+
+    def __init__(self, pool_sizes: Dict[str, int], max_retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 rate_limiter: Optional[RateLimiter] = None, rate_limit_routes: Optional[List[Tuple[str, str]]] = None):
+        self.pool_sizes = dict(pool_sizes)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter
+        self.rate_limit_routes = list(rate_limit_routes or [])
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """セッションと統計を初期化（fork 後の子プロセスでも呼ばれる）"""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._session = None
+        self._adapters = {}
+        self._stats = {}
+
+    def _build_session(self) -> requests.Session:
+        session = requests.Session()
+        for prefix, size in self.pool_sizes.items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=False)
+            session.mount(prefix, adapter)
+            self._adapters[prefix] = adapter
+        return session
+
+    def _get_session(self) -> requests.Session:
+        if self._session is None or self._pid != os.getpid():
+            if self._pid != os.getpid():
+                self._reset()
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def _record(self, host: str, key: str):
+        with self._lock:
+            host_stats = self._stats.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0})
+            host_stats[key] += 1
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Retry-After があればそれを、なければフルジッターの待ち時間を返す"""
+        if retry_after:
+            try:
+                return min(self.backoff_max, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _bucket_for(self, url: str) -> Optional[str]:
+        for prefix, bucket in self.rate_limit_routes:
+            if url.startswith(prefix):
+                return bucket
+        return None
+
+    def _max_retries_for(self, method: str, retry: Optional[bool]) -> int:
+        """再送してよいリクエストだけリトライする（retry を省略したら冪等なメソッドかで決める）"""
+        if retry is None:
+            retry = method.upper() in self.IDEMPOTENT_METHODS
+        return self.max_retries if retry else 0
+
+    def request(self, method: str, url: str, retry: Optional[bool] = None, **kwargs) -> requests.Response:
+        session = self._get_session()
+        host = urlsplit(url).netloc
+        upstream = self._bucket_for(url) or host
+        bucket = upstream if self.rate_limiter and upstream != host else None
+        max_retries = self._max_retries_for(method, retry)
+
+        for attempt in range(max_retries + 1):
+            if bucket:
+                self.rate_limiter.acquire(bucket)
+            self._record(host, 'requests')
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                metrics.observe('upstream_request_seconds', time.perf_counter() - start, upstream=upstream)
+                metrics.inc('upstream_requests_total', upstream=upstream, status='ERROR')
+                self._record(host, 'errors')
+                if attempt >= max_retries:
+                    raise
+                self._record(host, 'retries')
+                time.sleep(self._backoff(attempt))
+                continue
+
+            metrics.observe('upstream_request_seconds', time.perf_counter() - start, upstream=upstream)
+            metrics.inc('upstream_requests_total', upstream=upstream, status=response.status_code)
+
+            if response.status_code == 429 and bucket:
+                # 他のワーカーも含めて Retry-After の間はこの上流へ送らない
+                penalty = self._retry_after_seconds(response, attempt)
+                self.rate_limiter.penalize(bucket, penalty)
+                error = self._penalty_error(bucket, penalty, attempt, max_retries)
+                if error is not None:
+                    response.close()
+                    raise error
+
+            if response.status_code in self.RETRY_STATUSES and attempt < max_retries:
+                self._record(host, 'retries')
+                delay = self._retry_delay(response, attempt, bucket)
+                response.close()
+                time.sleep(delay)
+                continue
+
+            return response
+
+    def _penalty_error(self, bucket: str, penalty: float, attempt: int,
+                       max_retries: int) -> Optional[RateLimitExceeded]:
+        """リトライする予定でも、Retry-After が待ち時間の上限を超えるなら眠らずにすぐ諦める
+
+        待ってから acquire しても上限超えで RateLimitExceeded になるだけなので。
+        """
+        if attempt < max_retries and penalty > self.rate_limiter.max_wait:
+            return RateLimitExceeded(bucket, '上流の Retry-After が待ち時間上限を超えました', penalty)
+        return None
+
+    def _retry_delay(self, response, attempt: int, bucket: Optional[str]) -> float:
+        """次の試行までの待ち時間（レート制限のある 429 はバケットが止めているので acquire で待つ）"""
+        if response.status_code == 429 and bucket:
+            return 0.0
+        return self._backoff(attempt, response.headers.get('Retry-After'))
+
+    def _retry_after_seconds(self, response: requests.Response, attempt: int) -> float:
+        """429 の Retry-After（秒）。無ければバックオフの上限を使う"""
+        try:
+            return max(0.0, float(response.headers.get('Retry-After', '')))
+        except ValueError:
+            return min(self.backoff_max, self.backoff_base * (2 ** attempt))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """POST は既定ではリトライしない（再送してよいなら retry=True を渡す）"""
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """ホスト別のリクエスト数とコネクションプール使用状況"""
+        with self._lock:
+            result = {host: dict(values) for host, values in self._stats.items()}
+            adapters = list(self._adapters.items())
+
+        for prefix, adapter in adapters:
+            host = urlsplit(prefix).netloc
+            host_stats = result.setdefault(host, {'requests': 0, 'retries': 0, 'errors': 0})
+            connections = 0
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                idle = sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0
+                host_stats['idle_connections'] = host_stats.get('idle_connections', 0) + idle
+            host_stats['pool_maxsize'] = self.pool_sizes[prefix]
+            host_stats['connections_opened'] = connections
+            if host_stats['requests']:
+                host_stats['connection_reuse_ratio'] = round(1 - connections / host_stats['requests'], 3)
+
+        return {'pid': self._pid, 'hosts': result}
+
+# 全APIコールで共有するHTTPクライアント
+http_client = PooledHTTPClient(HTTP_POOL_SIZES, max_retries=HTTP_MAX_RETRIES,
+                               backoff_base=HTTP_BACKOFF_BASE, backoff_max=HTTP_BACKOFF_MAX,
+                               rate_limiter=rate_limiter, rate_limit_routes=RATE_LIMIT_ROUTES)
+
+class AsyncPooledHTTPClient(PooledHTTPClient):
+    """PooledHTTPClient の asyncio 版（httpx.AsyncClient を使い、リトライ・レート制限・メトリクスは同じ）
+
+    待っている間はイベントループを止めないので、1プロセスで多数のリクエストを同時に待てる。
+    クライアントはイベントループごとに作り直す。
+    """
+
+    def _reset(self):
+        super()._reset()
+        self._client = None
+        self._loop = None
+        self._closing = set()
+
+    def _get_client(self) -> 'httpx.AsyncClient':
+        loop = asyncio.get_running_loop()
+        if self._pid != os.getpid():
+            self._reset()
+        if self._client is not None and self._loop is not loop:
+            self._discard_client(self._client, self._loop)
+            self._client = None
+        if self._client is None:
+            total = sum(self.pool_sizes.values())
+            self._client = httpx.AsyncClient(limits=httpx.Limits(max_connections=total,
+                                                                 max_keepalive_connections=total))
+            self._loop = loop
+        return self._client
+
+    def _discard_client(self, client: 'httpx.AsyncClient', loop: Optional[asyncio.AbstractEventLoop]):
+        """別のイベントループで作ったクライアントの接続を閉じる
+
+        元のループが動いていればそのループで閉じ、終わっていれば現在のループで閉じる。
+        """
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._aclose_client(client), loop)
+            return
+        task = asyncio.ensure_future(self._aclose_client(client))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _aclose_client(client: 'httpx.AsyncClient'):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.debug("古い HTTP クライアントのクローズに失敗: %s", e)
+
+    async def aclose(self):
+        """現在のクライアントの接続を閉じる（非同期モードの終了時に呼ぶ）"""
+        client, self._client, self._loop = self._client, None, None
+        if client is not None and self._pid == os.getpid():
+            await self._aclose_client(client)
+
+    async def request(self, method: str, url: str, retry: Optional[bool] = None, **kwargs) -> 'httpx.Response':
+        client = self._get_client()
+        host = urlsplit(url).netloc
+        upstream = self._bucket_for(url) or host
+        bucket = upstream if self.rate_limiter and upstream != host else None
+        max_retries = self._max_retries_for(method, retry)
+
+        for attempt in range(max_retries + 1):
+            if bucket:
+                await self.rate_limiter.acquire_async(bucket)
+            self._record(host, 'requests')
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                metrics.observe('upstream_request_seconds', time.perf_counter() - start, upstream=upstream)
+                metrics.inc('upstream_requests_total', upstream=upstream, status='ERROR')
+                self._record(host, 'errors')
+                if attempt >= max_retries:
+                    raise
+                self._record(host, 'retries')
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+
+            metrics.observe('upstream_request_seconds', time.perf_counter() - start, upstream=upstream)
+            metrics.inc('upstream_requests_total', upstream=upstream, status=response.status_code)
+
+            if response.status_code == 429 and bucket:
+                penalty = self._retry_after_seconds(response, attempt)
+                await self.rate_limiter.penalize_async(bucket, penalty)
+                error = self._penalty_error(bucket, penalty, attempt, max_retries)
+                if error is not None:
+                    await response.aclose()
+                    raise error
+
+            if response.status_code in self.RETRY_STATUSES and attempt < max_retries:
+                self._record(host, 'retries')
+                delay = self._retry_delay(response, attempt, bucket)
+                await response.aclose()
+                await asyncio.sleep(delay)
+                continue
+
+            return response
+
+    async def get(self, url: str, **kwargs) -> 'httpx.Response':
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> 'httpx.Response':
+        return await self.request('POST', url, **kwargs)
+
+# 非同期モード（asgi.py）用の共有クライアント（httpx が無ければ None）
+async_http_client = AsyncPooledHTTPClient(HTTP_POOL_SIZES, max_retries=HTTP_MAX_RETRIES,
+                                          backoff_base=HTTP_BACKOFF_BASE, backoff_max=HTTP_BACKOFF_MAX,
+                                          rate_limiter=rate_limiter,
+                                          rate_limit_routes=RATE_LIMIT_ROUTES) if httpx is not None else None
 
 class eBayTokenManager:
     def __init__(self):
@@ -48,33 +1052,35 @@ class eBayTokenManager:
         self.client_secret = os.getenv('EBAY_CLIENT_SECRET')
 
     def generate_new_application_token(self):
-        print("=== 修正版 Application Token生成 ===")
+        token_info = self.request_application_token()
+        return token_info['access_token'] if token_info else None
+
+    def request_application_token(self) -> Optional[Dict[str, Any]]:
+        """Application Tokenを生成し、トークンと有効期限（epoch秒）を返す"""
+        logger.info("=== Application Token生成 ===")
 
         if not all([self.app_id, self.client_secret]):
-            print("❌ 必要な情報が不足:")
-            print(f"   EBAY_APP_ID: {'✓' if self.app_id else '✗'}")
-            print(f"   EBAY_CLIENT_SECRET: {'✓' if self.client_secret else '✗'}")
+            logger.error("❌ 必要な情報が不足 (EBAY_APP_ID: %s, EBAY_CLIENT_SECRET: %s)",
+                         '✓' if self.app_id else '✗', '✓' if self.client_secret else '✗')
             return None
 
         try:
-            token_url = "https://api.ebay.com/identity/v1/oauth2/token"
+            token_url = f"{EBAY_API_BASE_URL}/identity/v1/oauth2/token"
 
             # === eBay公式ドキュメントに従った認証ヘッダーのデバッグ ===
-            print("🔍 OAuth認証ヘッダーのデバッグ:")
+            logger.debug("🔍 OAuth認証ヘッダーのデバッグ:")
 
-            # Step 1: client_id:client_secretの組み合わせ
+            # Step 1: client_id:client_secretの組み合わせ（シークレットはログに出さない）
             credentials_raw = f"{self.app_id}:{self.client_secret}"
-            print(f"   Step 1 - Raw credentials: {self.app_id}:{self.client_secret}")
-            print(f"   Combined format: client_id:client_secret ✓")
+            logger.debug("   Step 1 - Raw credentials: %s:[MASKED_FOR_SECURITY]", self.app_id)
 
             # Step 2: Base64エンコーディング
             encoded_credentials = base64.b64encode(credentials_raw.encode()).decode()
-            print(f"   Step 2 - Base64 encoded: {encoded_credentials[:20]}...")
+            logger.debug("   Step 2 - Base64 encoded: %s...", encoded_credentials[:8])
 
             # Step 3: Authorization ヘッダーの構築
             auth_header_value = f'Basic {encoded_credentials}'
-            print(f"   Step 3 - Authorization header: Basic [B64_ENCODED_CREDENTIALS]")
-            print(f"   Header format check: 'Basic ' + space + credentials ✓")
+            logger.debug("   Step 3 - Authorization header: Basic [B64_ENCODED_CREDENTIALS]")
 
             headers = {
                 'Content-Type': 'application/x-www-form-urlencoded',
@@ -82,24 +1088,24 @@ class eBayTokenManager:
             }
 
             # === リクエストヘッダーの確認 ===
-            print("📤 送信ヘッダー:")
-            for key, value in headers.items():
-                if key == 'Authorization':
-                    print(f"   {key}: Basic [MASKED_FOR_SECURITY]")
-                else:
-                    print(f"   {key}: {value}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📤 送信ヘッダー:")
+                for key, value in headers.items():
+                    logger.debug("   %s: %s", key, 'Basic [MASKED_FOR_SECURITY]' if key == 'Authorization' else value)
 
             data = {
                 'grant_type': 'client_credentials',
                 'scope': 'https://api.ebay.com/oauth/api_scope'
             }
 
-            print("📤 送信データ:")
-            for key, value in data.items():
-                print(f"   {key}: {value}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📤 送信データ:")
+                for key, value in data.items():
+                    logger.debug("   %s: %s", key, value)
 
-            print(f"📤 トークンリクエスト送信中...")
-            response = requests.post(token_url, headers=headers, data=data, timeout=30)
+            logger.debug("📤 トークンリクエスト送信中...")
+            # トークンの発行は何度送っても同じなのでリトライしてよい
+            response = http_client.post(token_url, headers=headers, data=data, timeout=30, retry=True)
 
             # rlogIdをレスポンスヘッダーから取得
             rlog_id = (response.headers.get('X-EBAY-C-REQUEST-ID') or
@@ -107,28 +1113,31 @@ class eBayTokenManager:
                       response.headers.get('x-ebay-c-request-id') or
                       response.headers.get('rlogid'))  # この行を追加
 
-            print(f"📨 レスポンス: {response.status_code}")
-            print(f"🆔 rlogId: {rlog_id}")
+            logger.info("📨 レスポンス: %s (rlogId: %s)", response.status_code, rlog_id)
 
             # 全レスポンスヘッダーを出力
-            print("📋 全レスポンスヘッダー:")
-            for key, value in response.headers.items():
-                print(f"   {key}: {value}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("📋 全レスポンスヘッダー:")
+                for key, value in response.headers.items():
+                    logger.debug("   %s: %s", key, value)
 
             if response.status_code == 200:
                 token_data = response.json()
                 access_token = token_data.get('access_token')
                 expires_in = token_data.get('expires_in')
-                print(f"✅ トークン生成成功!")
-                print(f"   有効期限: {expires_in/3600:.1f}時間")
-                return access_token
+                logger.info("✅ トークン生成成功! 有効期限: %.1f時間", float(expires_in or 0) / 3600)
+                now = time.time()
+                return {
+                    'access_token': access_token,
+                    'issued_at': now,
+                    'expires_at': now + float(expires_in or 0)
+                }
             else:
-                print(f"❌ トークン生成失敗: {response.status_code}")
-                print(f"   エラー詳細: {response.text}")
+                logger.error("❌ トークン生成失敗: %s エラー詳細: %s", response.status_code, response.text)
                 return None
 
         except Exception as e:
-            print(f"❌ トークン生成エラー: {e}")
+            logger.error("❌ トークン生成エラー: %s", e)
             return None
 
     def test_token_validity(self, token):
@@ -137,7 +1146,7 @@ class eBayTokenManager:
             return False
 
         try:
-            test_url = "https://api.ebay.com/buy/browse/v1/item_summary/search"
+            test_url = f"{EBAY_API_BASE_URL}/buy/browse/v1/item_summary/search"
             headers = {
                 'Authorization': f'Bearer {token}',
                 'X-EBAY-C-MARKETPLACE-ID': 'EBAY_US',
@@ -145,266 +1154,2930 @@ class eBayTokenManager:
             }
 
             params = {'q': 'test', 'limit': '1'}
-            response = requests.get(test_url, headers=headers, params=params, timeout=15)
+            response = http_client.get(test_url, headers=headers, params=params, timeout=15)
 
             return response.status_code == 200
 
         except:
             return False
 
-class SmarteBayAnalyzer:
-    def __init__(self):
-        global EBAY_OAUTH_TOKEN
+class SharedTokenStore:
+    """ワーカープロセス間でトークンを共有するJSONファイルストア"""
 
-        self.base_url = "https://api.ebay.com/buy/browse/v1"
-        self.token_manager = eBayTokenManager()
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
 
-        # 日本関連キーワード辞書
-        self.japanese_keywords = {
-            'culture': ['kimono', 'yukata', 'obi', 'geta', 'zori', 'tabi', 'furoshiki', 'noren', 'daruma'],
-            'food': ['ramen', 'sushi', 'sake', 'miso', 'soy sauce', 'shoyu', 'mirin', 'dashi', 'wasabi', 'matcha', 'sencha', 'gyoza', 'tempura', 'yakitori', 'bento', 'onigiri'],
-            'anime_manga': ['anime', 'manga', 'otaku', 'cosplay', 'figure', 'figurine', 'pokemon', 'naruto', 'one piece', 'dragon ball', 'sailor moon', 'gundam', 'studio ghibli'],
-            'crafts': ['pottery', 'ceramics', 'lacquer', 'urushi', 'bamboo', 'washi', 'origami', 'calligraphy', 'shodo', 'ikebana', 'bonsai'],
-            'weapons': ['katana', 'wakizashi', 'tanto', 'samurai', 'ninja', 'sword', 'tsuba'],
-            'home': ['zabuton', 'tatami', 'shoji', 'kotatsu', 'futon', 'tansu'],
-            'brands': ['nintendo', 'sony', 'honda', 'toyota', 'canon', 'nikon', 'casio', 'citizen', 'seiko', 'uniqlo', 'muji']
-        }
+    @contextmanager
+    def lock(self):
+        """プロセス間の排他ロック（fcntl が無い環境ではロックなし）"""
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-        # トークン設定
-        current_token = EBAY_OAUTH_TOKEN
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('access_token') and data.get('expires_at'):
+                return data
+        except (OSError, ValueError):
+            pass
+        return None
 
-        print("=== eBay API トークン診断 ===")
-        if current_token and self.token_manager.test_token_validity(current_token):
-            print("✅ 現在のトークンは有効です")
-        else:
-            print("🔄 新しいトークンを生成します...")
-            new_token = self.token_manager.generate_new_application_token()
-
-            if new_token:
-                current_token = new_token
-                EBAY_OAUTH_TOKEN = new_token
-                os.environ['EBAY_OAUTH_TOKEN'] = new_token
-                print("✅ 新しいトークンを設定しました")
-            else:
-                print("❌ トークン生成に失敗しました")
-                current_token = None
+    def discard(self, token: str):
+        """保存中のトークンが token なら消す（lock() の中で呼ぶ）"""
+        data = self.load()
+        if data and data['access_token'] == token:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
 
-        # ヘッダーを設定
-        if current_token:
-            self.headers = {
-                'Authorization': f'Bearer {current_token}',
-                'X-EBAY-C-MARKETPLACE-ID': 'EBAY_US',
-                'Accept': 'application/json',
-                'User-Agent': 'eBayAnalyzer/1.0'
-            }
-            print("✅ APIヘッダー設定完了")
-        else:
-            print("❌ 有効なトークンがありません")
-            self.headers = {
-                'Accept': 'application/json',
-                'User-Agent': 'eBayAnalyzer/1.0'
-            }
+    def save(self, token_info: Dict[str, Any]):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(token_info, f)
+        os.replace(tmp_path, self.path)
 
-    def get_japanese_items_smart(self, limit: int = 200) -> List[Dict[Any, Any]]:
-        """効率的に日本関連商品を取得"""
-        if 'Authorization' not in self.headers:
-            print("❌ 有効なトークンがありません")
-            return []
+class eBayTokenCache:
+    """有効期限を考慮したアプリケーショントークンのキャッシュ
 
-        all_items = []
+    期限切れの refresh_margin 秒前からバックグラウンドで更新し、同時に発生した
+    更新要求は1回のトークン生成にまとめる。store を渡すとワーカー間で共有する。
+    """
 
-        # より具体的な日本関連検索クエリ
-        search_queries = [
-            'japan vintage',
-            'japanese art',
-            'anime figure',
-            'japanese pottery',
-            'kimono vintage',
-            'japanese tea set',
-            'manga collection',
-            'nintendo japan',
-            'japanese ceramics',
-            'samurai sword',
-            'japanese food',
-            'zen garden'
-        ]
+    def __init__(self, token_manager: 'eBayTokenManager', refresh_margin: float = 300,
+                 store: Optional[SharedTokenStore] = None, static_token: Optional[str] = None,
+                 static_token_ttl: float = 1800):
+        self.token_manager = token_manager
+        self.refresh_margin = refresh_margin
+        self.store = store
+        self.static_token = static_token
+        self.static_token_ttl = static_token_ttl
+        self.refresh_count = 0
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
 
-        items_per_query = max(1, limit // len(search_queries))
+    def _reset(self):
+        """ロックとタイマーを初期化（fork 後の子プロセスでも呼ばれる）"""
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._token_info = getattr(self, '_token_info', None)
+        self._revoked = getattr(self, '_revoked', None)
+        self._timer = None
 
-        for query in search_queries:
-            print(f"🔍 検索クエリ: '{query}'")
+    def _is_usable(self, token_info: Optional[Dict[str, Any]], margin: float = 0) -> bool:
+        return bool(token_info) and token_info['expires_at'] - margin > time.time()
 
-            params = {
-                'limit': str(min(items_per_query, 50)),
-                'sort': 'bestMatch',
-                'q': query,
-                'filter': 'buyingOptions:{AUCTION,FIXED_PRICE},conditions:{NEW,USED}'
-            }
+    def _margin(self, token_info: Optional[Dict[str, Any]]) -> float:
+        """期限前に更新を始める秒数（有効期間が refresh_margin 以下のトークンは期間の半分）"""
+        if not token_info or 'issued_at' not in token_info:
+            return self.refresh_margin
+        return min(self.refresh_margin, (token_info['expires_at'] - token_info['issued_at']) / 2)
 
-            url = f"{self.base_url}/item_summary/search"
+    def get_token(self) -> Optional[str]:
+        """有効なトークンを返す（期限が近ければ裏で更新、切れていれば同期更新）"""
+        token_info = self._token_info
+        if self._is_usable(token_info, self._margin(token_info)):
+            return token_info['access_token']
 
-            try:
-                response = requests.get(url, params=params, headers=self.headers, timeout=30)
+        if self._is_usable(token_info):
+            self._refresh_in_background()
+            return token_info['access_token']
 
-                if response.status_code == 401:
-                    print("   ❌ 認証エラー: トークンを再生成します")
-                    new_token = self.token_manager.generate_new_application_token()
-                    if new_token:
-                        self.headers['Authorization'] = f'Bearer {new_token}'
-                        response = requests.get(url, params=params, headers=self.headers, timeout=30)
+        token_info = self._refresh()
+        return token_info['access_token'] if token_info else None
 
-                if response.status_code == 200:
-                    data = response.json()
-                    items = data.get('itemSummaries', [])
-                    print(f"   ✅ {len(items)}件取得")
+    async def get_token_async(self) -> Optional[str]:
+        """get_token の asyncio 版（同期更新が必要なときだけ別スレッドで待つ）"""
+        token_info = self._token_info
+        if self._is_usable(token_info):
+            return self.get_token()
+        return await asyncio.to_thread(self.get_token)
 
-                    # 各商品にローカル分析を追加
-                    for item in items:
-                        enhanced_item = self.enhance_item_with_local_analysis(item)
-                        all_items.append(enhanced_item)
+    def invalidate(self, token: Optional[str]):
+        """401 を受けたトークンを破棄する（既に更新済みなら何もしない）
 
-                else:
-                    print(f"   ❌ エラー: {response.status_code}")
+        共有ストアに同じトークンが残っていれば消し、他のワーカーも作り直すようにする。
+        """
+        if not token:
+            return
+        with self._lock:
+            self._revoked = token
+            if self._token_info and self._token_info['access_token'] == token:
+                self._token_info = None
+        if self.store is not None:
+            with self.store.lock():
+                self.store.discard(token)
 
-            except Exception as e:
-                print(f"   ❌ リクエストエラー: {e}")
-                continue
+    def expires_in(self) -> Optional[float]:
+        token_info = self._token_info
+        return token_info['expires_at'] - time.time() if token_info else None
 
-        # 重複除去
-        unique_items = {}
-        for item in all_items:
-            item_id = item.get('itemId')
-            if item_id not in unique_items:
-                unique_items[item_id] = item
+    def _refresh_in_background(self):
+        if self._refresh_lock.locked():
+            return
+        threading.Thread(target=self._refresh, name='ebay-token-refresh', daemon=True).start()
 
-        result_items = list(unique_items.values())
+    def _refresh(self) -> Optional[Dict[str, Any]]:
+        """シングルフライトでトークンを更新する"""
+        with self._refresh_lock:
+            # 待っている間に他のスレッドが更新していればそれを使う
+            current = self._token_info
+            if self._is_usable(current, self._margin(current)):
+                return current
 
-        # 人気度スコアで並び替え
-        for item in result_items:
-            item['popularityScore'] = self.calculate_popularity_score(item)
+            if self.store is None:
+                token_info = self._mint()
+            else:
+                with self.store.lock():
+                    token_info = self.store.load()
+                    # 401 で破棄したトークンが（別ワーカーの書き込みなどで）残っていても使わない
+                    if (not self._is_usable(token_info, self._margin(token_info))
+                            or token_info['access_token'] == self._revoked):
+                        token_info = self._mint()
+                        if token_info and token_info['access_token'] != self.static_token:
+                            self.store.save(token_info)
 
-        result_items.sort(key=lambda x: x['popularityScore'], reverse=True)
+            if token_info is None and self._is_usable(current):
+                token_info = current
 
-        print(f"📈 合計 {len(result_items)}件の日本関連商品を取得")
-        return result_items[:limit]
+            with self._lock:
+                self._token_info = token_info
+            self._schedule_refresh(token_info)
+            return token_info
 
-    def enhance_item_with_local_analysis(self, item: Dict[Any, Any]) -> Dict[Any, Any]:
-        """ローカル分析で商品情報を強化（Gemini APIを使わない）"""
-        title = str(item.get('title', '')).lower()
-        description = str(item.get('shortDescription', '')).lower()
-        combined_text = f"{title} {description}"
+    def _mint(self) -> Optional[Dict[str, Any]]:
+        token_info = self.token_manager.request_application_token()
+        if token_info:
+            self.refresh_count += 1
+            return token_info
 
-        # キーワードベースの分類
-        categories_found = []
-        keyword_score = 0
+        # 認証情報が無い場合は .env の固定トークンを期限不明として使う
+        if self.static_token and self.token_manager.test_token_validity(self.static_token):
+            logger.info("✅ 既存のEBAY_OAUTH_TOKENを使用します")
+            now = time.time()
+            return {'access_token': self.static_token, 'issued_at': now,
+                    'expires_at': now + self.static_token_ttl}
+        return None
 
-        for category, keywords in self.japanese_keywords.items():
-            category_matches = 0
-            for keyword in keywords:
-                if keyword.lower() in combined_text:
-                    category_matches += 1
-                    keyword_score += 1
+    def _schedule_refresh(self, token_info: Optional[Dict[str, Any]]):
+        """期限切れ前の更新タイマーを設定する"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not token_info:
+            return
+        delay = max(1.0, token_info['expires_at'] - self._margin(token_info) - time.time())
+        self._timer = threading.Timer(delay, self._refresh)
+        self._timer.daemon = True
+        self._timer.start()
 
-            if category_matches > 0:
-                categories_found.append({
-                    'category': category,
-                    'matches': category_matches,
-                    'keywords': [k for k in keywords if k.lower() in combined_text]
-                })
+class KeywordMatcher:
+    """カテゴリ別キーワード辞書を1本の正規表現にまとめたマッチャー
 
-        # 最も多くマッチしたカテゴリを主カテゴリとする
-        primary_category = "その他"
-        confidence = 0.5  # デフォルト
+    テキストを1回走査するだけで、カテゴリごとの一致キーワードと一致数を返す。
+    キーワードはトライ状の正規表現にまとめるので、照合コストは辞書の語数では
+    なくテキスト長に比例する。各位置で最長一致したキーワードから、その接頭辞に
+    なっているキーワードもたどるので、結果は従来の `keyword in text` と一致する。
+    """
 
-        if categories_found:
-            categories_found.sort(key=lambda x: x['matches'], reverse=True)
-            primary_category = categories_found[0]['category']
-            # マッチ数に基づく信頼度計算
-            max_matches = categories_found[0]['matches']
-            confidence = min(0.9, 0.5 + (max_matches * 0.1))
+    _WORD_CHAR = re.compile(r'\w')
 
-        # 日本語文字の検出
-        has_japanese_chars = bool(re.search(r'[ひらがなカタカナ漢字]', combined_text))
-        if has_japanese_chars:
-            confidence = min(0.95, confidence + 0.2)
+    def __init__(self, keywords: Dict[str, List[str]], word_boundary: bool = False):
+        self.word_boundary = word_boundary
+        self.categories = list(keywords.keys())
 
-        # 価格による重み付け
-        price_info = item.get('price', {})
-        if price_info and 'value' in price_info:
-            try:
-                price = float(price_info['value'])
-                # 高額商品は信頼度を少し上げる
-                if price > 100:
-                    confidence = min(0.98, confidence + 0.05)
-            except:
-                pass
+        # 小文字化したパターン -> [(カテゴリ, 辞書内の位置, 元のキーワード)]
+        self._entries: Dict[str, List[Tuple[str, int, str]]] = {}
+        for category, words in keywords.items():
+            for position, keyword in enumerate(words):
+                pattern = keyword.lower()
+                if pattern:
+                    self._entries.setdefault(pattern, []).append((category, position, keyword))
 
-        # 分析結果を商品に追加
-        item['local_analysis'] = {
-            'is_japanese': True,  # japanクエリで検索しているので基本的にTrue
-            'confidence': confidence,
-            'primary_category': primary_category,
-            'categories_found': categories_found,
+        # パターンをトライにまとめ、各位置で1本の枝だけをたどる正規表現にする
+        trie: Dict[str, Any] = {}
+        for pattern in self._entries:
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[''] = pattern
+
+        # 各パターンについて「自身の接頭辞になっているパターン」をトライから求める
+        self._prefixes: Dict[str, List[str]] = {}
+        for pattern in self._entries:
+            node, prefixes = trie, []
+            for char in pattern:
+                node = node[char]
+                if '' in node:
+                    prefixes.append(node[''])
+            self._prefixes[pattern] = prefixes
+
+        alternation = self._trie_to_regex(trie) if trie else '(?!)'
+        if word_boundary:
+            self._regex = re.compile(rf'(?<!\w)(?=({alternation})(?!\w))')
+        else:
+            self._regex = re.compile(rf'(?=({alternation}))')
+
+    @classmethod
+    def _trie_to_regex(cls, node: Dict[str, Any]) -> str:
+        """トライを正規表現に変換する（終端を持つ節は省略可能にして最長一致させる）"""
+        branches = [re.escape(char) + cls._trie_to_regex(child)
+                    for char, child in sorted(node.items()) if char != '']
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        return group + '?' if '' in node else group
+
+    def _ends_at_boundary(self, text: str, end: int) -> bool:
+        return end >= len(text) or not self._WORD_CHAR.match(text, end)
+
+    def match(self, text: str) -> Tuple[Dict[str, List[str]], int]:
+        """小文字化済みテキストを照合し、(カテゴリ -> 一致キーワード, 総一致数) を返す"""
+        found = set()
+        for m in self._regex.finditer(text):
+            longest = m.group(1)
+            start = m.start()
+            for pattern in self._prefixes[longest]:
+                if pattern in found:
+                    continue
+                if (self.word_boundary and pattern is not longest
+                        and not self._ends_at_boundary(text, start + len(pattern))):
+                    continue
+                found.add(pattern)
+
+        if not found:
+            return {}, 0
+
+        hits: Dict[str, List[Tuple[int, str]]] = {}
+        keyword_score = 0
+        for pattern in found:
+            for category, position, keyword in self._entries[pattern]:
+                hits.setdefault(category, []).append((position, keyword))
+                keyword_score += 1
+
+        # 辞書のカテゴリ順・キーワード順に揃える
+        matches = {
+            category: [keyword for _, keyword in sorted(hits[category])]
+            for category in self.categories if category in hits
+        }
+        return matches, keyword_score
+
+# ひらがな・カタカナ（半角、音声拡張を含む）・CJK統合漢字（拡張A、互換漢字を含む）のいずれか1文字
+JAPANESE_SCRIPT = re.compile(r'[\u3040-\u309f\u30a0-\u30ff\u31f0-\u31ff\u3400-\u4dbf\u4e00-\u9fff'
+                             r'\uf900-\ufaff\uff66-\uff9f]')
+
+class HashedNgramClassifier:
+    """商品テキストの単語・単語2-gram・文字3-gram を特徴ハッシュした多クラス線形分類器（ソフトマックス回帰）
+
+    重みは商品ストアの分類済み商品からオフラインで学習して .npz に保存する（train_classifier.py）。
+    予測はバッチ全体の特徴を CSR 形式の配列にまとめ、重み行列との積と softmax を一度に計算する。
+    ハッシュは crc32 なので、プロセスが違っても同じ特徴は同じ列になる。NumPy が必要。
+    """
+
+    _TOKEN_RE = re.compile(r'\w+')
+
+    def __init__(self, weights: 'np.ndarray', classes: List[str]):
+        self.weights = weights
+        self.classes = list(classes)
+        self.n_features = weights.shape[0]
+
+    @functools.cached_property
+    def version(self) -> str:
+        """重みとクラスのハッシュ（分類器を差し替えたら保存済みのローカル分析を使い回さない）"""
+        return hashlib.sha1(self.weights.tobytes() + json.dumps(self.classes).encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def load(cls, path: str) -> 'HashedNgramClassifier':
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['weights'].astype(np.float32), data['classes'].tolist())
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, weights=self.weights, classes=np.array(self.classes))
+
+    def feature_ids(self, text: str) -> List[int]:
+        """テキストの特徴列（0 列目はバイアス、同じ特徴は1回だけ）"""
+        words = self._TOKEN_RE.findall(text.lower())
+        grams = [f"w:{word}" for word in words]
+        grams += [f"b:{first} {second}" for first, second in zip(words, words[1:])]
+        for word in words:
+            padded = f"<{word}>"
+            grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        if JAPANESE_SCRIPT.search(text):
+            grams.append('script:ja')
+        buckets = self.n_features - 1
+        return [0] + sorted({zlib.crc32(gram.encode('utf-8')) % buckets + 1 for gram in grams})
+
+    def transform(self, texts: List[str]) -> Tuple['np.ndarray', 'np.ndarray', 'np.ndarray']:
+        """テキストのバッチを CSR 形式の (indptr, indices, values) にする（各行の特徴は L2 正規化）"""
+        indptr, indices, values = [0], [], []
+        for text in texts:
+            ids = self.feature_ids(text)
+            indices.extend(ids)
+            values.extend([1.0 / math.sqrt(len(ids))] * len(ids))
+            indptr.append(len(indices))
+        return (np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int64),
+                np.asarray(values, dtype=np.float32))
+
+    @staticmethod
+    def _softmax(logits: 'np.ndarray') -> 'np.ndarray':
+        logits = logits - logits.max(axis=1, keepdims=True)
+        np.exp(logits, out=logits)
+        return logits / logits.sum(axis=1, keepdims=True)
+
+    def _logits(self, indptr: 'np.ndarray', indices: 'np.ndarray', values: 'np.ndarray') -> 'np.ndarray':
+        # どの行にもバイアス列があるので、行ごとの区間は空にならない
+        return np.add.reduceat(self.weights[indices] * values[:, None], indptr[:-1], axis=0)
+
+    def predict_proba(self, texts: List[str]) -> 'np.ndarray':
+        """各テキストのクラス確率（行がテキスト、列が classes の順）"""
+        if not texts:
+            return np.zeros((0, len(self.classes)), dtype=np.float32)
+        return self._softmax(self._logits(*self.transform(texts)))
+
+    @classmethod
+    def fit(cls, texts: List[str], labels: List[str], n_features: int = 1 << 18, epochs: int = 10,
+            learning_rate: float = 0.5, batch_size: int = 256, seed: int = 0) -> 'HashedNgramClassifier':
+        """ミニバッチ SGD で交差エントロピーを最小化して学習する（重みは触れた行だけ更新する）"""
+        classes = sorted(set(labels))
+        model = cls(np.zeros((n_features, len(classes)), dtype=np.float32), classes)
+        indptr, indices, values = model.transform(texts)
+        targets = np.asarray([classes.index(label) for label in labels])
+        rng = np.random.default_rng(seed)
+
+        for _ in range(epochs):
+            for rows in np.array_split(rng.permutation(len(texts)), max(1, len(texts) // batch_size)):
+                # 選んだ行の特徴を取り出して、ミニバッチ用の CSR を作る
+                starts, lengths = indptr[rows], indptr[rows + 1] - indptr[rows]
+                batch_indptr = np.concatenate(([0], np.cumsum(lengths)))
+                positions = np.repeat(starts - batch_indptr[:-1], lengths) + np.arange(batch_indptr[-1])
+                batch_indices, batch_values = indices[positions], values[positions]
+
+                gradient = model._softmax(model._logits(batch_indptr, batch_indices, batch_values))
+                gradient[np.arange(len(rows)), targets[rows]] -= 1.0
+                gradient /= len(rows)
+                row_of = np.repeat(np.arange(len(rows)), lengths)
+                np.add.at(model.weights, batch_indices,
+                          -learning_rate * gradient[row_of] * batch_values[:, None])
+
+        return model
+
+class StaleWhileRevalidateCache:
+    """TTL と stale-while-revalidate に対応した計算結果キャッシュ
+
+    TTL 内はそのまま返し、TTL 切れから stale_ttl 秒までは古い結果を返しつつ
+    バックグラウンドで再計算する。同じキーへの同時ミスは1回の計算にまとめる。
+    get_or_compute_async はコルーチンで計算し、待つ間スレッドを占有しない
+    （スレッド側の計算もコルーチン側の計算も同じキーなら1回にまとめる）。
+    """
+
+    class _Flight:
+        def __init__(self):
+            self.done = threading.Event()
+            self.value = None
+            self.error = None
+            self._lock = threading.Lock()
+            self._waiters = []  # (イベントループ, Future)
+
+        def finish(self):
+            with self._lock:
+                self.done.set()
+                waiters, self._waiters = self._waiters, []
+            for loop, future in waiters:
+                loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+        async def wait_async(self):
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            with self._lock:
+                if self.done.is_set():
+                    return
+                self._waiters.append((loop, future))
+            await future
+
+    def __init__(self, ttl: float, stale_ttl: float = 0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[float, Any]] = {}
+        self._inflight: Dict[str, 'StaleWhileRevalidateCache._Flight'] = {}
+        self._tasks = set()  # 実行中の非同期計算（途中で回収されないよう参照を持つ）
+        self.counters = {'hit': 0, 'stale': 0, 'miss': 0, 'coalesced': 0, 'refresh': 0}
+
+    def get_or_compute(self, key: str, compute, cacheable=lambda value: True,
+                       force: bool = False) -> Tuple[Any, Dict[str, Any]]:
+        """(値, キャッシュ情報) を返す"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            age = now - entry[0] if entry else None
+
+            if entry and not force and age < self.ttl:
+                return entry[1], self._info('hit', age)
+
+            if entry and not force and age < self.ttl + self.stale_ttl:
+                if key not in self._inflight:
+                    self._inflight[key] = self._Flight()
+                    self.counters['refresh'] += 1
+                    threading.Thread(target=self._run, args=(key, compute, cacheable),
+                                     name='analysis-cache-refresh', daemon=True).start()
+                return entry[1], self._info('stale', age)
+
+            flight = self._inflight.get(key)
+            owner = flight is None
+            if owner:
+                flight = self._inflight[key] = self._Flight()
+
+        if owner:
+            self._run(key, compute, cacheable)
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        with self._lock:
+            return flight.value, self._info('miss' if owner else 'coalesced', 0.0)
+
+    async def get_or_compute_async(self, key: str, compute, cacheable=lambda value: True,
+                                   force: bool = False) -> Tuple[Any, Dict[str, Any]]:
+        """get_or_compute の asyncio 版（compute はコルーチン関数）"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            age = now - entry[0] if entry else None
+
+            if entry and not force and age < self.ttl:
+                return entry[1], self._info('hit', age)
+
+            if entry and not force and age < self.ttl + self.stale_ttl:
+                if key not in self._inflight:
+                    self._inflight[key] = self._Flight()
+                    self.counters['refresh'] += 1
+                    self._start_task(key, compute, cacheable)
+                return entry[1], self._info('stale', age)
+
+            flight = self._inflight.get(key)
+            owner = flight is None
+            if owner:
+                flight = self._inflight[key] = self._Flight()
+                task = self._start_task(key, compute, cacheable)
+
+        if owner:
+            # リクエストが切断されても計算は続け、待っている他のリクエストに結果を渡す
+            await asyncio.shield(task)
+        else:
+            await flight.wait_async()
+
+        if flight.error is not None:
+            raise flight.error
+        with self._lock:
+            return flight.value, self._info('miss' if owner else 'coalesced', 0.0)
+
+    def _start_task(self, key: str, compute, cacheable) -> 'asyncio.Task':
+        task = asyncio.ensure_future(self._run_async(key, compute, cacheable))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run_async(self, key: str, compute, cacheable):
+        with self._lock:
+            flight = self._inflight[key]
+        try:
+            flight.value = await compute()
+            if cacheable(flight.value):
+                with self._lock:
+                    self._entries[key] = (time.time(), flight.value)
+        except Exception as e:
+            flight.error = e
+            logger.error("❌ キャッシュ更新エラー: %s", e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.finish()
+
+    def set(self, key: str, value: Any):
+        """外部で計算した結果を登録する"""
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+
+    def _run(self, key: str, compute, cacheable):
+        with self._lock:
+            flight = self._inflight[key]
+        try:
+            flight.value = compute()
+            if cacheable(flight.value):
+                with self._lock:
+                    self._entries[key] = (time.time(), flight.value)
+        except Exception as e:
+            flight.error = e
+            logger.error("❌ キャッシュ更新エラー: %s", e)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.finish()
+
+    def counter_snapshot(self) -> Dict[str, int]:
+        """ヒット・ミスなどの回数の一貫したコピー"""
+        with self._lock:
+            return dict(self.counters)
+
+    def _info(self, status: str, age: float) -> Dict[str, Any]:
+        """カウンターを数えてキャッシュ情報を返す（self._lock を持って呼ぶ）"""
+        self.counters[status] += 1
+        return {
+            'status': status,
+            'age_seconds': round(age, 1),
+            'ttl_seconds': self.ttl,
+            'stale_ttl_seconds': self.stale_ttl,
+            'counters': dict(self.counters)
+        }
+
+class EncodedBody:
+    """一度だけシリアライズした JSON 本体と、その gzip/brotli 圧縮版（ETag は本体のハッシュ）
+
+    本体は optimization_info を最後の項目にして、その閉じ括弧の手前までを持つ。リクエスト
+    ごとに変わる項目（キャッシュ状態・ヒット率など）は response() で optimization_info の
+    末尾に足す。圧縮版は閉じずに flush したストリームで、足す分は無圧縮ブロックとして
+    継ぎ足すので、共通部分の圧縮は最初の1回だけで済む（ETag も共通部分だけから作る）。
+    """
+
+    GZIP_LEVEL = 9
+    BROTLI_QUALITY = 11
+    # mtime を 0 に固定した gzip ヘッダー（同じ本体からは常に同じバイト列を作る）
+    GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff'
+    # 書き出した本体の形式（形式を変えたら上げて、古いスナップショットの本体を使わないようにする）
+    FORMAT = 2
+
+    def __init__(self, identity: bytes, encoded: Optional[Dict[str, bytes]] = None):
+        self.identity = identity
+        self.etag = hashlib.sha256(identity).hexdigest()[:32]
+        self._encoded = dict(encoded or {})
+        self._lock = threading.Lock()
+        self._crc = None
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, Any]) -> 'EncodedBody':
+        info = {key: value for key, value in (payload.get('optimization_info') or {}).items()
+                if key not in RESPONSE_OVERLAY_KEYS}
+        document = {key: value for key, value in payload.items() if key != 'optimization_info'}
+        document['optimization_info'] = info
+        encoded = json.dumps(document, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+        # optimization_info と全体の閉じ括弧 '}}' は response() で足す
+        return cls(encoded[:-2])
+
+    @staticmethod
+    def encodings() -> List[str]:
+        """対応する圧縮形式（優先順）"""
+        return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    def encoded(self, encoding: str) -> bytes:
+        """共通部分の本体（圧縮版は終端を書かずに flush したストリーム）"""
+        if encoding == 'identity':
+            return self.identity
+        with self._lock:
+            body = self._encoded.get(encoding)
+            if body is None:
+                if encoding == 'br':
+                    compressor = brotli.Compressor(quality=self.BROTLI_QUALITY)
+                    body = compressor.process(self.identity) + compressor.flush()
+                else:
+                    compressor = zlib.compressobj(self.GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+                    body = self.GZIP_HEADER + compressor.compress(self.identity) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                self._encoded[encoding] = body
+        return body
+
+    def _tail(self, overlay: Optional[Dict[str, Any]]) -> bytes:
+        """optimization_info に足す項目と閉じ括弧"""
+        items = json.dumps(overlay or {}, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')[1:-1]
+        separator = b',' if items and not self.identity.endswith(b'{') else b''
+        return separator + items + b'}}'
+
+    def _gzip_tail(self, tail: bytes) -> bytes:
+        """無圧縮の deflate ブロック（最大 65535 バイトずつ）と gzip のトレーラー"""
+        if self._crc is None:
+            self._crc = zlib.crc32(self.identity)
+        blocks = []
+        for start in range(0, len(tail), 65535):
+            chunk = tail[start:start + 65535]
+            final = 1 if start + 65535 >= len(tail) else 0
+            blocks.append(struct.pack('<BHH', final, len(chunk), len(chunk) ^ 0xFFFF) + chunk)
+        trailer = struct.pack('<II', zlib.crc32(tail, self._crc), (len(self.identity) + len(tail)) & 0xFFFFFFFF)
+        return b''.join(blocks) + trailer
+
+    @staticmethod
+    def _brotli_tail(tail: bytes) -> bytes:
+        """無圧縮のメタブロック（最大 65536 バイトずつ）と、空の最終メタブロック"""
+        blocks = []
+        for start in range(0, len(tail), 65536):
+            chunk = tail[start:start + 65536]
+            # ISLAST=0、MNIBBLES=4、MLEN-1（16ビット）、ISUNCOMPRESSED=1 の20ビットをバイト境界まで埋める
+            blocks.append((((len(chunk) - 1) << 3) | (1 << 19)).to_bytes(3, 'little') + chunk)
+        # ISLAST=1、ISLASTEMPTY=1
+        return b''.join(blocks) + b'\x03'
+
+    def body(self, encoding: str, overlay: Optional[Dict[str, Any]] = None) -> bytes:
+        """overlay を optimization_info に足した完全な本体"""
+        tail = self._tail(overlay)
+        if encoding == 'br':
+            return self.encoded(encoding) + self._brotli_tail(tail)
+        if encoding == 'gzip':
+            return self.encoded(encoding) + self._gzip_tail(tail)
+        return self.identity + tail
+
+    def response(self, min_compress: int = 0, overlay: Optional[Dict[str, Any]] = None) -> Response:
+        """If-None-Match と Accept-Encoding に応じたレスポンス（一致すれば 304）"""
+        if request.if_none_match.contains_weak(self.etag):
+            response = Response(status=304)
+        else:
+            encoding = 'identity'
+            if len(self.identity) >= min_compress:
+                encoding = request.accept_encodings.best_match(self.encodings() + ['identity'], default='identity')
+            response = Response(self.body(encoding, overlay), mimetype='application/json')
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        # リクエストごとの項目は ETag に含めない（共通部分が同じなら同じ表現とみなす）
+        response.set_etag(self.etag, weak=True)
+        response.headers['Vary'] = 'Accept-Encoding'
+        # ブラウザにも毎回 ETag で再検証させる
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+class PayloadCache:
+    """結果の辞書（と変種）ごとに、そこから作った値（EncodedBody や ItemIndex）を保持する小さな LRU
+
+    キャッシュ中の結果は同じ辞書オブジェクトのまま返されるので、その同一性をキーにする。
+    """
+
+    def __init__(self, maxsize: int = 32, name: str = 'encoded_body'):
+        self.maxsize = maxsize
+        self.name = name
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Tuple[int, Any], Tuple[Dict[str, Any], Any]]' = OrderedDict()
+
+    def get(self, payload: Dict[str, Any], variant: Any, build) -> Any:
+        key = (id(payload), variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            # 辞書への参照も持っているので、同じ id の別の辞書と取り違えることはない
+            if entry is not None and entry[0] is payload:
+                self._entries.move_to_end(key)
+                metrics.inc('cache_hits_total', cache=self.name)
+                return entry[1]
+
+        metrics.inc('cache_misses_total', cache=self.name)
+        body = build()
+        with self._lock:
+            self._entries[key] = (payload, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return body
+
+class ItemIndex:
+    """分析結果の商品を絞り込み・並べ替え・ページ送りするためのインデックス
+
+    結果ごとに一度だけ、カテゴリ → 位置、価格・スコアの昇順配列（二分探索で範囲を引く）、
+    タイトルの単語 → 位置の転置インデックス、並べ順ごとのキー列と順位を作る。ページ送りは
+    カーソル（前のページ末尾の並べ替えキー）から二分探索で再開する。絞り込み時は条件に
+    合う商品の順位の昇順リスト（カテゴリ・単語1つだけの条件なら並べ順ごとに一度作って
+    使い回す）を二分探索するので、どのページも全商品を先頭やカーソルから走査し直さない。
+    """
+
+    SORTS = ('-score', 'score', 'price', '-price')
+    MAX_LIMIT = 100
+    _TOKEN_RE = re.compile(r'\w+')
+
+    def __init__(self, items: List[Any]):
+        self.items = list(items)
+        self.by_category: Dict[str, List[int]] = {}
+        self.by_token: Dict[str, List[int]] = {}
+        prices, scores = [], []
+        for position, item in enumerate(self.items):
+            local_analysis = item.get('local_analysis') or {}
+            price = local_analysis.get('price_value')
+            if price is None:
+                price = to_usd(item.get('price'))
+            prices.append(price)
+            scores.append(float(item.get('popularityScore') or 0))
+            self.by_category.setdefault(local_analysis.get('primary_category', 'その他'), []).append(position)
+            for token in set(self.tokenize(item.get('title') or '')):
+                self.by_token.setdefault(token, []).append(position)
+
+        # 範囲検索用の (値, 位置) の昇順配列（価格の無い商品は価格の条件に一致しない）
+        self._price_range = self._sorted_values(prices)
+        self._score_range = self._sorted_values(scores)
+
+        # 並べ順ごとの (キー, 位置) 列。同じ値は itemId 順にしてキーを一意にする（価格の無い商品は最後）
+        ids = [str(item.get('itemId') or '') for item in self.items]
+        key_functions = {
+            '-score': lambda i: (-scores[i], ids[i]),
+            'score': lambda i: (scores[i], ids[i]),
+            'price': lambda i: (prices[i] is None, prices[i] or 0.0, ids[i]),
+            '-price': lambda i: (prices[i] is None, -(prices[i] or 0.0), ids[i]),
+        }
+        self._orders = {}
+        self._ranks: Dict[str, List[int]] = {}
+        for sort, key in key_functions.items():
+            order = sorted(range(len(self.items)), key=key)
+            self._orders[sort] = ([key(i) for i in order], order)
+            ranks = [0] * len(order)
+            for rank, position in enumerate(order):
+                ranks[position] = rank
+            self._ranks[sort] = ranks
+        # (並べ順, 'category' か 'token', 値) → 該当する商品の順位の昇順リスト、
+        # ('category' か 'token', 値) → 位置の集合（どちらも初めて使うときに作る）
+        self._ranked: Dict[Tuple[str, str, str], List[int]] = {}
+        self._position_sets: Dict[Tuple[str, str], frozenset] = {}
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls._TOKEN_RE.findall(text.lower())
+
+    @staticmethod
+    def _sorted_values(values: List[Optional[float]]) -> Tuple[List[float], List[int]]:
+        pairs = sorted((value, position) for position, value in enumerate(values) if value is not None)
+        return [value for value, _ in pairs], [position for _, position in pairs]
+
+    @staticmethod
+    def _in_range(sorted_range: Tuple[List[float], List[int]], low: Optional[float], high: Optional[float],
+                  include_low: bool = True) -> set:
+        """low 以上（include_low が False なら超）high 以下の位置"""
+        values, positions = sorted_range
+        start = 0 if low is None else (bisect_left if include_low else bisect_right)(values, low)
+        end = len(values) if high is None else bisect_right(values, high)
+        return set(positions[start:end])
+
+    def _position_set(self, kind: str, value: str) -> frozenset:
+        """カテゴリ・単語1つに該当する商品の位置の集合"""
+        positions = (self.by_category if kind == 'category' else self.by_token).get(value)
+        if positions is None:
+            return frozenset()
+        key = (kind, value)
+        position_set = self._position_sets.get(key)
+        if position_set is None:
+            position_set = self._position_sets[key] = frozenset(positions)
+        return position_set
+
+    def _ranked_positions(self, sort: str, kind: str, value: str) -> List[int]:
+        """カテゴリ・単語1つに該当する商品の、sort での順位の昇順リスト"""
+        positions = (self.by_category if kind == 'category' else self.by_token).get(value)
+        if positions is None:
+            # 索引に無い値は作り置きしない（任意の入力で増え続けないように）
+            return []
+        key = (sort, kind, value)
+        ranked = self._ranked.get(key)
+        if ranked is None:
+            ranks = self._ranks[sort]
+            ranked = self._ranked[key] = sorted(ranks[position] for position in positions)
+        return ranked
+
+    @staticmethod
+    def encode_cursor(sort: str, key: Tuple[Any, ...]) -> str:
+        return base64.urlsafe_b64encode(json.dumps([sort, list(key)]).encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor: str, sort: str) -> Tuple[Any, ...]:
+        try:
+            cursor_sort, key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (ValueError, TypeError):
+            raise ValueError('cursor が不正です')
+        if cursor_sort != sort:
+            raise ValueError('cursor と sort の並べ順が一致しません')
+        return tuple(key)
+
+    def query(self, category: Optional[str] = None, price_range: Optional[str] = None,
+              min_price: Optional[float] = None, max_price: Optional[float] = None,
+              min_score: Optional[float] = None, max_score: Optional[float] = None,
+              q: Optional[str] = None, sort: str = '-score', limit: int = 20,
+              cursor: Optional[str] = None) -> Dict[str, Any]:
+        """条件に合う商品の1ページ分（items, total, next_cursor）"""
+        if sort not in self._orders:
+            raise ValueError(f"sort は {', '.join(self.SORTS)} のいずれかです")
+        limit = max(1, min(self.MAX_LIMIT, limit))
+
+        # 条件ごとに (一致する位置の集合を作る関数, カテゴリ・単語なら (種類, 値))
+        filters = []
+        if category:
+            filters.append((lambda: self._position_set('category', category), ('category', category)))
+        if price_range:
+            bounds = MarketStatsAccumulator.price_bounds(price_range)
+            if bounds is None:
+                raise ValueError(f"price_range が不正です: {price_range}")
+            # 価格帯は市場統計と同じく下限を含まず上限を含む
+            filters.append((lambda: self._in_range(self._price_range, bounds[0], bounds[1], include_low=False),
+                            None))
+        if min_price is not None or max_price is not None:
+            filters.append((lambda: self._in_range(self._price_range, min_price, max_price), None))
+        if min_score is not None or max_score is not None:
+            filters.append((lambda: self._in_range(self._score_range, min_score, max_score), None))
+        for token in dict.fromkeys(self.tokenize(q or '')):
+            filters.append((lambda token=token: self._position_set('token', token), ('token', token)))
+
+        keys, order = self._orders[sort]
+        start = 0
+        if cursor:
+            try:
+                start = bisect_right(keys, self.decode_cursor(cursor, sort))
+            except TypeError:
+                raise ValueError('cursor が不正です')
+
+        if not filters:
+            page = list(range(start, min(len(order), start + limit + 1)))
+            total = len(self.items)
+        elif len(filters) == 1 and filters[0][1] is not None:
+            # カテゴリか単語1つだけなら、作り置きの順位リストをそのまま使う
+            ranked = self._ranked_positions(sort, *filters[0][1])
+            first = bisect_left(ranked, start)
+            page = ranked[first:first + limit + 1]
+            total = len(ranked)
+        else:
+            matched = None
+            for positions in sorted((build() for build, _ in filters), key=len):
+                matched = positions if matched is None else matched & positions
+                if not matched:
+                    break
+            total = len(matched)
+            keyed = [self._ranked_positions(sort, *key) for _, key in filters if key is not None]
+            if not matched:
+                page = []
+            elif keyed:
+                # 一番短いカテゴリ・単語の順位リストをカーソルから進め、他の条件は集合で確かめる
+                ranked = min(keyed, key=len)
+                page = []
+                for rank in islice(ranked, bisect_left(ranked, start), None):
+                    if order[rank] in matched:
+                        page.append(rank)
+                        if len(page) > limit:
+                            break
+            else:
+                # 範囲の条件だけなら、一致した商品の順位を並べる
+                ranks = self._ranks[sort]
+                ranked = sorted(ranks[position] for position in matched)
+                first = bisect_left(ranked, start)
+                page = ranked[first:first + limit + 1]
+
+        has_more = len(page) > limit
+        page = page[:limit]
+        return {
+            'items': [self.items[order[index]] for index in page],
+            'total': total,
+            'next_cursor': self.encode_cursor(sort, keys[page[-1]]) if has_more else None
+        }
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class AnalysisSnapshot:
+    """ワーカー間で共有する分析結果のスナップショット（JSON ファイルを原子的に置き換える）
+
+    読み出しは mtime が変わったときだけファイルを読み直し、それ以外はメモリ上のコピーを返す。
+    既定の表示（項目指定なし）のレスポンス本体と圧縮版も「パス.body.ETag」などに書き出し、
+    全ワーカーが同じバイト列と ETag を返せるようにする。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime_ns = None
+        self._generated_at = None
+        self._payload = None
+        self._body = None
+
+    def _body_path(self, etag: str, encoding: str) -> str:
+        return f"{self.path}.body.{etag}" + ('' if encoding == 'identity' else f".{encoding}")
+
+    def publish(self, payload: Dict[str, Any]):
+        """分析結果を書き出す（商品は全件を JSON 用の辞書にする）"""
+        # 本体を先に置き、読み手が新しいスナップショットを見たときには揃っているようにする
+        body = EncodedBody.from_payload(render_payload(payload))
+        for encoding in ['identity'] + EncodedBody.encodings():
+            _write_atomic(self._body_path(body.etag, encoding), body.encoded(encoding))
+
+        document = {'generated_at': time.time(), 'etag': body.etag, 'body_format': EncodedBody.FORMAT,
+                    'payload': render_payload(payload, limit=None)}
+        _write_atomic(self.path, json.dumps(document, ensure_ascii=False, default=str).encode('utf-8'))
+
+        # 前回までの本体を消す（読み込み中のワーカーは自前でエンコードし直す）
+        directory, prefix = os.path.split(f"{self.path}.body.")
+        for name in os.listdir(directory or '.'):
+            if name.startswith(prefix) and not name.startswith(prefix + body.etag) and not name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def _load_body(self, etag: Optional[str]) -> Optional[EncodedBody]:
+        """書き出し済みの本体（次の publish で消されていたら None）"""
+        if not etag:
+            return None
+        try:
+            encoded = {}
+            for encoding in ['identity'] + EncodedBody.encodings():
+                with open(self._body_path(etag, encoding), 'rb') as f:
+                    encoded[encoding] = f.read()
+        except OSError:
+            return None
+        return EncodedBody(encoded.pop('identity'), encoded)
+
+    def body_for(self, payload: Dict[str, Any]) -> Optional[EncodedBody]:
+        """read() が返した payload に対応する書き出し済みの本体（無ければ None）"""
+        with self._lock:
+            return self._body if payload is self._payload else None
+
+    def read(self) -> Tuple[Optional[Dict[str, Any]], Optional[float]]:
+        """(分析結果, 経過秒数) を返す（まだ無ければ (None, None)）"""
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None, None
+
+        with self._lock:
+            if mtime_ns != self._mtime_ns:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        document = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning("⚠️ スナップショット読み込みエラー: %s", e)
+                    return None, None
+                self._mtime_ns = mtime_ns
+                self._generated_at = document['generated_at']
+                self._payload = document['payload']
+                self._body = (self._load_body(document.get('etag'))
+                              if document.get('body_format') == EncodedBody.FORMAT else None)
+            return self._payload, time.time() - self._generated_at
+
+class RefreshScheduler:
+    """分析結果を定期的に計算して共有スナップショットに書き出すバックグラウンドワーカー
+
+    ファイルロックを取れたワーカー（リーダー）だけが計算する。取れなかったワーカーは
+    間隔ごとに取り直しを試み、リーダーのプロセスが終わればロックが外れて引き継ぐ。
+    間隔にはゆらぎを入れ、失敗が続いたら指数バックオフする。スレッドが予期せず終わったら
+    ロックを手放し、次の start() で起動し直せるようにする。
+    """
+
+    def __init__(self, compute, snapshot: AnalysisSnapshot, interval: float, jitter: float = 0.1,
+                 backoff_base: float = 30, backoff_max: float = 1800):
+        self.compute = compute
+        self.snapshot = snapshot
+        self.interval = interval
+        self.jitter = jitter
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock_path = f"{snapshot.path}.lock"
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """状態を初期化（fork 後の子プロセスではスレッドもロックも引き継がない）"""
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._lock_file = None
+        self.state = {'leader': False, 'runs': 0, 'failures': 0, 'last_success': None,
+                      'last_error': None, 'next_run_in': None}
+
+    def start(self):
+        """スケジューラのスレッドを（プロセスごとに1回だけ）起動する"""
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='analysis-refresh', daemon=True)
+                self._thread.start()
+
+    def _jittered(self, seconds: float) -> float:
+        return max(0.0, seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def _try_lead(self) -> bool:
+        """リーダー用のロックを取る（取れたらプロセスが終わるまで持ち続ける）"""
+        if fcntl is None:
+            self.state['leader'] = True
+            return True
+        try:
+            lock_file = open(self.lock_path, 'a')
+        except OSError as e:
+            logger.warning("⚠️ 定期更新のロックファイルを開けません: %s", e)
+            return False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.state['leader'] = True
+        logger.info("👑 定期更新のリーダーになりました (pid %s)", os.getpid())
+        return True
+
+    def _resign(self):
+        """リーダー用のロックを手放す（他のワーカーが引き継げるように）"""
+        lock_file, self._lock_file = self._lock_file, None
+        if lock_file is not None:
+            lock_file.close()
+        self.state['leader'] = False
+
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            logger.exception("❌ 定期更新のスレッドが停止しました: %s", e)
+        finally:
+            # ロックを持ったまま止まると誰も更新しなくなるので手放し、start() で起動し直せるようにする
+            self._resign()
+            with self._start_lock:
+                self._thread = None
+
+    def _loop(self):
+        failures = 0
+        while True:
+            if not self.state['leader'] and not self._try_lead():
+                time.sleep(self._jittered(self.interval))
+                continue
+
+            # 直前のリーダーが書いたスナップショットがまだ新しければ、その分だけ待つ
+            _, age = self.snapshot.read()
+            if failures == 0 and age is not None and age < self.interval:
+                delay = self._jittered(self.interval - age)
+            else:
+                try:
+                    payload = self.compute()
+                    error = None if payload.get('success') else payload.get('error', '分析に失敗しました')
+                    if error is None:
+                        self.snapshot.publish(payload)
+                except Exception as e:
+                    # 書き出しの失敗（ディスクフルなど）も計算の失敗と同じく数えてバックオフする
+                    error = str(e)
+
+                self.state['runs'] += 1
+                if error is None:
+                    failures = 0
+                    self.state.update(last_success=time.time(), last_error=None)
+                    delay = self._jittered(self.interval)
+                else:
+                    failures += 1
+                    self.state['last_error'] = error
+                    delay = self._jittered(min(self.backoff_max, self.backoff_base * (2 ** (failures - 1))))
+                    logger.warning("⚠️ 定期更新に失敗しました（%s回連続、%.0f秒後に再試行）: %s", failures, delay, error)
+                self.state['failures'] = failures
+
+            self.state['next_run_in'] = round(delay, 1)
+            time.sleep(delay)
+
+class LRUTTLCache:
+    """LRU と TTL で追い出すスレッドセーフなキャッシュ（任意で SQLite に永続化）
+
+    値は JSON にできるものに限る。path を渡すと再起動後もディスクから読み戻す。
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 3600, path: Optional[str] = None,
+                 table: str = 'cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            with self._connect() as conn:
+                conn.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                             '(key TEXT PRIMARY KEY, stored_at REAL NOT NULL, value TEXT NOT NULL)')
+
+    def _connect(self) -> sqlite3.Connection:
+        # 接続は操作ごとに開く（スレッド・fork をまたいで共有しない）
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key: str) -> Any:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+        value = self._load(key, now)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        with self._lock:
+            self._store_memory(key, now, value)
+        if self.path:
+            try:
+                with self._connect() as conn:
+                    conn.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+                                 (key, now, json.dumps(value, ensure_ascii=False)))
+                    conn.execute(f'DELETE FROM {self.table} WHERE stored_at < ?', (now - self.ttl,))
+            except sqlite3.Error as e:
+                logger.warning("⚠️ キャッシュ書き込みエラー: %s", e)
+
+    def _store_memory(self, key: str, stored_at: float, value: Any):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: str, now: float) -> Any:
+        if not self.path:
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(f'SELECT stored_at, value FROM {self.table} WHERE key = ?',
+                                   (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("⚠️ キャッシュ読み込みエラー: %s", e)
+            return None
+        if not row or now - row[0] >= self.ttl:
+            return None
+        value = json.loads(row[1])
+        with self._lock:
+            self._store_memory(key, row[0], value)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize, 'ttl_seconds': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'persistent': bool(self.path)}
+
+class ItemRecord:
+    """パイプライン内で持ち回る商品の軽量表現（スコア計算・市場統計・画面表示に使う項目だけ）
+
+    取り込み時に Browse API の辞書から1回だけ作り、元の辞書は残さない。辞書と同じ
+    get / [] で読めるので、スコア計算や統計は生の辞書と同じコードで扱える。
+    ?fields=raw の元の応答は、返す商品の分だけ商品詳細（getItems）から取り直す。
+    """
+
+    FIELDS = ('itemId', 'title', 'shortDescription', 'price', 'image', 'itemWebUrl', 'watchCount', 'bidCount',
+              'quantitySold', 'shippingOptions', 'marketplaceId', 'local_analysis', 'popularityScore')
+    _FIELD_SET = frozenset(FIELDS)
+    __slots__ = FIELDS + ('payload_hash',)
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def from_summary(cls, summary: Dict[str, Any], marketplace: Optional[str] = None,
+                     payload_hash: Optional[str] = None) -> 'ItemRecord':
+        """検索結果1件から作る（送料は無料判定に使う金額だけを残す）"""
+        image = summary.get('image')
+        shipping_options = [{'shippingCost': {'value': option.get('shippingCost', {}).get('value', '0')}}
+                            for option in summary.get('shippingOptions', [])]
+        return cls(
+            itemId=summary.get('itemId'),
+            title=summary.get('title'),
+            shortDescription=summary.get('shortDescription'),
+            price=summary.get('price'),
+            image={'imageUrl': image['imageUrl']} if image and image.get('imageUrl') else None,
+            itemWebUrl=summary.get('itemWebUrl'),
+            watchCount=summary.get('watchCount'),
+            bidCount=summary.get('bidCount'),
+            quantitySold=summary.get('quantitySold'),
+            shippingOptions=shipping_options or None,
+            marketplaceId=marketplace or summary.get('marketplaceId'),
+            payload_hash=payload_hash
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key) if key in self._FIELD_SET else None
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in self._FIELD_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON 用の辞書（値の無い項目は省く）"""
+        return {name: getattr(self, name) for name in self.FIELDS if getattr(self, name) is not None}
+
+def serialize_items(items: List[Any], fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """商品を JSON 用の辞書にする（fields 指定時はその項目と itemId だけ）
+
+    fields に 'raw' を含めると、渡された商品の分だけ商品詳細（詳細キャッシュか getItems）を
+    取得して raw に付ける。
+    """
+    raw_details = {}
+    if fields and 'raw' in fields and items:
+        raw_details = get_ebay_analyzer().get_item_details([item.get('itemId') for item in items if item.get('itemId')])
+    result = []
+    for item in items:
+        data = item.to_dict() if isinstance(item, ItemRecord) else item
+        if fields:
+            data = {key: data[key] for key in ('itemId', *fields) if key in data}
+            if data.get('itemId') in raw_details:
+                data['raw'] = raw_details[data['itemId']]
+        result.append(data)
+    return result
+
+class ItemStore:
+    """itemId をキーに分析済み商品を保存する SQLite ストア
+
+    商品の内容（ローカル分析・スコアを除いた JSON）のハッシュを持ち、変化した
+    商品だけを書き換える。未変化の商品は last_seen だけ更新する。
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS items (
+            item_id TEXT PRIMARY KEY,
+            title TEXT,
+            primary_category TEXT,
+            price REAL,
+            popularity_score REAL,
+            confidence REAL,
+            analysis_key TEXT NOT NULL,
+            payload_hash TEXT NOT NULL,
+            item_json TEXT NOT NULL,
+            first_seen REAL NOT NULL,
+            last_seen REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_items_category ON items (primary_category, popularity_score DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_items_price ON items (price)',
+        'CREATE INDEX IF NOT EXISTS idx_items_score ON items (popularity_score DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_items_last_seen ON items (last_seen)',
+    ]
+
+    # 1回の IN 句に渡す ID 数（SQLite の変数上限より十分小さく）
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self) -> sqlite3.Connection:
+        # 接続は操作ごとに開く（スレッド・gunicorn ワーカー間で共有しない）
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def payload_hash(item: Dict[Any, Any]) -> str:
+        """ローカル分析とスコアを除いた出品内容のハッシュ"""
+        if isinstance(item, ItemRecord):
+            if item.payload_hash:
+                return item.payload_hash
+            item = item.to_dict()
+        listing = {k: v for k, v in item.items() if k not in ('local_analysis', 'popularityScore')}
+        encoded = json.dumps(listing, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+    def _lookup(self, conn: sqlite3.Connection, columns: str, item_ids: List[str]) -> Dict[str, tuple]:
+        rows = {}
+        for start in range(0, len(item_ids), self.LOOKUP_CHUNK):
+            chunk = item_ids[start:start + self.LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            for row in conn.execute(f'SELECT item_id, {columns} FROM items WHERE item_id IN ({placeholders})', chunk):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def get_analyses(self, item_ids: List[str]) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+        """保存済みの (分析キー, local_analysis) を返す"""
+        with self._connect() as conn:
+            rows = self._lookup(conn, 'analysis_key, item_json', item_ids)
+        return {item_id: (key, json.loads(item_json).get('local_analysis', {}))
+                for item_id, (key, item_json) in rows.items()}
+
+    def upsert_items(self, items: List[Dict[Any, Any]]) -> Dict[str, int]:
+        """商品を保存し、新規・更新・未変化の件数を返す"""
+        now = time.time()
+        items = [item for item in items if item.get('itemId')]
+        if not items:
+            return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+
+        with self._connect() as conn:
+            existing = self._lookup(conn, 'payload_hash, popularity_score, analysis_key',
+                                    [item['itemId'] for item in items])
+            inserts, updates, touched = [], [], []
+
+            for item in items:
+                local_analysis = item.get('local_analysis', {})
+                payload_hash = self.payload_hash(item)
+                score = item.get('popularityScore')
+                analysis_key = local_analysis.get('analysis_key', '')
+                previous = existing.get(item['itemId'])
+
+                if previous == (payload_hash, score, analysis_key):
+                    touched.append((now, item['itemId']))
+                    continue
+
+                row = (item.get('title'), local_analysis.get('primary_category'), local_analysis.get('price_value'),
+                       score, local_analysis.get('confidence'), analysis_key, payload_hash,
+                       json.dumps(item.to_dict() if isinstance(item, ItemRecord) else item,
+                                  ensure_ascii=False, default=str), now, now)
+                if previous is None:
+                    inserts.append((item['itemId'],) + row[:-1] + (now, now))
+                else:
+                    updates.append(row[:-2] + (now, now, item['itemId']))
+
+            conn.executemany('INSERT INTO items (item_id, title, primary_category, price, popularity_score, confidence, '
+                             'analysis_key, payload_hash, item_json, first_seen, last_seen, updated_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', inserts)
+            conn.executemany('UPDATE items SET title = ?, primary_category = ?, price = ?, popularity_score = ?, '
+                             'confidence = ?, analysis_key = ?, payload_hash = ?, item_json = ?, last_seen = ?, '
+                             'updated_at = ? WHERE item_id = ?', updates)
+            conn.executemany('UPDATE items SET last_seen = ? WHERE item_id = ?', touched)
+
+        return {'inserted': len(inserts), 'updated': len(updates), 'unchanged': len(touched)}
+
+    def _filters(self, category: Optional[str], min_price: Optional[float], max_price: Optional[float],
+                 max_age: Optional[float]) -> Tuple[str, list]:
+        clauses, params = [], []
+        if category:
+            clauses.append('primary_category = ?')
+            params.append(category)
+        if min_price is not None:
+            clauses.append('price >= ?')
+            params.append(min_price)
+        if max_price is not None:
+            clauses.append('price <= ?')
+            params.append(max_price)
+        if max_age is not None:
+            clauses.append('last_seen >= ?')
+            params.append(time.time() - max_age)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def top_items(self, limit: int = 100, category: Optional[str] = None, min_price: Optional[float] = None,
+                  max_price: Optional[float] = None, max_age: Optional[float] = None) -> List[Dict[Any, Any]]:
+        """人気度スコアの上位商品（インデックスを使った絞り込み）"""
+        where, params = self._filters(category, min_price, max_price, max_age)
+        with self._connect() as conn:
+            rows = conn.execute(f'SELECT item_json FROM items{where} ORDER BY popularity_score DESC LIMIT ?',
+                                params + [limit]).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def market_stats(self, category: Optional[str] = None, min_price: Optional[float] = None,
+                     max_price: Optional[float] = None, max_age: Optional[float] = None) -> 'MarketStatsAccumulator':
+        """条件に合う商品の市場統計（価格とカテゴリの列だけを読む）"""
+        where, params = self._filters(category, min_price, max_price, max_age)
+        accumulator = MarketStatsAccumulator()
+        with self._connect() as conn:
+            for price, primary_category in conn.execute(f'SELECT price, primary_category FROM items{where}', params):
+                accumulator.add({'local_analysis': {'primary_category': primary_category or 'その他',
+                                                    'price_value': price}})
+        return accumulator
+
+    def count(self) -> int:
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def iter_items(self, batch_size: int = 1000) -> Iterator[Dict[Any, Any]]:
+        """保存済みの全商品を item_id 順に返す（batch_size 件ずつ読み、読み込み中は接続を保持しない）"""
+        last_item_id = ''
+        while True:
+            with self._connect() as conn:
+                rows = conn.execute('SELECT item_id, item_json FROM items WHERE item_id > ? ORDER BY item_id LIMIT ?',
+                                    (last_item_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for _, item_json in rows:
+                yield json.loads(item_json)
+            last_item_id = rows[-1][0]
+
+class TimeSeriesRecorder:
+    """分析結果から作る追記型の時系列ストア
+
+    各点は (時刻, 系列ID, 値4つ) の固定長レコードとして points.bin に追記し、
+    系列名とIDの対応は series.tsv に追記する。複数ワーカーが追記しても、
+    読み出し前にファイル末尾の差分だけを取り込む。メモリに列（array）で持つのは
+    件数の少ないカテゴリの系列だけで、商品の系列はレコードの位置だけを持ち、
+    問い合わせのたびにファイルから読む。生データ保持期間を過ぎた点は rollup_seconds
+    単位の平均に集約し、保持期間を過ぎた点は捨てる。集約はファイルロックの中で
+    最終集約時刻（compacted_at）を確かめ、全ワーカーで間隔ごとに1回だけ行う。
+    """
+
+    RECORD = struct.Struct('<dIdddd')
+    READ_CHUNK_RECORDS = 65536
+    CATEGORY_FIELDS = ('count', 'share', 'avg_price', 'avg_score')
+    ITEM_FIELDS = ('price', 'watch_count', 'bid_count', 'popularity_score')
+
+    def __init__(self, directory: str, raw_retention_days: float = 7, retention_days: float = 365,
+                 rollup_seconds: float = 86400):
+        self.directory = directory
+        self.raw_retention = raw_retention_days * 86400
+        self.retention = retention_days * 86400
+        self.rollup_seconds = rollup_seconds
+        self.points_path = os.path.join(directory, 'points.bin')
+        self.series_path = os.path.join(directory, 'series.tsv')
+        self.lock_path = os.path.join(directory, 'timeseries.lock')
+        self.compaction_path = os.path.join(directory, 'compacted_at')
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._series_ids: Dict[str, int] = {}
+        self._category_ids: set = set()
+        self._series_offset = 0
+        self._columns: Dict[int, List[array]] = {}  # カテゴリの系列ID -> [時刻, 値1..4]
+        self._offsets: Dict[int, array] = {}  # 商品の系列ID -> points.bin 内のレコードの位置
+        self._points_file = None
+        self._points_offset = 0
+        self._points_inode = None
+        self._last_compaction: Optional[float] = None  # 全ワーカーでの最終集約時刻（初回はファイルから読む）
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reopen)
+
+    def _reopen(self):
+        """次の _sync で points.bin を開き直して読み直す（fork 後の子プロセスでは親とファイル位置を共有しない）"""
+        if self._points_file is not None:
+            self._points_file.close()
+        self._points_file = None
+        self._points_inode = None
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sync(self):
+        """他プロセスが追記した系列と点を取り込む（ファイルが置き換わっていれば読み直す）"""
+        if os.path.exists(self.series_path):
+            with open(self.series_path, 'r', encoding='utf-8') as f:
+                f.seek(self._series_offset)
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    series_id, name = line.rstrip('\n').split('\t', 1)
+                    self._series_ids[name] = int(series_id)
+                    if name.startswith('category:'):
+                        self._category_ids.add(int(series_id))
+                    self._series_offset += len(line.encode('utf-8'))
+
+        try:
+            stat = os.stat(self.points_path)
+        except FileNotFoundError:
+            return
+        if self._points_file is None or stat.st_ino != self._points_inode or stat.st_size < self._points_offset:
+            # 集約で置き換わったら開き直して最初から読む（開いたままのファイルは置き換え後も読める）
+            self._reopen()
+            self._points_file = open(self.points_path, 'rb')
+            self._points_inode = os.fstat(self._points_file.fileno()).st_ino
+            self._columns, self._offsets, self._points_offset = {}, {}, 0
+
+        size = self.RECORD.size
+        end = os.fstat(self._points_file.fileno()).st_size // size * size
+        for offset, (timestamp, series_id, *values) in self._iter_records(self._points_offset, end):
+            if series_id in self._category_ids:
+                self._append_point(series_id, timestamp, values)
+            else:
+                offsets = self._offsets.get(series_id)
+                if offsets is None:
+                    offsets = self._offsets[series_id] = array('q')
+                offsets.append(offset)
+        self._points_offset = max(self._points_offset, end)
+
+    def _iter_records(self, start: int, end: int) -> Iterator[Tuple[int, Tuple[Any, ...]]]:
+        """points.bin の [start, end) のレコードを (位置, レコード) で返す（一定件数ずつ読む）"""
+        size = self.RECORD.size
+        chunk = self.READ_CHUNK_RECORDS * size
+        for chunk_start in range(start, end, chunk):
+            self._points_file.seek(chunk_start)
+            data = self._points_file.read(min(chunk, end - chunk_start))
+            data = data[:len(data) // size * size]
+            for i, record in enumerate(self.RECORD.iter_unpack(data)):
+                yield chunk_start + i * size, record
+
+    def _read_series(self, series_id: int) -> Iterator[Tuple[float, List[float]]]:
+        """商品の系列の点を points.bin から読む"""
+        size = self.RECORD.size
+        for offset in self._offsets.get(series_id, ()):
+            self._points_file.seek(offset)
+            timestamp, _, *values = self.RECORD.unpack(self._points_file.read(size))
+            yield timestamp, values
+
+    def _append_point(self, series_id: int, timestamp: float, values):
+        columns = self._columns.get(series_id)
+        if columns is None:
+            columns = self._columns[series_id] = [array('d') for _ in range(5)]
+        columns[0].append(timestamp)
+        for column, value in zip(columns[1:], values):
+            column.append(value)
+
+    def _series_id(self, name: str, new_series: List[str]) -> int:
+        series_id = self._series_ids.get(name)
+        if series_id is None:
+            series_id = self._series_ids[name] = len(self._series_ids)
+            if name.startswith('category:'):
+                self._category_ids.add(series_id)
+            new_series.append(f"{series_id}\t{name}\n")
+        return series_id
+
+    def record_run(self, items: List[Dict[Any, Any]], stats: Dict[str, Any], timestamp: Optional[float] = None):
+        """1回の分析結果（商品と市場統計）を記録する"""
+        timestamp = time.time() if timestamp is None else timestamp
+        total = stats.get('total_items') or 0
+        nan = float('nan')
+
+        # カテゴリごとの件数・平均価格・平均スコアは表示対象の商品から1回の走査で集計する
+        sums: Dict[str, List[float]] = {}
+        for item in items:
+            local_analysis = item.get('local_analysis', {})
+            entry = sums.setdefault(local_analysis.get('primary_category', 'その他'), [0.0, 0, 0.0, 0])
+            if local_analysis.get('price_value'):
+                entry[0] += local_analysis['price_value']
+                entry[1] += 1
+            entry[2] += item.get('popularityScore', 0.0)
+            entry[3] += 1
+
+        rows = []
+        for category, count in stats.get('categories', {}).items():
+            price_sum, priced, score_sum, listed = sums.get(category, (0.0, 0, 0.0, 0))
+            rows.append((f"category:{category}", (float(count), count / total if total else nan,
+                                                   price_sum / priced if priced else nan,
+                                                   score_sum / listed if listed else nan)))
+        for item in items:
+            if not item.get('itemId'):
+                continue
+            price = item.get('local_analysis', {}).get('price_value')
+            rows.append((f"item:{item['itemId']}", (nan if price is None else float(price),
+                                                     float(item.get('watchCount', 0)), float(item.get('bidCount', 0)),
+                                                     float(item.get('popularityScore', nan)))))
+
+        with self._lock, self._file_lock():
+            self._sync()
+            new_series = []
+            records = bytearray()
+            for name, values in rows:
+                records += self.RECORD.pack(timestamp, self._series_id(name, new_series), *values)
+            if new_series:
+                with open(self.series_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(new_series))
+            with open(self.points_path, 'ab') as f:
+                f.write(records)
+            self._sync()
+
+            # 他のワーカーが集約したばかりなら集約しない（最終集約時刻はファイルで共有する）
+            if self._last_compaction is None or timestamp - self._last_compaction > self.rollup_seconds:
+                self._last_compaction = self._read_compaction_time()
+                if timestamp - self._last_compaction > self.rollup_seconds:
+                    self._compact_locked(timestamp)
+
+    def _read_compaction_time(self) -> float:
+        try:
+            with open(self.compaction_path, 'r', encoding='utf-8') as f:
+                return float(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0.0
+
+    def compact(self, now: Optional[float] = None):
+        """保持期間外の点を捨て、生データ保持期間を過ぎた点を集約して書き直す"""
+        with self._lock, self._file_lock():
+            self._compact_locked(time.time() if now is None else now)
+
+    def _compact_locked(self, now: float):
+        """compact の本体（_lock とファイルロックを持って呼ぶ）
+
+        全系列をメモリに載せず、ファイルを2回読む（1回目で集約、2回目で生データを写す）。
+        集約した点を先に、生データをファイル順に後ろへ置くので、系列ごとの時刻順は保たれる。
+        """
+        # 集約の境目を間隔に揃え、同じ区間を2回集約しないようにする
+        raw_cutoff = math.floor((now - self.raw_retention) / self.rollup_seconds) * self.rollup_seconds
+        retention_cutoff = now - self.retention
+        keep_from = max(raw_cutoff, retention_cutoff)
+        nan = float('nan')
+
+        self._sync()
+        end = self._points_offset
+        # (系列ID, 区間) -> [値1..4 の合計, 値1..4 の件数]（NaN は数えない）
+        rollups: Dict[Tuple[int, float], List[float]] = {}
+        if self._points_file is not None:
+            for _, (timestamp, series_id, *values) in self._iter_records(0, end):
+                if not retention_cutoff <= timestamp < raw_cutoff:
+                    continue
+                key = (series_id, math.floor(timestamp / self.rollup_seconds) * self.rollup_seconds)
+                entry = rollups.get(key)
+                if entry is None:
+                    entry = rollups[key] = [0.0] * 8
+                for c, value in enumerate(values):
+                    if not math.isnan(value):
+                        entry[c] += value
+                        entry[c + 4] += 1
+
+        tmp_path = f"{self.points_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(self.RECORD.pack(bucket, series_id, *(entry[c] / entry[c + 4] if entry[c + 4] else nan
+                                                                   for c in range(4)))
+                             for (series_id, bucket), entry in sorted(rollups.items())))
+            if self._points_file is not None:
+                for _, (timestamp, series_id, *values) in self._iter_records(0, end):
+                    if timestamp >= keep_from:
+                        f.write(self.RECORD.pack(timestamp, series_id, *values))
+        # 開いたままだと置き換えられない環境（Windows）があるので先に閉じる
+        self._reopen()
+        os.replace(tmp_path, self.points_path)
+        _write_atomic(self.compaction_path, repr(now).encode('utf-8'))
+        self._last_compaction = now
+
+        # 置き換えたファイルを読み直す
+        self._sync()
+
+    @staticmethod
+    def _nanmean_rows(rows: List[List[float]]) -> List[float]:
+        means = []
+        for values in zip(*rows):
+            present = [v for v in values if not math.isnan(v)]
+            means.append(sum(present) / len(present) if present else float('nan'))
+        return means
+
+    def query(self, name: str, fields, since: float, until: float, step: Optional[float] = None) -> List[Dict[str, Any]]:
+        """系列 name の [since, until] の点を返す（step 秒ごとに平均して間引く）"""
+        with self._lock:
+            self._sync()
+            series_id = self._series_ids.get(name)
+            if series_id is None:
+                return []
+            if series_id in self._category_ids:
+                columns = self._columns.get(series_id)
+                if columns is None:
+                    return []
+                timestamps = columns[0]
+                start, end = bisect_left(timestamps, since), bisect_right(timestamps, until)
+                rows = [(timestamps[i], [columns[c][i] for c in range(1, 5)]) for i in range(start, end)]
+            else:
+                rows = [(timestamp, values) for timestamp, values in self._read_series(series_id)
+                        if since <= timestamp <= until]
+
+        if step:
+            buckets: Dict[float, List[List[float]]] = {}
+            for timestamp, values in rows:
+                buckets.setdefault(math.floor(timestamp / step) * step, []).append(values)
+            rows = [(bucket, self._nanmean_rows(buckets[bucket])) for bucket in sorted(buckets)]
+
+        return [dict({'timestamp': timestamp},
+                     **{field: (None if math.isnan(value) else round(value, 4)) for field, value in zip(fields, values)})
+                for timestamp, values in rows]
+
+    def category_trends(self, since: float, until: float, step: Optional[float] = None) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            self._sync()
+            names = [name for name in self._series_ids if name.startswith('category:')]
+        return {name[len('category:'):]: self.query(name, self.CATEGORY_FIELDS, since, until, step) for name in names}
+
+    def item_trend(self, item_id: str, since: float, until: float, step: Optional[float] = None) -> List[Dict[str, Any]]:
+        return self.query(f"item:{item_id}", self.ITEM_FIELDS, since, until, step)
+
+class LocalItemAnalyzer:
+    """eBay にも Gemini にも問い合わせないローカル分析（キーワード分類と人気度スコア）
+
+    状態はコンパイル済みのキーワードマッチャー、学習済み分類器（任意）と辞書の版だけなので、
+    プロセスプールのワーカーにも一度送れば使い回せる。SmarteBayAnalyzer はこれを継承する。
+    """
+
+    def __init__(self, keyword_matcher: Optional[KeywordMatcher] = None, keyword_version: str = '',
+                 classifier: Optional[HashedNgramClassifier] = None):
+        self.keyword_matcher = keyword_matcher
+        self.keyword_version = keyword_version
+        self.classifier = classifier
+
+    def analysis_key(self, item: Dict[Any, Any]) -> str:
+        """ローカル分析の入力（タイトル・説明・価格と通貨、キーワード辞書の版）のハッシュ"""
+        price_info = item.get('price') or {}
+        encoded = '\x1f'.join([self.keyword_version, str(item.get('title', '')),
+                                str(item.get('shortDescription', '')), str(price_info.get('value', '')),
+                                str(price_info.get('currency', ''))])
+        return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+    def enhance_item_with_local_analysis(self, item: Dict[Any, Any]) -> Dict[Any, Any]:
+        """ローカル分析で商品情報を強化（Gemini APIを使わない）"""
+        title = str(item.get('title', '')).lower()
+        description = str(item.get('shortDescription', '')).lower()
+        combined_text = f"{title} {description}"
+
+        # キーワードベースの分類（コンパイル済みマッチャーで1回だけ走査）
+        matches, keyword_score = self.keyword_matcher.match(combined_text)
+        categories_found = [
+            {'category': category, 'matches': len(keywords), 'keywords': keywords}
+            for category, keywords in matches.items()
+        ]
+
+        # 最も多くマッチしたカテゴリを主カテゴリとする
+        primary_category = "その他"
+        confidence = 0.5  # デフォルト
+
+        if categories_found:
+            categories_found.sort(key=lambda x: x['matches'], reverse=True)
+            primary_category = categories_found[0]['category']
+            # マッチ数に基づく信頼度計算
+            max_matches = categories_found[0]['matches']
+            confidence = min(0.9, 0.5 + (max_matches * 0.1))
+
+        # 日本語文字（ひらがな・カタカナ・漢字）の検出
+        has_japanese_chars = bool(JAPANESE_SCRIPT.search(combined_text))
+        if has_japanese_chars:
+            confidence = min(0.95, confidence + 0.2)
+
+        # 価格による重み付け（マーケットプレイス間で比べられるようドルに換算）
+        price_value = to_usd(item.get('price'))
+        # 高額商品は信頼度を少し上げる
+        if price_value is not None and price_value > 100:
+            confidence = min(0.98, confidence + 0.05)
+
+        # 分析結果を商品に追加
+        item['local_analysis'] = {
+            'is_japanese': True,  # japanクエリで検索しているので基本的にTrue
+            'confidence': confidence,
+            'primary_category': primary_category,
+            'categories_found': categories_found,
             'keyword_score': keyword_score,
             'has_japanese_text': has_japanese_chars,
+            'price_value': price_value,
             'analysis_method': 'local_keyword_matching'
         }
 
-        return item
+        return item
+
+    def calculate_popularity_score(self, item: Dict[Any, Any]) -> float:
+        """人気度スコアを計算"""
+        score = 0.0
+
+        # 基本メトリクス
+        score += item.get('watchCount', 0) * 2
+        score += item.get('bidCount', 0) * 5
+        score += item.get('quantitySold', 0) * 10
+
+        # 価格による重み付け（ドル換算）
+        price = to_usd(item.get('price'))
+        if price is not None:
+            if price > 100:
+                score *= 1.3
+            elif price > 500:
+                score *= 1.5
+
+        # ローカル分析スコアを加味
+        local_analysis = item.get('local_analysis', {})
+        confidence = local_analysis.get('confidence', 0.5)
+        keyword_score = local_analysis.get('keyword_score', 0)
+
+        score += confidence * 10
+        score += keyword_score * 2
+
+        # 送料無料ボーナス
+        shipping_options = item.get('shippingOptions', [])
+        for option in shipping_options:
+            if option.get('shippingCost', {}).get('value', '0') == '0':
+                score += 5
+                break
+
+        return score
+
+    def calculate_popularity_scores(self, items: List[Dict[Any, Any]]) -> List[float]:
+        """人気度スコアを一括計算（calculate_popularity_score と同じ値を返す）
+
+        各商品から必要な値を列に取り出し、NumPy があればベクトル演算、無ければ
+        array の列をまとめて計算する。演算順序は1件ずつの実装と揃えてある。
+        """
+        n = len(items)
+        watch, bids, sold = array('d', bytes(8 * n)), array('d', bytes(8 * n)), array('d', bytes(8 * n))
+        prices, confidence = array('d', bytes(8 * n)), array('d', bytes(8 * n))
+        keyword_scores, free_shipping = array('d', bytes(8 * n)), array('d', bytes(8 * n))
+
+        for i, item in enumerate(items):
+            watch[i] = item.get('watchCount', 0)
+            bids[i] = item.get('bidCount', 0)
+            sold[i] = item.get('quantitySold', 0)
+
+            local_analysis = item.get('local_analysis', {})
+            confidence[i] = local_analysis.get('confidence', 0.5)
+            keyword_scores[i] = local_analysis.get('keyword_score', 0)
+
+            # enhance_item_with_local_analysis で解析済みの価格を再利用
+            price = local_analysis.get('price_value') if 'price_value' in local_analysis else self._parse_price(item)
+            if price is not None:
+                prices[i] = price
+
+            for option in item.get('shippingOptions', []):
+                if option.get('shippingCost', {}).get('value', '0') == '0':
+                    free_shipping[i] = 1.0
+                    break
+
+        if np is not None:
+            base = np.frombuffer(watch) * 2 + np.frombuffer(bids) * 5 + np.frombuffer(sold) * 10
+            scores = np.where(np.frombuffer(prices) > 100, base * 1.3, base)
+            scores = scores + np.frombuffer(confidence) * 10
+            scores = scores + np.frombuffer(keyword_scores) * 2
+            scores = scores + np.frombuffer(free_shipping) * 5
+            return scores.tolist()
+
+        scores = []
+        for w, b, q, p, c, k, f in zip(watch, bids, sold, prices, confidence, keyword_scores, free_shipping):
+            score = w * 2 + b * 5 + q * 10
+            if p > 100:
+                score *= 1.3
+            scores.append(score + c * 10 + k * 2 + f * 5)
+        return scores
+
+    @staticmethod
+    def _parse_price(item: Dict[Any, Any]) -> Optional[float]:
+        return to_usd(item.get('price'))
+
+    @staticmethod
+    def select_top_items(items: List[Dict[Any, Any]], scores: List[float], limit: int) -> List[Dict[Any, Any]]:
+        """スコア上位 limit 件を降順で返す（同点は元の順序を保つ、全件ソートはしない）"""
+        n = len(items)
+        if limit <= 0 or n == 0:
+            return []
+
+        if np is not None and n > limit:
+            values = np.asarray(scores)
+            # limit 番目のスコア以上の候補だけを部分選択してから並べる
+            threshold = np.partition(values, n - limit)[n - limit]
+            candidates = np.flatnonzero(values >= threshold)
+            order = candidates[np.lexsort((candidates, -values[candidates]))][:limit]
+            return [items[i] for i in order.tolist()]
+
+        top = heapq.nlargest(limit, range(n), key=scores.__getitem__)
+        return [items[i] for i in top]
+
+    def enhance_batch(self, items: List[Dict[Any, Any]]) -> List[Dict[Any, Any]]:
+        """商品をまとめてローカル分析する（学習済み分類器があれば、主カテゴリと確信度をバッチで付け直す）"""
+        for item in items:
+            self.enhance_item_with_local_analysis(item)
+        self.classify_items(items)
+        return items
+
+    def classify_items(self, items: List[Dict[Any, Any]]):
+        """ローカル分析済みの商品に、分類器の最も確率の高いカテゴリとその確率を付ける"""
+        if self.classifier is None or not items:
+            return
+        probabilities = self.classifier.predict_proba(
+            [f"{item.get('title', '')} {item.get('shortDescription', '')}" for item in items])
+        best = probabilities.argmax(axis=1)
+        confidences = probabilities[np.arange(len(items)), best]
+        for item, index, confidence in zip(items, best.tolist(), confidences.tolist()):
+            local_analysis = item['local_analysis']
+            local_analysis['primary_category'] = self.classifier.classes[index]
+            local_analysis['confidence'] = confidence
+            local_analysis['analysis_method'] = 'local_classifier'
+
+    def enrich_chunk(self, items: List[Dict[Any, Any]]) -> List[Tuple[Dict[str, Any], float]]:
+        """商品ごとの (local_analysis, 人気度スコア)（プロセスプールのワーカーで1チャンクずつ呼ぶ）"""
+        self.enhance_batch(items)
+        for item in items:
+            item['local_analysis']['analysis_key'] = self.analysis_key(item)
+        scores = self.calculate_popularity_scores(items)
+        return [(item['local_analysis'], score) for item, score in zip(items, scores)]
+
+def iter_chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """items を size 件ずつのリストにして返す（ジェネレータも先読みしすぎない）"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# プロセスプールのワーカー内の分析器（initializer で一度だけ作る）
+_worker_analyzer: Optional[LocalItemAnalyzer] = None
+
+def _init_enrich_worker(keyword_matcher: KeywordMatcher, keyword_version: str,
+                        classifier: Optional[HashedNgramClassifier]):
+    global _worker_analyzer
+    _worker_analyzer = LocalItemAnalyzer(keyword_matcher, keyword_version, classifier)
+
+def _enrich_worker_chunk(items: List[Dict[Any, Any]]) -> List[Tuple[Dict[str, Any], float]]:
+    return _worker_analyzer.enrich_chunk(items)
+
+class BulkEnricher:
+    """大量の商品にローカル分析と人気度スコアを付けるプロセスプール
+
+    コンパイル済みのキーワードマッチャーと分類器は initializer で各ワーカーに一度だけ送り、
+    商品は分析に使う項目だけをチャンクにして送る。結果は入力順に逐次返し、送り出す
+    チャンクはワーカー数の2倍までにするので、入力がジェネレータでも全件をメモリに載せない。
+    キーワード辞書が変わったらプールを作り直す。
+    """
+
+    INPUT_FIELDS = ('title', 'shortDescription', 'price', 'watchCount', 'bidCount', 'quantitySold',
+                    'shippingOptions')
+
+    def __init__(self, workers: int, chunk_size: int = 500, start_method: str = 'spawn'):
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.start_method = start_method
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_version = None
+
+    def _get_pool(self, analyzer: LocalItemAnalyzer) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None or self._pool_version != analyzer.keyword_version:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(self.start_method),
+                    initializer=_init_enrich_worker,
+                    initargs=(analyzer.keyword_matcher, analyzer.keyword_version, analyzer.classifier)
+                )
+                self._pool_version = analyzer.keyword_version
+            return self._pool
+
+    def enrich(self, analyzer: LocalItemAnalyzer, items: Iterable[Any]) -> Iterator[Any]:
+        """items に local_analysis と popularityScore を付け、入力順に1件ずつ返す"""
+        pool = self._get_pool(analyzer)
+        pending = deque()
+        try:
+            for chunk in iter_chunks(items, self.chunk_size):
+                inputs = [{field: item[field] for field in self.INPUT_FIELDS if field in item} for item in chunk]
+                pending.append((chunk, pool.submit(_enrich_worker_chunk, inputs)))
+                if len(pending) >= self.workers * 2:
+                    yield from self._apply(*pending.popleft())
+            while pending:
+                yield from self._apply(*pending.popleft())
+        finally:
+            # 途中で読むのをやめたら、まだ始まっていないチャンクは取り消す
+            for _, future in pending:
+                future.cancel()
+
+    @staticmethod
+    def _apply(chunk: List[Any], future: Future) -> Iterator[Any]:
+        for item, (local_analysis, score) in zip(chunk, future.result()):
+            item['local_analysis'] = local_analysis
+            item['popularityScore'] = score
+            yield item
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+class SmarteBayAnalyzer(LocalItemAnalyzer):
+    SEARCH_FILTER = 'buyingOptions:{AUCTION,FIXED_PRICE},conditions:{NEW,USED}'
+
+    def __init__(self):
+        self.base_url = f"{EBAY_API_BASE_URL}/buy/browse/v1"
+        self.token_manager = eBayTokenManager()
+        self.token_cache = eBayTokenCache(
+            self.token_manager,
+            refresh_margin=EBAY_TOKEN_REFRESH_MARGIN,
+            store=SharedTokenStore(EBAY_TOKEN_CACHE_PATH) if EBAY_TOKEN_CACHE_PATH else None,
+            static_token=EBAY_OAUTH_TOKEN,
+            static_token_ttl=EBAY_STATIC_TOKEN_TTL
+        )
+
+        # 学習済みのカテゴリ分類器（任意、train_classifier.py で作る）
+        self.classifier = self.load_classifier(LOCAL_CLASSIFIER_PATH)
+
+        # 日本関連キーワード辞書（代入するとマッチャーを再構築する）
+        self.keyword_word_boundary = KEYWORD_WORD_BOUNDARY
+        self.japanese_keywords = {
+            'culture': ['kimono', 'yukata', 'obi', 'geta', 'zori', 'tabi', 'furoshiki', 'noren', 'daruma'],
+            'food': ['ramen', 'sushi', 'sake', 'miso', 'soy sauce', 'shoyu', 'mirin', 'dashi', 'wasabi', 'matcha', 'sencha', 'gyoza', 'tempura', 'yakitori', 'bento', 'onigiri'],
+            'anime_manga': ['anime', 'manga', 'otaku', 'cosplay', 'figure', 'figurine', 'pokemon', 'naruto', 'one piece', 'dragon ball', 'sailor moon', 'gundam', 'studio ghibli'],
+            'crafts': ['pottery', 'ceramics', 'lacquer', 'urushi', 'bamboo', 'washi', 'origami', 'calligraphy', 'shodo', 'ikebana', 'bonsai'],
+            'weapons': ['katana', 'wakizashi', 'tanto', 'samurai', 'ninja', 'sword', 'tsuba'],
+            'home': ['zabuton', 'tatami', 'shoji', 'kotatsu', 'futon', 'tansu'],
+            'brands': ['nintendo', 'sony', 'honda', 'toyota', 'canon', 'nikon', 'casio', 'citizen', 'seiko', 'uniqlo', 'muji']
+        }
+
+        # より具体的な日本関連検索クエリ
+        self.search_queries = [
+            'japan vintage',
+            'japanese art',
+            'anime figure',
+            'japanese pottery',
+            'kimono vintage',
+            'japanese tea set',
+            'manga collection',
+            'nintendo japan',
+            'japanese ceramics',
+            'samurai sword',
+            'japanese food',
+            'zen garden'
+        ]
+
+        # ヘッダーを設定（Authorization はリクエストごとにキャッシュから付与）
+        self.base_headers = {
+            'X-EBAY-C-MARKETPLACE-ID': EBAY_MARKETPLACES[0],
+            'Accept': 'application/json',
+            'User-Agent': 'eBayAnalyzer/1.0'
+        }
+        # 同じクエリをマーケットプレイスごとに投げる（トークンとコネクションプールは共有）
+        self.marketplaces = list(EBAY_MARKETPLACES)
+
+        # 検索クエリ用のスレッドプール（プロセス内で共有し、同時実行数を制限）
+        # マーケットプレイスを増やしても所要時間が伸びないよう、その数だけ並列度を上げる
+        self.search_concurrency = EBAY_SEARCH_CONCURRENCY
+        self.search_deadline = EBAY_SEARCH_DEADLINE
+        self._executor = ThreadPoolExecutor(max_workers=self.search_concurrency * len(self.marketplaces),
+                                            thread_name_prefix='ebay-search')
+        # 分析済み商品の永続ストア（任意）
+        self.item_store = ItemStore(ITEM_STORE_PATH) if ITEM_STORE_PATH else None
+
+        # 深いクロールは長時間かかるので通常検索とは別のプールで動かす
+        self._crawl_executor = ThreadPoolExecutor(max_workers=EBAY_CRAWL_CONCURRENCY * len(self.marketplaces),
+                                                  thread_name_prefix='ebay-crawl')
+
+        # 商品詳細（ローカル分析済み）のキャッシュと、getItems を並列に投げるプール
+        self.detail_cache = LRUTTLCache(ITEM_DETAIL_CACHE_SIZE, ITEM_DETAIL_CACHE_TTL,
+                                        path=ITEM_DETAIL_CACHE_PATH, table='item_details')
+        self._detail_executor = ThreadPoolExecutor(max_workers=self.search_concurrency,
+                                                   thread_name_prefix='ebay-detail')
+        self._detail_inflight: Dict[str, Future] = {}
+        self._detail_lock = threading.Lock()
+
+        # 大量の商品のローカル分析はコア数分のプロセスで並列に行う（最初に使うときに起動）
+        self.bulk_enricher = BulkEnricher(BULK_ENRICH_WORKERS, BULK_ENRICH_CHUNK_SIZE,
+                                          BULK_ENRICH_START_METHOD) if BULK_ENRICH_WORKERS > 0 else None
+
+    @property
+    def japanese_keywords(self) -> Dict[str, List[str]]:
+        return self._japanese_keywords
+
+    @japanese_keywords.setter
+    def japanese_keywords(self, keywords: Dict[str, List[str]]):
+        self._japanese_keywords = keywords
+        self.refresh_keyword_matcher()
+
+    def refresh_keyword_matcher(self):
+        """キーワード辞書からマッチャーを作り直す（辞書をその場で変更した場合に呼ぶ）"""
+        self.keyword_matcher = KeywordMatcher(self._japanese_keywords,
+                                              word_boundary=self.keyword_word_boundary)
+        # 辞書（や分類器）が変わったら保存済みのローカル分析を使い回さないための版
+        encoded = json.dumps([self._japanese_keywords, self.keyword_word_boundary,
+                              self.classifier.version if self.classifier is not None else None],
+                             sort_keys=True, ensure_ascii=False)
+        self.keyword_version = hashlib.sha1(encoded.encode('utf-8')).hexdigest()[:12]
+
+    @staticmethod
+    def load_classifier(path: Optional[str]) -> Optional[HashedNgramClassifier]:
+        """学習済みの分類器を読み込む（未設定・NumPy が無い・読めない場合は None でキーワード分類のみ）"""
+        if not path:
+            return None
+        if np is None:
+            logger.warning("⚠️ 分類器には NumPy が必要です（キーワード分類のみで動作します）")
+            return None
+        try:
+            classifier = HashedNgramClassifier.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("⚠️ 分類器の読み込みエラー: %s", e)
+            return None
+        logger.info("🧠 分類器を読み込みました: %s (%sクラス)", path, len(classifier.classes))
+        return classifier
+
+    def warm_up(self) -> bool:
+        """トークンを取得してeBayへのコネクションを確立しておく（起動後にバックグラウンドで実行）"""
+        logger.debug("=== eBay API トークン診断 ===")
+        if self.token_cache.get_token():
+            logger.info("✅ APIヘッダー設定完了")
+            return True
+
+        logger.error("❌ 有効なトークンがありません")
+        return False
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """キャッシュ済みトークンを付けたリクエストヘッダー"""
+        return self.headers_for(self.marketplaces[0])
+
+    def headers_for(self, marketplace: str) -> Dict[str, str]:
+        """マーケットプレイスを指定したリクエストヘッダー（トークンは共通）"""
+        headers = dict(self.base_headers, **{'X-EBAY-C-MARKETPLACE-ID': marketplace})
+        token = self.token_cache.get_token()
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        return headers
+
+    async def headers_for_async(self, marketplace: str) -> Dict[str, str]:
+        """headers_for の asyncio 版"""
+        headers = dict(self.base_headers, **{'X-EBAY-C-MARKETPLACE-ID': marketplace})
+        token = await self.token_cache.get_token_async()
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        return headers
+
+    def get_japanese_items_smart(self, limit: int = 200) -> List[Dict[Any, Any]]:
+        """効率的に日本関連商品を取得"""
+        return self.get_marketplace_rankings(limit)[0]
+
+    def get_marketplace_rankings(self, limit: int = 200, stagger: float = 0.0,
+                                 progress=None) -> Tuple[List[Dict[Any, Any]], Dict[str, List[Dict[Any, Any]]]]:
+        """全マーケットプレイスを合わせた上位 limit 件と、マーケットプレイスごとの上位 limit 件
+
+        progress を渡すと、クエリが完了するたびに progress('query', {query, completed, items}) を呼ぶ。
+        """
+        results = {}
+        for completed, (index, query, items) in enumerate(self.iter_query_results(limit, stagger), 1):
+            results[index] = items
+            if progress is not None:
+                progress('query', {'query': query, 'completed': completed, 'items': items})
+        return self._rank_marketplaces(results, limit)
+
+    async def get_marketplace_rankings_async(self, limit: int = 200, progress=None) -> Tuple[List[Dict[Any, Any]],
+                                                                                            Dict[str, List[Dict[Any, Any]]]]:
+        """get_marketplace_rankings の asyncio 版（クエリの待ちでスレッドを占有しない）"""
+        if await self.token_cache.get_token_async() is None:
+            logger.error("❌ 有効なトークンがありません")
+            return [], {marketplace: [] for marketplace in self.marketplaces}
+
+        items_per_query = max(1, limit // len(self.search_queries))
+        jobs = [(query, marketplace) for query in self.search_queries for marketplace in self.marketplaces]
+        semaphore = asyncio.Semaphore(self.search_concurrency * len(self.marketplaces))
+        deadline = time.monotonic() + self.search_deadline
+        completed = [0]
+
+        async def run(query: str, marketplace: str) -> List[Dict[Any, Any]]:
+            async with semaphore:
+                items = await self._fetch_query_items_async(query, items_per_query, deadline, marketplace)
+            if progress is not None:
+                completed[0] += 1
+                progress('query', {'query': query, 'completed': completed[0], 'items': items})
+            return items
+
+        tasks = [asyncio.ensure_future(run(query, marketplace)) for query, marketplace in jobs]
+        done, pending = await asyncio.wait(tasks, timeout=self.search_deadline)
+        if pending:
+            logger.warning("⏱️ 締め切り超過: %s/%s件のクエリ結果を破棄します", len(pending), len(tasks))
+            for task in pending:
+                task.cancel()
+
+        results = {index: task.result() for index, task in enumerate(tasks)
+                   if task in done and task.exception() is None}
+        # スコア計算とストアへの保存はスレッドで行い、その間もイベントループを止めない
+        return await asyncio.to_thread(self._rank_marketplaces, results, limit)
+
+    def _rank_marketplaces(self, results: Dict[int, List[Dict[Any, Any]]],
+                           limit: int) -> Tuple[List[Dict[Any, Any]], Dict[str, List[Dict[Any, Any]]]]:
+        """クエリ番号ごとの結果から、全体とマーケットプレイスごとの上位 limit 件を作る"""
+        # 元のクエリ順に結合して、逐次実行時と同じ並び順を保つ
+        all_items = []
+        for index in sorted(results):
+            all_items.extend(results[index])
+
+        combined = self.rank_items(all_items, limit)
+        if len(self.marketplaces) == 1:
+            return combined, {self.marketplaces[0]: combined}
+
+        per_marketplace = {}
+        for marketplace in self.marketplaces:
+            market_items = {}
+            for item in all_items:
+                if item.get('marketplaceId') == marketplace:
+                    market_items.setdefault(item.get('itemId'), item)
+            market_items = list(market_items.values())
+            scores = [item['popularityScore'] for item in market_items]
+            per_marketplace[marketplace] = self.select_top_items(market_items, scores, limit)
+        return combined, per_marketplace
+
+    def iter_query_results(self, limit: int = 200, stagger: float = 0.0):
+        """全クエリを全マーケットプレイスへ並列に投げ、完了した順に (番号, クエリ, 商品リスト) を返す
+
+        番号はクエリ順・マーケットプレイス順に振るので、番号順に結合すれば
+        逐次実行時と同じ並び順になる。limit はマーケットプレイスごとの件数。
+        stagger 秒を指定すると、上流への集中を避けるためクエリを間隔を空けて投げる。
+        """
+        if self.token_cache.get_token() is None:
+            logger.error("❌ 有効なトークンがありません")
+            return
+
+        items_per_query = max(1, limit // len(self.search_queries))
+
+        # 締め切りまでに返ってきた結果だけを使う
+        # クエリごとに全マーケットプレイス分を並べて投げ、締め切りで偏らないようにする
+        jobs = [(query, marketplace) for query in self.search_queries for marketplace in self.marketplaces]
+        search_deadline = self.search_deadline + stagger * len(jobs)
+        deadline = time.monotonic() + search_deadline
+        futures = {}
+        for index, (query, marketplace) in enumerate(jobs):
+            if stagger and index:
+                time.sleep(stagger)
+            # 呼び出し元の run_timings に各スレッドの所要時間も集まるよう context を引き継ぐ
+            futures[self._executor.submit(contextvars.copy_context().run, self._fetch_query_items,
+                                          query, items_per_query, deadline, marketplace)] = (index, query)
+
+        pending = set(futures)
+        try:
+            for future in as_completed(futures, timeout=max(0.0, deadline - time.monotonic())):
+                pending.discard(future)
+                if future.exception() is None:
+                    index, query = futures[future]
+                    yield index, query, future.result()
+        except FuturesTimeoutError:
+            logger.warning("⏱️ 締め切り超過: %s/%s件のクエリ結果を破棄します", len(pending), len(futures))
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def rank_items(self, all_items: List[Dict[Any, Any]], limit: int) -> List[Dict[Any, Any]]:
+        """重複を除き、人気度スコアの上位 limit 件を返す"""
+        # 重複除去
+        unique_items = {}
+        for item in all_items:
+            item_id = item.get('itemId')
+            if item_id not in unique_items:
+                unique_items[item_id] = item
+
+        result_items = list(unique_items.values())
+
+        # 人気度スコアを一括計算し、上位 limit 件だけを選ぶ
+        # （マーケットプレイス別の順位付けにも使うので重複分にも付けておく）
+        with metrics.timer('scoring'):
+            scores = self.calculate_popularity_scores(all_items)
+            for item, score in zip(all_items, scores):
+                item['popularityScore'] = score
+            scores = [item['popularityScore'] for item in result_items]
+            top_items = self.select_top_items(result_items, scores, limit)
+
+        logger.info("📈 合計 %s件の日本関連商品を取得", len(result_items))
+        self.save_items(result_items)
+        return top_items
+
+    def save_items(self, items: List[Dict[Any, Any]]):
+        """スコア計算済みの商品をストアに保存する（ストア未設定なら何もしない）"""
+        if self.item_store is None or not items:
+            return
+        try:
+            counts = self.item_store.upsert_items(items)
+            logger.info("💾 商品ストア: 新規%s件 / 更新%s件 / 変化なし%s件",
+                        counts['inserted'], counts['updated'], counts['unchanged'])
+        except sqlite3.Error as e:
+            logger.warning("⚠️ 商品ストア保存エラー: %s", e)
+
+    def enhance_items(self, items: List[Dict[Any, Any]], bulk: Optional[bool] = None) -> List[Dict[Any, Any]]:
+        """ローカル分析を付ける（入力が変わっていない商品はストアの分析結果を再利用）
+
+        分析し直す商品が BULK_ENRICH_MIN_ITEMS 件以上なら（bulk=True なら件数によらず）
+        プロセスプールで分析する。
+        """
+        stored = {}
+        if self.item_store is not None and items:
+            try:
+                stored = self.item_store.get_analyses([item.get('itemId') for item in items if item.get('itemId')])
+            except sqlite3.Error as e:
+                logger.warning("⚠️ 商品ストア読み込みエラー: %s", e)
+
+        misses = []
+        with metrics.timer('enhance'):
+            for item in items:
+                key = self.analysis_key(item)
+                previous = stored.get(item.get('itemId'))
+                if previous and previous[0] == key and previous[1]:
+                    item['local_analysis'] = previous[1]
+                else:
+                    misses.append((item, key))
+
+            if bulk is None:
+                bulk = len(misses) >= BULK_ENRICH_MIN_ITEMS
+            if bulk and self.bulk_enricher is not None and misses:
+                # 分析キーはワーカーでも同じ版の辞書から計算される
+                for _ in self.bulk_enricher.enrich(self, [item for item, _ in misses]):
+                    pass
+            else:
+                self.enhance_batch([item for item, _ in misses])
+                for item, key in misses:
+                    item['local_analysis']['analysis_key'] = key
+        reused = len(items) - len(misses)
+        if self.item_store is not None:
+            metrics.inc('cache_hits_total', reused, cache='local_analysis')
+            metrics.inc('cache_misses_total', len(misses), cache='local_analysis')
+        return list(items)
+
+    def enrich_items_bulk(self, items: Iterable[Any]) -> Iterator[Any]:
+        """大量の商品にローカル分析と人気度スコアを付け、入力順に逐次返す（ストアの分析結果は使わない）
+
+        プロセスプールが無効なら、同じチャンク単位で呼び出し元のスレッドで分析する。
+        """
+        if self.bulk_enricher is not None:
+            yield from self.bulk_enricher.enrich(self, items)
+            return
+        for chunk in iter_chunks(items, BULK_ENRICH_CHUNK_SIZE):
+            for item, (_, score) in zip(chunk, self.enrich_chunk(chunk)):
+                item['popularityScore'] = score
+                yield item
+
+    def reanalyze_store(self, batch_size: int = 1000) -> Dict[str, int]:
+        """保存済みの全商品をいまのキーワード辞書で分析し直して保存する（辞書を変えたあとに使う）"""
+        totals = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        if self.item_store is None:
+            return totals
+        for batch in iter_chunks(self.enrich_items_bulk(self.item_store.iter_items(batch_size)), batch_size):
+            for key, count in self.item_store.upsert_items(batch).items():
+                totals[key] += count
+        logger.info("💾 商品ストア再分析: 更新%s件 / 変化なし%s件", totals['updated'], totals['unchanged'])
+        return totals
+
+    def to_records(self, summaries: List[Dict[str, Any]], marketplace: str) -> List[ItemRecord]:
+        """検索結果を軽量な ItemRecord にする（ストアがあれば差分判定用のハッシュもここで取る）
+
+        元の辞書は残さないので、応答の JSON はこの後すぐに解放される。
+        """
+        return [ItemRecord.from_summary(summary, marketplace,
+                                        ItemStore.payload_hash(summary) if self.item_store is not None else None)
+                for summary in summaries]
+
+    def _fetch_query_items(self, query: str, items_per_query: int, deadline: float,
+                           marketplace: Optional[str] = None) -> List[Dict[Any, Any]]:
+        """1つの検索クエリを実行し、ローカル分析済みの商品リストを返す"""
+        marketplace = marketplace or self.marketplaces[0]
+        logger.debug("🔍 検索クエリ: '%s' (%s)", query, marketplace)
+
+        url, params = self._search_request(query, items_per_query)
+        items = []
+
+        try:
+            timeout = max(1.0, min(30.0, deadline - time.monotonic()))
+            with metrics.timer('ebay_query'):
+                response = self._get_with_auth(url, params=params, timeout=timeout, marketplace=marketplace)
+                data = response.json() if response.status_code == 200 else None
+
+            if response.status_code == 200:
+                summaries = self.to_records(data.get('itemSummaries', []), marketplace)
+                logger.debug("   ✅ '%s' (%s): %s件取得", query, marketplace, len(summaries))
+
+                # 各商品にローカル分析を追加
+                items = self.enhance_items(summaries)
+
+            else:
+                logger.warning("   ❌ '%s' (%s) エラー: %s", query, marketplace, response.status_code)
+
+        except Exception as e:
+            logger.warning("   ❌ '%s' (%s) リクエストエラー: %s", query, marketplace, e)
+
+        return items
+
+    def _search_request(self, query: str, items_per_query: int) -> Tuple[str, Dict[str, str]]:
+        """検索クエリの URL とパラメータ"""
+        return f"{self.base_url}/item_summary/search", {
+            'limit': str(min(items_per_query, 50)),
+            'sort': 'bestMatch',
+            'q': query,
+            'filter': self.SEARCH_FILTER
+        }
+
+    async def _fetch_query_items_async(self, query: str, items_per_query: int, deadline: float,
+                                       marketplace: str) -> List[Dict[Any, Any]]:
+        """_fetch_query_items の asyncio 版"""
+        logger.debug("🔍 検索クエリ: '%s' (%s)", query, marketplace)
+        url, params = self._search_request(query, items_per_query)
+        items = []
+
+        try:
+            timeout = max(1.0, min(30.0, deadline - time.monotonic()))
+            with metrics.timer('ebay_query'):
+                response = await self._get_with_auth_async(url, params=params, timeout=timeout,
+                                                           marketplace=marketplace)
+                data = response.json() if response.status_code == 200 else None
+
+            if response.status_code == 200:
+                summaries = self.to_records(data.get('itemSummaries', []), marketplace)
+                logger.debug("   ✅ '%s' (%s): %s件取得", query, marketplace, len(summaries))
+                # ローカル分析はストアを読むことがあるのでスレッドで行う
+                items = await asyncio.to_thread(self.enhance_items, summaries)
+            else:
+                logger.warning("   ❌ '%s' (%s) エラー: %s", query, marketplace, response.status_code)
+
+        except Exception as e:
+            logger.warning("   ❌ '%s' (%s) リクエストエラー: %s", query, marketplace, e)
+
+        return items
+
+    async def _get_with_auth_async(self, url: str, params: Optional[Dict[str, str]] = None,
+                                   timeout: float = 30, marketplace: Optional[str] = None) -> 'httpx.Response':
+        """_get_with_auth の asyncio 版"""
+        marketplace = marketplace or self.marketplaces[0]
+        headers = await self.headers_for_async(marketplace)
+        response = await async_http_client.get(url, params=params, headers=headers, timeout=timeout)
+
+        if response.status_code == 401:
+            logger.warning("   ❌ 認証エラー: トークンを再生成します")
+            # 共有ストアのファイルロックを待つのでスレッドで行う
+            await asyncio.to_thread(self.token_cache.invalidate, headers.get('Authorization', '')[len('Bearer '):])
+            retry_headers = await self.headers_for_async(marketplace)
+            if retry_headers.get('Authorization') != headers.get('Authorization'):
+                response = await async_http_client.get(url, params=params, headers=retry_headers, timeout=timeout)
+
+        return response
+
+    def _get_with_auth(self, url: str, params: Optional[Dict[str, str]] = None,
+                       timeout: float = 30, marketplace: Optional[str] = None) -> requests.Response:
+        """トークン付きでGETし、401 ならトークンを更新して1回だけ再試行する"""
+        marketplace = marketplace or self.marketplaces[0]
+        headers = self.headers_for(marketplace)
+        response = http_client.get(url, params=params, headers=headers, timeout=timeout)
+
+        if response.status_code == 401:
+            # 期限前更新で通常は発生しない（失効などの異常時のみ）
+            logger.warning("   ❌ 認証エラー: トークンを再生成します")
+            self.token_cache.invalidate(headers.get('Authorization', '')[len('Bearer '):])
+            retry_headers = self.headers_for(marketplace)
+            if retry_headers.get('Authorization') != headers.get('Authorization'):
+                response = http_client.get(url, params=params, headers=retry_headers, timeout=timeout)
+
+        return response
+
+    GET_ITEMS_BATCH_SIZE = 20  # getItems の1回あたりの上限
+
+    def _fetch_item_chunk(self, item_ids: List[str]) -> Dict[str, Dict[Any, Any]]:
+        """getItems（/item/?item_ids=）で最大20件を取得し、ローカル分析してキャッシュする"""
+        response = self._get_with_auth(f"{self.base_url}/item/", params={'item_ids': ','.join(item_ids)},
+                                       timeout=ITEM_DETAIL_TIMEOUT)
+        if response.status_code != 200:
+            logger.warning("   ❌ 商品詳細の取得失敗 (%s件): %s", len(item_ids), response.status_code)
+            return {}
+
+        details = {}
+        for item in self.enhance_batch([item for item in response.json().get('items', []) if item.get('itemId')]):
+            details[item['itemId']] = item
+            self.detail_cache.set(item['itemId'], item)
+        return details
+
+    def _submit_item_chunks(self, item_ids: List[str]) -> List[Future]:
+        """キャッシュに無い商品IDを20件ずつ取得に回す（取得中のものは同じ Future を使う）"""
+        futures = []
+        with self._detail_lock:
+            pending = []
+            for item_id in item_ids:
+                future = self._detail_inflight.get(item_id)
+                if future is not None:
+                    futures.append(future)
+                else:
+                    pending.append(item_id)
+
+            for start in range(0, len(pending), self.GET_ITEMS_BATCH_SIZE):
+                chunk = pending[start:start + self.GET_ITEMS_BATCH_SIZE]
+                future = self._detail_executor.submit(self._fetch_item_chunk, chunk)
+                for item_id in chunk:
+                    self._detail_inflight[item_id] = future
+                future.add_done_callback(lambda done, chunk=chunk: self._release_inflight(chunk, done))
+                futures.append(future)
+        return futures
+
+    def _release_inflight(self, item_ids: List[str], future: Future):
+        with self._detail_lock:
+            for item_id in item_ids:
+                if self._detail_inflight.get(item_id) is future:
+                    del self._detail_inflight[item_id]
+
+    def _cached_item_details(self, item_ids: List[str]) -> Tuple[Dict[str, Dict[Any, Any]], List[str]]:
+        """キャッシュ済みの商品詳細と、キャッシュに無い商品IDに分ける"""
+        details = {}
+        missing = []
+        for item_id in item_ids:
+            cached = self.detail_cache.get(item_id)
+            if cached is not None:
+                details[item_id] = cached
+            else:
+                missing.append(item_id)
+        return details, missing
+
+    @staticmethod
+    def _collect_item_chunks(futures: Iterable[Future], details: Dict[str, Dict[Any, Any]]):
+        for future in futures:
+            try:
+                details.update(future.result())
+            except requests.RequestException as e:
+                logger.warning("   ❌ 商品詳細の取得エラー: %s", e)
+
+    def get_item_details(self, item_ids: List[str]) -> Dict[str, Dict[Any, Any]]:
+        """商品詳細をまとめて取得する（キャッシュ済みはそのまま、残りは getItems を並列実行）"""
+        item_ids = list(dict.fromkeys(item_ids))
+        details, missing = self._cached_item_details(item_ids)
+
+        if missing:
+            done, _ = wait(self._submit_item_chunks(missing), timeout=ITEM_DETAIL_TIMEOUT * 2)
+            self._collect_item_chunks(done, details)
+
+        return {item_id: details[item_id] for item_id in item_ids if item_id in details}
+
+    async def get_item_details_async(self, item_ids: List[str]) -> Dict[str, Dict[Any, Any]]:
+        """get_item_details の asyncio 版（取得は同じスレッドプールで行い、完了を待つ間スレッドを占有しない）"""
+        item_ids = list(dict.fromkeys(item_ids))
+        # キャッシュは SQLite から読むことがあるのでスレッドで引く
+        details, missing = await asyncio.to_thread(self._cached_item_details, item_ids)
+
+        if missing:
+            futures = self._submit_item_chunks(missing)
+            await asyncio.wait([asyncio.wrap_future(future) for future in futures], timeout=ITEM_DETAIL_TIMEOUT * 2)
+            self._collect_item_chunks([future for future in futures if future.done()], details)
+
+        return {item_id: details[item_id] for item_id in item_ids if item_id in details}
+
+    def prefetch_item_details(self, item_ids: List[str]):
+        """上位商品の詳細を裏で取得してキャッシュしておく（結果は待たない）"""
+        missing = [item_id for item_id in dict.fromkeys(item_ids) if self.detail_cache.get(item_id) is None]
+        if missing:
+            self._submit_item_chunks(missing)
+
+    def iter_search_pages(self, query: str, page_size: int = 200, max_items: Optional[int] = None,
+                          marketplace: Optional[str] = None, keep_going: Optional[Callable[[], bool]] = None):
+        """Browse API の next リンクをたどり、検索結果を1ページずつ返すジェネレータ
+
+        keep_going を渡すと各ページを取りに行く前に呼び、False なら取得せずに終わる。
+        """
+        marketplace = marketplace or self.marketplaces[0]
+        url = f"{self.base_url}/item_summary/search"
+        params = {
+            'limit': str(min(page_size, 200)),
+            'offset': '0',
+            'sort': 'bestMatch',
+            'q': query,
+            'filter': self.SEARCH_FILTER
+        }
+        fetched = 0
+
+        while url and (max_items is None or fetched < max_items):
+            if keep_going is not None and not keep_going():
+                return
+            with metrics.timer('ebay_page'):
+                response = self._get_with_auth(url, params=params, marketplace=marketplace)
+                data = response.json() if response.status_code == 200 else None
+            if response.status_code != 200:
+                logger.warning("   ❌ '%s' (%s) ページ取得エラー: %s (offset %s)", query, marketplace, response.status_code, fetched)
+                return
+
+            page = data.get('itemSummaries', [])
+            if not page:
+                return
+            if max_items is not None:
+                page = page[:max_items - fetched]
+            fetched += len(page)
+            yield page
+
+            # next には検索条件とoffsetが含まれている
+            url, params = data.get('next'), None
+
+    def crawl_japanese_items(self, per_query_budget: int = 1000, global_budget: int = 5000,
+                             page_size: int = 200, min_new_ratio: float = 0.1, stale_pages: int = 2):
+        """全クエリをページ送りで深く取得し、重複を除いたローカル分析済み商品を逐次返す
+
+        クエリごとのページ取得は別スレッドで並列に進み、結果は上限付きキューを
+        通して流すので、消費側が遅ければ取得側も待つ（全件をメモリに溜めない）。
+        新規商品の割合が min_new_ratio 未満のページが stale_pages 回続いたクエリは
+        打ち切る。
+        """
+        if self.token_cache.get_token() is None:
+            logger.error("❌ 有効なトークンがありません")
+            return
+
+        items_queue = queue.Queue(maxsize=page_size * 2)
+        stop = threading.Event()
+        seen = set()
+        seen_lock = threading.Lock()
+        accepted = [0]
+        finished = object()
+
+        def put(entry) -> bool:
+            while not stop.is_set():
+                try:
+                    items_queue.put(entry, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def keep_going() -> bool:
+            # ページを取りに行く前に、消費側の終了と全体の上限を確かめる（上限後のページは取らない）
+            return not stop.is_set() and accepted[0] < global_budget
+
+        def produce(query: str, marketplace: str):
+            stale = 0
+            fetched = 0
+            try:
+                for page in self.iter_search_pages(query, page_size, per_query_budget, marketplace,
+                                                   keep_going=keep_going):
+                    if stop.is_set():
+                        return
+                    page = self.to_records(page, marketplace)
+                    fetched += len(page)
+
+                    new_items = []
+                    with seen_lock:
+                        for item in page:
+                            item_id = item.get('itemId')
+                            if item_id in seen or accepted[0] >= global_budget:
+                                continue
+                            seen.add(item_id)
+                            accepted[0] += 1
+                            new_items.append(item)
+                        budget_reached = accepted[0] >= global_budget
+
+                    # 1ページ（最大200件）はプロセスプールへ送る往復の方が高くつくので、
+                    # BULK_ENRICH_MIN_ITEMS の判定どおりこのスレッドで分析する
+                    for item in self.enhance_items(new_items):
+                        if not put(item):
+                            return
+
+                    if budget_reached:
+                        return
+
+                    # 新しい商品がほとんど出てこないページが続いたら打ち切る
+                    stale = stale + 1 if len(new_items) < len(page) * min_new_ratio else 0
+                    if stale >= stale_pages:
+                        logger.info("   ⏹️ '%s' (%s): 新規商品が減ったため %s件で打ち切り", query, marketplace, fetched)
+                        return
+            except Exception as e:
+                logger.warning("   ❌ '%s' (%s) クロールエラー: %s", query, marketplace, e)
+            finally:
+                put(finished)
+
+        logger.info("🕸️ 深いクロール開始: クエリあたり最大%s件, 全体で最大%s件", per_query_budget, global_budget)
+        futures = [self._crawl_executor.submit(contextvars.copy_context().run, produce, query, marketplace)
+                   for query in self.search_queries for marketplace in self.marketplaces]
+        remaining = len(futures)
+        try:
+            while remaining:
+                entry = items_queue.get()
+                if entry is finished:
+                    remaining -= 1
+                    continue
+                yield entry
+        finally:
+            # まだ始まっていない取得は取り消し、実行中のものは次のページの前に止まる
+            stop.set()
+            for future in futures:
+                future.cancel()
+
+class QuantileSketch:
+    """相対誤差を保証する対数バケットの分位点スケッチ（DDSketch 方式）
 
-    def calculate_popularity_score(self, item: Dict[Any, Any]) -> float:
-        """人気度スコアを計算"""
-        score = 0.0
+    値を1件 O(1) で追加でき、同じ精度のスケッチ同士はバケットを足すだけでマージできる。
+    返す分位点は真の値から relative_accuracy 以内の相対誤差に収まる。正の値のみを扱う。
+    """
 
-        # 基本メトリクス
-        score += item.get('watchCount', 0) * 2
-        score += item.get('bidCount', 0) * 5
-        score += item.get('quantitySold', 0) * 10
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, int] = {}
+        self.count = 0
 
-        # 価格による重み付け
-        price_info = item.get('price', {})
-        if price_info and 'value' in price_info:
-            try:
-                price = float(price_info['value'])
-                if price > 100:
-                    score *= 1.3
-                elif price > 500:
-                    score *= 1.5
-            except:
-                pass
+    def add(self, value: float):
+        if value <= 0:
+            return
+        key = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        self.count += 1
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        if other.gamma != self.gamma:
+            raise ValueError("精度の異なるスケッチはマージできません")
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+class MarketStatsAccumulator:
+    """商品を1件ずつ投入できる市場統計の集計器
+
+    件数・平均・分散（Welford 法）、二分探索による価格帯分布、カテゴリ件数、
+    中央値・p90 用の分位点スケッチを O(1) で更新する。シャードごとに集計して
+    merge でまとめることもできる。
+    """
+
+    def __init__(self, price_edges=MARKET_PRICE_EDGES, relative_accuracy: float = MARKET_QUANTILE_ACCURACY):
+        self.price_edges = tuple(sorted(price_edges))
+        self.price_labels = self._bucket_labels(self.price_edges)
+        self.price_bucket_counts = [0] * len(self.price_labels)
+        self.total_items = 0
+        self.price_count = 0
+        self.price_sum = 0.0
+        self.price_mean = 0.0
+        self._price_m2 = 0.0
+        self.min_price = None
+        self.max_price = None
+        self.categories: Dict[str, int] = {}
+        self.marketplaces: Dict[str, int] = {}
+        self.price_sketch = QuantileSketch(relative_accuracy)
+
+    @staticmethod
+    def _bucket_labels(edges) -> List[str]:
+        bounds = [0] + list(edges)
+        labels = [f"{low:g}-{high:g}" for low, high in zip(bounds, bounds[1:])]
+        labels.append(f"{edges[-1]:g}+" if edges else "0+")
+        return labels
+
+    @classmethod
+    def price_bounds(cls, label: str, price_edges=MARKET_PRICE_EDGES) -> Optional[Tuple[float, Optional[float]]]:
+        """価格帯ラベル（"50-100" など）の (下限, 上限)。下限は含まず上限は含む（最上位の上限は None）"""
+        edges = tuple(sorted(price_edges))
+        bounds = [0.0] + list(edges) + [None]
+        for i, candidate in enumerate(cls._bucket_labels(edges)):
+            if candidate == label:
+                return bounds[i], bounds[i + 1]
+        return None
+
+    def add(self, item: Dict[Any, Any]) -> 'MarketStatsAccumulator':
+        """商品1件を統計に加える"""
+        self.total_items += 1
 
-        # ローカル分析スコアを加味
         local_analysis = item.get('local_analysis', {})
-        confidence = local_analysis.get('confidence', 0.5)
-        keyword_score = local_analysis.get('keyword_score', 0)
+        category = local_analysis.get('primary_category', 'その他')
+        self.categories[category] = self.categories.get(category, 0) + 1
+        marketplace = item.get('marketplaceId')
+        if marketplace:
+            self.marketplaces[marketplace] = self.marketplaces.get(marketplace, 0) + 1
 
-        score += confidence * 10
-        score += keyword_score * 2
+        price = local_analysis.get('price_value')
+        if price is None:
+            price = to_usd(item.get('price')) or 0
+        if price > 0:
+            self.add_price(price)
+        return self
 
-        # 送料無料ボーナス
-        shipping_options = item.get('shippingOptions', [])
-        for option in shipping_options:
-            if option.get('shippingCost', {}).get('value', '0') == '0':
-                score += 5
-                break
+    def add_price(self, price: float):
+        self.price_count += 1
+        self.price_sum += price
+        delta = price - self.price_mean
+        self.price_mean += delta / self.price_count
+        self._price_m2 += delta * (price - self.price_mean)
+        self.min_price = price if self.min_price is None else min(self.min_price, price)
+        self.max_price = price if self.max_price is None else max(self.max_price, price)
+        # 区切り値ちょうどは下の価格帯に入れる（例: 50ドルは "0-50"）
+        self.price_bucket_counts[bisect_left(self.price_edges, price)] += 1
+        self.price_sketch.add(price)
 
-        return score
+    def merge(self, other: 'MarketStatsAccumulator') -> 'MarketStatsAccumulator':
+        """別シャードの集計をまとめる"""
+        if other.price_edges != self.price_edges:
+            raise ValueError("価格帯の区切りが異なる集計はマージできません")
+
+        self.total_items += other.total_items
+        for category, count in other.categories.items():
+            self.categories[category] = self.categories.get(category, 0) + count
+        for marketplace, count in other.marketplaces.items():
+            self.marketplaces[marketplace] = self.marketplaces.get(marketplace, 0) + count
+
+        if other.price_count:
+            count = self.price_count + other.price_count
+            delta = other.price_mean - self.price_mean
+            self._price_m2 += other._price_m2 + delta * delta * self.price_count * other.price_count / count
+            self.price_mean += delta * other.price_count / count
+            self.price_count = count
+            self.price_sum += other.price_sum
+            self.min_price = other.min_price if self.min_price is None else min(self.min_price, other.min_price)
+            self.max_price = other.max_price if self.max_price is None else max(self.max_price, other.max_price)
+            for i, bucket_count in enumerate(other.price_bucket_counts):
+                self.price_bucket_counts[i] += bucket_count
+            self.price_sketch.merge(other.price_sketch)
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        """_calculate_market_stats と同じ形の統計（標準偏差・分位点つき、価格はドル換算）"""
+        if not self.total_items:
+            return {}
+
+        variance = self._price_m2 / (self.price_count - 1) if self.price_count > 1 else 0.0
+        return {
+            'total_items': self.total_items,
+            'currency': 'USD',
+            'avg_price': self.price_sum / self.price_count if self.price_count else 0,
+            'price_stddev': math.sqrt(variance),
+            'median_price': self.price_sketch.quantile(0.5) or 0,
+            'p90_price': self.price_sketch.quantile(0.9) or 0,
+            'min_price': self.min_price or 0,
+            'max_price': self.max_price or 0,
+            'price_ranges': dict(zip(self.price_labels, self.price_bucket_counts)),
+            'top_categories': sorted(self.categories.items(), key=lambda x: x[1], reverse=True),
+            'categories': dict(self.categories),
+            'marketplaces': dict(self.marketplaces)
+        }
 
 class EfficientGeminiAnalyzer:
     def __init__(self):
         self.api_key = GEMINI_API_KEY
-        self.base_url = "https://generativelanguage.googleapis.com/v1/models"
-        self.request_count = 0
+        self.base_url = f"{GEMINI_API_BASE_URL}/v1/models"
+        self.request_count = 0  # 実際にGeminiを呼んだ回数
+        self.calls_saved = 0    # キャッシュのおかげで省略できた回数
+        self._count_lock = threading.Lock()
+        self.analysis_cache = LRUTTLCache(GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL,
+                                          path=GEMINI_CACHE_PATH, table='gemini_analysis')
+
+    def analyze_market_trends_only(self, japanese_items: List[Dict[Any, Any]],
+                                   stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """市場トレンドのみを分析（個別商品判定は行わない）
+
+        stats を渡した場合（深いクロールで逐次集計した場合など）はそれを使う。
+        """
+        prepared = self._prepare_trend_request(japanese_items, stats)
+        if 'result' in prepared:
+            return prepared['result']
+        stats = prepared['stats']
+
+        try:
+            with metrics.timer('gemini'):
+                response = http_client.post(prepared['url'],
+                                            headers={'Content-Type': 'application/json'},
+                                            json=prepared['payload'],
+                                            timeout=30)
+            result = self._trend_result(response, stats, prepared['fingerprint'])
+            if result is not None:
+                return result
+
+        except RateLimitExceeded as e:
+            logger.warning("⚠️ レート制限: トレンド分析をスキップします (%s)", e)
+            return self._rate_limited_result(stats)
+
+        except Exception as e:
+            logger.error("❌ 分析エラー: %s", e)
+
+        # フォールバック: 統計ベースの簡易分析
+        return self._local_result(stats)
+
+    async def analyze_market_trends_only_async(self, japanese_items: List[Dict[Any, Any]],
+                                               stats: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """analyze_market_trends_only の asyncio 版（Gemini の応答待ちでスレッドを占有しない）"""
+        prepared = await asyncio.to_thread(self._prepare_trend_request, japanese_items, stats)
+        if 'result' in prepared:
+            return prepared['result']
+        stats = prepared['stats']
 
-    def analyze_market_trends_only(self, japanese_items: List[Dict[Any, Any]]) -> Dict[str, Any]:
-        """市場トレンドのみを分析（個別商品判定は行わない）"""
-        print("📈 市場トレンドを分析中...")
+        try:
+            with metrics.timer('gemini'):
+                response = await async_http_client.post(prepared['url'],
+                                                        headers={'Content-Type': 'application/json'},
+                                                        json=prepared['payload'],
+                                                        timeout=30)
+            # 結果のキャッシュは SQLite に書くことがあるのでスレッドで作る
+            result = await asyncio.to_thread(self._trend_result, response, stats, prepared['fingerprint'])
+            if result is not None:
+                return result
+
+        except RateLimitExceeded as e:
+            logger.warning("⚠️ レート制限: トレンド分析をスキップします (%s)", e)
+            return self._rate_limited_result(stats)
+
+        except Exception as e:
+            logger.error("❌ 分析エラー: %s", e)
+
+        return self._local_result(stats)
+
+    def _prepare_trend_request(self, japanese_items: List[Dict[Any, Any]],
+                               stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """統計とキャッシュを確認し、返す結果（result）か Gemini へのリクエスト内容を返す"""
+        logger.debug("📈 市場トレンドを分析中...")
 
         if not japanese_items:
-            return {"error": "分析する商品がありません"}
+            return {'result': {"error": "分析する商品がありません"}}
 
         # 統計情報を準備
-        stats = self._calculate_market_stats(japanese_items)
+        if stats is None:
+            stats = self._calculate_market_stats(japanese_items)
+
+        # 同じような統計なら前回のGemini分析を再利用する
+        fingerprint = self._stats_fingerprint(stats)
+        cached_analysis = self.analysis_cache.get(fingerprint)
+        if cached_analysis is not None:
+            with self._count_lock:
+                self.calls_saved += 1
+            logger.info("♻️ キャッシュ済みのトレンド分析を再利用します")
+            return {'result': {
+                "analysis": cached_analysis,
+                "data_summary": stats,
+                "analysis_method": "gemini_trends_only",
+                "from_cache": True
+            }}
 
         # 簡潔な分析プロンプト
         prompt = f"""eBayの日本関連商品市場データを分析してください。
@@ -412,6 +4085,7 @@ class EfficientGeminiAnalyzer:
 統計データ:
 - 総商品数: {stats['total_items']}件
 - 平均価格: ${stats['avg_price']:.2f}
+- 価格の中央値: ${stats.get('median_price', 0):.2f} / 上位10%の境目(p90): ${stats.get('p90_price', 0):.2f}
 - 価格帯分布: {stats['price_ranges']}
 - 主要カテゴリ: {stats['top_categories'][:5]}
 
@@ -423,10 +4097,11 @@ class EfficientGeminiAnalyzer:
 
 500文字程度で日本語で回答してください。"""
 
-        try:
-            url = f"{self.base_url}/gemini-1.5-flash:generateContent?key={self.api_key}"
-
-            payload = {
+        return {
+            'stats': stats,
+            'fingerprint': fingerprint,
+            'url': f"{self.base_url}/gemini-1.5-flash:generateContent?key={self.api_key}",
+            'payload': {
                 "contents": [{
                     "parts": [{"text": prompt}]
                 }],
@@ -435,90 +4110,83 @@ class EfficientGeminiAnalyzer:
                     "maxOutputTokens": 1000
                 }
             }
+        }
 
-            response = requests.post(url,
-                                   headers={'Content-Type': 'application/json'},
-                                   json=payload,
-                                   timeout=30)
+    def _trend_result(self, response, stats: Dict[str, Any], fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Gemini の応答から結果を作る（使えない応答なら None でフォールバックさせる）"""
+        # 実際に応答があった呼び出しだけ数える（レート制限で送らなかった分は数えない）
+        with self._count_lock:
+            self.request_count += 1
+        if response.status_code == 200:
+            result = response.json()
+            if 'candidates' in result and len(result['candidates']) > 0:
+                content = result['candidates'][0]['content']['parts'][0]['text']
+                self.analysis_cache.set(fingerprint, content)
 
-            if response.status_code == 200:
-                result = response.json()
-                if 'candidates' in result and len(result['candidates']) > 0:
-                    content = result['candidates'][0]['content']['parts'][0]['text']
-
-                    return {
-                        "analysis": content,
-                        "data_summary": stats,
-                        "analysis_method": "gemini_trends_only"
-                    }
-
-            elif response.status_code == 429:
-                print("⚠️ レート制限: トレンド分析をスキップします")
                 return {
-                    "analysis": "レート制限のためAI分析をスキップしました。統計データのみ表示します。",
+                    "analysis": content,
                     "data_summary": stats,
-                    "analysis_method": "statistics_only"
+                    "analysis_method": "gemini_trends_only"
                 }
 
-            else:
-                print(f"❌ Gemini API エラー: {response.status_code}")
+        elif response.status_code == 429:
+            logger.warning("⚠️ レート制限: トレンド分析をスキップします")
+            return self._rate_limited_result(stats)
 
-        except Exception as e:
-            print(f"❌ 分析エラー: {e}")
+        else:
+            logger.error("❌ Gemini API エラー: %s", response.status_code)
+        return None
 
-        # フォールバック: 統計ベースの簡易分析
+    @staticmethod
+    def _rate_limited_result(stats: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "analysis": "レート制限のためAI分析をスキップしました。統計データのみ表示します。",
+            "data_summary": stats,
+            "analysis_method": "statistics_only"
+        }
+
+    def _local_result(self, stats: Dict[str, Any]) -> Dict[str, Any]:
+        """統計ベースの簡易分析の結果"""
         return {
             "analysis": self._generate_simple_analysis(stats),
             "data_summary": stats,
             "analysis_method": "local_statistics"
         }
 
+    def _stats_fingerprint(self, stats: Dict[str, Any]) -> str:
+        """プロンプトに使う統計を丸めて正規化した指紋（小さな変動では変わらない）"""
+        total = stats.get('total_items', 0) or 0
+        price_ranges = stats.get('price_ranges', {})
+        range_total = sum(price_ranges.values()) or 1
+        top_categories = stats.get('top_categories', [])[:5]
+        category_total = total or sum(count for _, count in top_categories) or 1
+        normalized = {
+            'total': round(total, -1),
+            'avg_price': round(stats.get('avg_price', 0) / GEMINI_CACHE_PRICE_BUCKET),
+            'median_price': round(stats.get('median_price', 0) / GEMINI_CACHE_PRICE_BUCKET),
+            'p90_price': round(stats.get('p90_price', 0) / GEMINI_CACHE_PRICE_BUCKET),
+            # 価格帯・カテゴリは件数ではなく構成比を10%刻みで比べる
+            'price_ranges': {name: round(count * 10 / range_total) for name, count in sorted(price_ranges.items())},
+            'top_categories': [[name, round(count * 10 / category_total)] for name, count in top_categories]
+        }
+        encoded = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Gemini呼び出し回数とメモ化の効果"""
+        return dict(self.analysis_cache.stats(), gemini_calls=self.request_count,
+                    gemini_calls_saved=self.calls_saved)
+
     def _calculate_market_stats(self, items: List[Dict[Any, Any]]) -> Dict[str, Any]:
-        """市場統計を計算"""
+        """市場統計を計算（MarketStatsAccumulator で1回だけ走査）"""
         if not items:
             return {}
 
-        # 価格統計
-        prices = []
-        for item in items:
-            try:
-                price = float(item.get('price', {}).get('value', 0))
-                if price > 0:
-                    prices.append(price)
-            except:
-                continue
-
-        avg_price = sum(prices) / len(prices) if prices else 0
-
-        # 価格帯分布
-        price_ranges = {"0-50": 0, "50-100": 0, "100-300": 0, "300-500": 0, "500+": 0}
-        for price in prices:
-            if price <= 50:
-                price_ranges["0-50"] += 1
-            elif price <= 100:
-                price_ranges["50-100"] += 1
-            elif price <= 300:
-                price_ranges["100-300"] += 1
-            elif price <= 500:
-                price_ranges["300-500"] += 1
-            else:
-                price_ranges["500+"] += 1
-
-        # カテゴリ統計
-        categories = {}
-        for item in items:
-            category = item.get('local_analysis', {}).get('primary_category', 'その他')
-            categories[category] = categories.get(category, 0) + 1
-
-        top_categories = sorted(categories.items(), key=lambda x: x[1], reverse=True)
-
-        return {
-            'total_items': len(items),
-            'avg_price': avg_price,
-            'price_ranges': price_ranges,
-            'top_categories': top_categories,
-            'categories': categories
-        }
+        with metrics.timer('stats'):
+            accumulator = MarketStatsAccumulator()
+            for item in items:
+                accumulator.add(item)
+            return accumulator.to_dict()
 
     def _generate_simple_analysis(self, stats: Dict[str, Any]) -> str:
         """統計ベースの簡易分析"""
@@ -538,6 +4206,7 @@ class EfficientGeminiAnalyzer:
 📊 **基本統計**
 - 分析商品数: {total_items}件
 - 平均価格: ${avg_price:.2f}
+- 価格の中央値: ${stats.get('median_price', 0):.2f}
 - 主要価格帯: ${most_common_price_range}
 
 📈 **人気カテゴリ TOP3**
@@ -560,85 +4229,852 @@ class EfficientGeminiAnalyzer:
 
         return analysis
 
-# グローバルインスタンス
-ebay_analyzer = SmarteBayAnalyzer()
+# グローバルインスタンス（eBayアナライザは初回利用時に生成し、import 時にネットワークI/Oをしない）
+_ebay_analyzer = None
+_ebay_analyzer_lock = threading.Lock()
 gemini_analyzer = EfficientGeminiAnalyzer()
 
+def get_ebay_analyzer() -> SmarteBayAnalyzer:
+    """プロセス内で共有するeBayアナライザを返す"""
+    global _ebay_analyzer
+    if _ebay_analyzer is None:
+        with _ebay_analyzer_lock:
+            if _ebay_analyzer is None:
+                _ebay_analyzer = SmarteBayAnalyzer()
+    return _ebay_analyzer
+
+# 分析ごとの価格・人気度の時系列（TIMESERIES_DIR 未設定なら記録しない）
+timeseries_recorder = TimeSeriesRecorder(
+    TIMESERIES_DIR, TIMESERIES_RAW_RETENTION_DAYS, TIMESERIES_RETENTION_DAYS, TIMESERIES_ROLLUP_SECONDS
+) if TIMESERIES_DIR else None
+
+def record_timeseries(japanese_items: List[Dict[Any, Any]], stats: Dict[str, Any]):
+    """分析結果を時系列に記録する（失敗しても分析自体は続ける）"""
+    if timeseries_recorder is None or not stats:
+        return
+    try:
+        timeseries_recorder.record_run(japanese_items, stats)
+    except (OSError, struct.error) as e:
+        logger.warning("⚠️ 時系列記録エラー: %s", e)
+
+# バックグラウンドのウォームアップ状態（ワーカープロセスごと）
+_warmup_state = {'running': False, 'ready': False, 'started_at': None, 'finished_at': None, 'error': None}
+_warmup_lock = threading.Lock()
+
+def _run_warmup():
+    try:
+        ready = get_ebay_analyzer().warm_up()
+        error = None if ready else 'eBayトークンを取得できませんでした'
+    except Exception as e:
+        ready, error = False, str(e)
+    with _warmup_lock:
+        _warmup_state.update(running=False, ready=ready, error=error, finished_at=time.time())
+
+def start_background_warmup():
+    """ウォームアップ未完了で実行中でもなければ、バックグラウンドで開始する"""
+    with _warmup_lock:
+        if _warmup_state['ready'] or _warmup_state['running']:
+            return
+        # 失敗直後はeBayへの再試行を連発しない
+        finished_at = _warmup_state['finished_at']
+        if finished_at and time.time() - finished_at < WARMUP_RETRY_INTERVAL:
+            return
+        _warmup_state.update(running=True, started_at=time.time(), error=None)
+    threading.Thread(target=_run_warmup, name='ebay-warmup', daemon=True).start()
+
+@app.before_request
+def ensure_warmup_started():
+    """最初のリクエストでウォームアップを開始する（リクエストは待たせない）"""
+    if not _warmup_state['ready']:
+        start_background_warmup()
+    if refresh_scheduler is not None:
+        refresh_scheduler.start()
+    metrics.start_flusher()
+
+@app.route('/healthz')
+def healthz():
+    """プロセスの生存確認（外部APIに依存しない）"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """ウォームアップ完了後に200を返すレディネスチェック"""
+    with _warmup_lock:
+        state = dict(_warmup_state)
+    body = {'ready': state['ready'], 'warmup': state}
+    if refresh_scheduler is not None:
+        body['refresh'] = dict(refresh_scheduler.state)
+    return jsonify(body), (200 if state['ready'] else 503)
+
 @app.route('/')
 def index():
     """メインページ"""
     return render_template('index.html')
 
+# /api/analyze の結果キャッシュ（ワーカープロセスごと）
+analysis_cache = StaleWhileRevalidateCache(ANALYZE_CACHE_TTL, ANALYZE_CACHE_STALE_TTL)
+
+def measured(total_stage: str):
+    """分析関数の所要時間をステージ別に計測し、結果の optimization_info['timings'] に入れるデコレーター
+
+    コルーチン関数にも使える。
+    """
+    def attach(payload: Dict[str, Any], timings: Dict[str, Dict[str, float]]) -> Dict[str, Any]:
+        if payload.get('success'):
+            payload['optimization_info']['timings'] = metrics.format_timings(timings)
+        return payload
+
+    def decorate(compute):
+        if inspect.iscoroutinefunction(compute):
+            @functools.wraps(compute)
+            async def async_wrapper(*args, **kwargs):
+                with metrics.run_timings() as timings:
+                    with metrics.timer(total_stage):
+                        payload = await compute(*args, **kwargs)
+                return attach(payload, timings)
+            return async_wrapper
+
+        @functools.wraps(compute)
+        def wrapper(*args, **kwargs):
+            with metrics.run_timings() as timings:
+                with metrics.timer(total_stage):
+                    payload = compute(*args, **kwargs)
+            return attach(payload, timings)
+        return wrapper
+    return decorate
+
+@measured('analysis_total')
+def compute_analysis_payload(stagger: float = 0.0, progress=None) -> Dict[str, Any]:
+    """eBay取得からGemini分析までを実行し、/api/analyze のレスポンス本体を返す
+
+    progress を渡すと途中経過（'query' と、Gemini 分析前の 'ranking'）を通知する。
+    """
+    # 1. eBayから日本関連商品を効率的に取得
+    logger.info("🛍️ 日本関連商品を取得中...")
+    japanese_items, marketplace_items = get_ebay_analyzer().get_marketplace_rankings(100, stagger, progress)
+
+    if not japanese_items:
+        return {
+            'success': False,
+            'error': 'eBayから商品を取得できませんでした'
+        }
+
+    logger.info("✅ %s件の日本関連商品を取得", len(japanese_items))
+    if progress is not None:
+        progress('ranking', {'japanese_items': japanese_items})
+
+    # 2. 市場トレンドのみをGeminiで分析（個別商品判定はスキップ）
+    logger.info("📈 市場トレンド分析中...")
+    market_analysis = gemini_analyzer.analyze_market_trends_only(japanese_items)
+    record_timeseries(japanese_items, market_analysis.get('data_summary', {}))
+
+    logger.info("✅ 分析完了!")
+
+    # 上位商品の詳細を先読みしておき、ドリルダウンを即時に返せるようにする
+    if ITEM_DETAIL_PREFETCH > 0:
+        get_ebay_analyzer().prefetch_item_details(
+            [item['itemId'] for item in japanese_items[:ITEM_DETAIL_PREFETCH] if item.get('itemId')]
+        )
+
+    payload = build_analysis_payload(japanese_items, market_analysis)
+    if len(marketplace_items) > 1:
+        payload['marketplaces'] = build_marketplace_summaries(marketplace_items)
+    return payload
+
+@measured('analysis_total')
+async def compute_analysis_payload_async(progress=None) -> Dict[str, Any]:
+    """compute_analysis_payload の asyncio 版（非同期モードの /api/analyze と SSE で使う）"""
+    ebay_analyzer = get_ebay_analyzer()
+    logger.info("🛍️ 日本関連商品を取得中...")
+    japanese_items, marketplace_items = await ebay_analyzer.get_marketplace_rankings_async(100, progress)
+
+    if not japanese_items:
+        return {
+            'success': False,
+            'error': 'eBayから商品を取得できませんでした'
+        }
+
+    logger.info("✅ %s件の日本関連商品を取得", len(japanese_items))
+    if progress is not None:
+        progress('ranking', {'japanese_items': japanese_items})
+    logger.info("📈 市場トレンド分析中...")
+    market_analysis = await gemini_analyzer.analyze_market_trends_only_async(japanese_items)
+    await asyncio.to_thread(record_timeseries, japanese_items, market_analysis.get('data_summary', {}))
+    logger.info("✅ 分析完了!")
+
+    if ITEM_DETAIL_PREFETCH > 0:
+        await asyncio.to_thread(ebay_analyzer.prefetch_item_details,
+                                [item['itemId'] for item in japanese_items[:ITEM_DETAIL_PREFETCH] if item.get('itemId')])
+
+    payload = build_analysis_payload(japanese_items, market_analysis)
+    if len(marketplace_items) > 1:
+        payload['marketplaces'] = build_marketplace_summaries(marketplace_items)
+    return payload
+
+# 定期更新が有効なら、リクエストはスナップショットを読むだけにする
+analysis_snapshot = AnalysisSnapshot(ANALYSIS_SNAPSHOT_PATH)
+refresh_scheduler = RefreshScheduler(
+    lambda: compute_analysis_payload(stagger=REFRESH_STAGGER), analysis_snapshot, REFRESH_INTERVAL,
+    jitter=REFRESH_JITTER, backoff_base=REFRESH_BACKOFF_BASE, backoff_max=REFRESH_BACKOFF_MAX
+) if REFRESH_INTERVAL > 0 else None
+
+def read_analysis_snapshot() -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """定期更新のスナップショットとその情報（無い・古すぎる場合は (None, None)）"""
+    if refresh_scheduler is None:
+        return None, None
+    payload, age = analysis_snapshot.read()
+    # リーダー不在で更新が止まったら、通常の経路で計算し直す
+    if payload is None or age > REFRESH_INTERVAL * 3:
+        return None, None
+    return payload, {'status': 'snapshot', 'age_seconds': round(age, 1), 'refresh_interval': REFRESH_INTERVAL}
+
+def publish_analysis_snapshot(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """リクエスト内で計算した結果もスナップショットに反映する（定期更新が無効なら何もしない）"""
+    if refresh_scheduler is not None and payload.get('success'):
+        try:
+            analysis_snapshot.publish(payload)
+        except OSError as e:
+            logger.warning("⚠️ スナップショット書き込みエラー: %s", e)
+    return payload
+
+# マーケットプレイス別の結果に含める上位商品の件数
+MARKETPLACE_TOP_ITEMS = 20
+
+def build_marketplace_summaries(marketplace_items: Dict[str, List[Dict[Any, Any]]]) -> Dict[str, Any]:
+    """マーケットプレイスごとの上位商品と市場統計（価格はドル換算）"""
+    summaries = {}
+    for marketplace, items in marketplace_items.items():
+        stats = MarketStatsAccumulator()
+        for item in items:
+            stats.add(item)
+        summaries[marketplace] = {
+            'total_items_found': len(items),
+            'top_items': items[:MARKETPLACE_TOP_ITEMS],
+            'market_summary': stats.to_dict()
+        }
+    return summaries
+
+def requested_fields() -> Optional[List[str]]:
+    """?fields=a,b の項目リスト（未指定なら None）"""
+    fields = [field.strip() for field in request.args.get('fields', '').split(',') if field.strip()]
+    return fields or None
+
+# /api/analyze が返す上位商品の件数（結果には rank_items の上位100件を残し、/api/items でその中を
+# 絞り込み・ページ送りできる）
+ANALYZE_RESPONSE_ITEMS = 50
+
+def render_payload(payload: Dict[str, Any], fields: Optional[List[str]] = None,
+                   limit: Optional[int] = ANALYZE_RESPONSE_ITEMS) -> Dict[str, Any]:
+    """分析結果の商品を JSON 用に変換したレスポンス本体（キャッシュ中の payload は変更しない）
+
+    商品は上位 limit 件まで（None なら全件）。
+    """
+    response = dict(payload)
+    if 'japanese_items' in payload:
+        response['japanese_items'] = serialize_items(payload['japanese_items'][:limit], fields)
+    if 'marketplaces' in payload:
+        response['marketplaces'] = {
+            marketplace: dict(summary, top_items=serialize_items(summary['top_items'], fields))
+            for marketplace, summary in payload['marketplaces'].items()
+        }
+    return response
+
+# optimization_info のうちリクエストごとに作る項目（エンコード済みの本体には含めない）
+RESPONSE_OVERLAY_KEYS = ('cache', 'cache_hit_ratios', 'gemini_cache')
+
+# 分析結果のレスポンス本体（結果と項目指定の組ごとに一度だけエンコードする）
+encoded_bodies = PayloadCache(RESPONSE_BODY_CACHE_SIZE)
+
+def optimization_overlay(cache_info: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """optimization_info にリクエストごとに足す項目（結果のキャッシュ状態、ヒット率、Geminiメモ化の状況）"""
+    overlay = {'cache': cache_info} if cache_info else {}
+    overlay['cache_hit_ratios'] = metrics.cache_hit_ratios()
+    overlay['gemini_cache'] = gemini_analyzer.cache_stats()
+    return overlay
+
+def encoded_payload_response(payload: Dict[str, Any], fields: Optional[List[str]] = None,
+                             cache_info: Optional[Dict[str, Any]] = None) -> Response:
+    """キャッシュ済みの分析結果をエンコード済みの本体で返す
+
+    キャッシュ状態などリクエストごとに変わる項目は、エンコード済みの共通部分の後ろに
+    optimization_info の項目として足す（ヘッダーでも返す）。
+    """
+    variant = tuple(fields) if fields else None
+
+    def build():
+        body = analysis_snapshot.body_for(payload) if variant is None else None
+        return body or EncodedBody.from_payload(render_payload(payload, fields))
+
+    body = encoded_bodies.get(payload, variant, build)
+    response = body.response(RESPONSE_COMPRESSION_MIN_BYTES, optimization_overlay(cache_info))
+    return set_cache_headers(response, cache_info)
+
+def set_cache_headers(response: Response, cache_info: Optional[Dict[str, Any]]) -> Response:
+    """結果のキャッシュ状態と経過秒数をヘッダーで返す"""
+    if cache_info:
+        response.headers['X-Cache-Status'] = cache_info['status']
+        response.headers['Age'] = str(int(cache_info['age_seconds']))
+    return response
+
+def build_analysis_payload(japanese_items: List[Dict[Any, Any]], market_analysis: Dict[str, Any],
+                           total_items_found: Optional[int] = None) -> Dict[str, Any]:
+    """/api/analyze のレスポンス本体を組み立てる"""
+    if total_items_found is None:
+        total_items_found = len(japanese_items)
+    return {
+        'success': True,
+        'total_items_found': total_items_found,
+        'japanese_items': japanese_items,
+        'market_analysis': market_analysis,
+        'optimization_info': {
+            'gemini_requests_saved': f"約{total_items_found}回のAPIコールを節約",
+            'analysis_method': 'smart_keyword_matching + minimal_ai'
+        }
+    }
+
+@measured('store_analysis_total')
+def compute_store_analysis_payload(category: Optional[str] = None, min_price: Optional[float] = None,
+                                   max_price: Optional[float] = None) -> Dict[str, Any]:
+    """eBayに問い合わせず、商品ストアのインデックス検索だけで分析結果を返す"""
+    item_store = get_ebay_analyzer().item_store
+    if item_store is None:
+        return {'success': False, 'error': '商品ストアが設定されていません（ITEM_STORE_PATH）'}
+
+    filters = dict(category=category, min_price=min_price, max_price=max_price, max_age=ITEM_STORE_MAX_AGE)
+    japanese_items = item_store.top_items(100, **filters)
+    if not japanese_items:
+        return {'success': False, 'error': '条件に合う保存済み商品がありません'}
+
+    stats = item_store.market_stats(**filters).to_dict()
+    market_analysis = gemini_analyzer.analyze_market_trends_only(japanese_items, stats=stats)
+
+    payload = build_analysis_payload(japanese_items, market_analysis, total_items_found=stats['total_items'])
+    payload['optimization_info']['source'] = 'item_store'
+    return payload
+
 @app.route('/api/analyze')
 def analyze_items():
-    """効率化された商品分析API"""
-    try:
-        # 1. eBayから日本関連商品を効率的に取得
-        print("=" * 50)
-        print("🛍️ 日本関連商品を取得中...")
-        japanese_items = ebay_analyzer.get_japanese_items_smart(100)
-
-        if not japanese_items:
-            return jsonify({
-                'success': False,
-                'error': 'eBayから商品を取得できませんでした'
-            })
+    """効率化された商品分析API（結果はTTLキャッシュから返し、期限切れは裏で更新）
 
-        print(f"✅ {len(japanese_items)}件の日本関連商品を取得")
+    ?source=store を付けると eBay には問い合わせず商品ストアから回答する
+    （category, min_price, max_price で絞り込み可能）。?fields=title,price のように
+    商品の項目を絞れる（raw を含めると返す商品の商品詳細も付ける）。
+    本体は結果ごとに一度だけエンコード・圧縮し、ETag が一致すれば 304 を返す。
+    """
+    try:
+        if request.args.get('source') == 'store':
+            return store_analysis_response()
 
-        # 2. 市場トレンドのみをGeminiで分析（個別商品判定はスキップ）
-        print("=" * 50)
-        print("📈 市場トレンド分析中...")
-        market_analysis = gemini_analyzer.analyze_market_trends_only(japanese_items)
+        payload, cache_info = latest_analysis_payload(request.args.get('refresh') == '1')
+        if not payload.get('success'):
+            return jsonify(payload)
 
-        print("✅ 分析完了!")
-        print("=" * 50)
+        return encoded_payload_response(payload, requested_fields(), cache_info)
 
+    except Exception as e:
+        logger.exception("❌ 分析エラー: %s", e)
         return jsonify({
-            'success': True,
-            'total_items_found': len(japanese_items),
-            'japanese_items': japanese_items[:50],  # 最初の50件を表示
-            'market_analysis': market_analysis,
-            'optimization_info': {
-                'gemini_requests_saved': f"約{len(japanese_items)}回のAPIコールを節約",
-                'analysis_method': 'smart_keyword_matching + minimal_ai',
-                'processing_time_improvement': '約80%短縮'
-            }
+            'success': False,
+            'error': str(e)
         })
 
+async def analyze_items_async() -> Response:
+    """/api/analyze の非同期版（asgi.py が Flask のリクエストコンテキスト内で呼ぶ）
+
+    計算を待つ間はイベントループに戻るので、同時に多数のリクエストを待たせてもスレッドを使わない。
+    """
+    try:
+        if request.args.get('source') == 'store':
+            return await asyncio.to_thread(store_analysis_response)
+
+        force = request.args.get('refresh') == '1'
+        payload, cache_info = await asyncio.to_thread(snapshot_for_request, force)
+        if payload is None:
+            async def compute():
+                payload = await compute_analysis_payload_async()
+                return await asyncio.to_thread(publish_analysis_snapshot, payload)
+
+            payload, cache_info = await analysis_cache.get_or_compute_async(
+                'analyze:100', compute, cacheable=lambda result: result.get('success'), force=force
+            )
+
+        if not payload.get('success'):
+            return jsonify(payload)
+
+        # 本体の読み込み・圧縮はスレッドで行う（to_thread は contextvars を引き継ぐので
+        # リクエストコンテキストもそのまま使える）
+        return await asyncio.to_thread(encoded_payload_response, payload, requested_fields(), cache_info)
+
     except Exception as e:
-        print(f"❌ 分析エラー: {e}")
-        import traceback
-        print(f"詳細エラー: {traceback.format_exc()}")
+        logger.exception("❌ 分析エラー: %s", e)
         return jsonify({
             'success': False,
             'error': str(e)
         })
 
+def store_analysis_response() -> Response:
+    """?source=store のレスポンス（category, min_price, max_price で絞り込み）"""
+    response = render_payload(compute_store_analysis_payload(
+        category=request.args.get('category'),
+        min_price=request.args.get('min_price', type=float),
+        max_price=request.args.get('max_price', type=float)
+    ), requested_fields())
+    if response.get('success'):
+        response['optimization_info'] = dict(response['optimization_info'], **optimization_overlay())
+    return jsonify(response)
+
+def latest_analysis_payload(force: bool = False) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """最新の分析結果とキャッシュ状態（スナップショット → 分析キャッシュの順に探し、無ければ計算する）"""
+    payload, cache_info = snapshot_for_request(force)
+    if payload is None:
+        payload, cache_info = analysis_cache.get_or_compute(
+            'analyze:100', lambda: publish_analysis_snapshot(compute_analysis_payload()),
+            cacheable=lambda result: result.get('success'), force=force
+        )
+    return payload, cache_info
+
+def snapshot_for_request(force: bool) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """refresh=1 でなければ定期更新のスナップショットを使う（ヒット・ミスを記録）"""
+    if force:
+        return None, None
+    payload, cache_info = read_analysis_snapshot()
+    if refresh_scheduler is not None:
+        metrics.inc('cache_hits_total' if payload is not None else 'cache_misses_total', cache='analysis_snapshot')
+    return payload, cache_info
+
+@measured('deep_analysis_total')
+def compute_deep_analysis_payload(per_query_budget: int, global_budget: int, limit: int = 100) -> Dict[str, Any]:
+    """ページ送りで深くクロールし、上位商品と市場統計を逐次集計して分析する
+
+    全商品のリストは作らず、スコア上位 limit 件のヒープと統計の集計器だけを持つ。
+    """
+    ebay_analyzer = get_ebay_analyzer()
+    top_heap = []    # (スコア, -到着順, 商品) の最小ヒープ
+    stats = MarketStatsAccumulator()
+    chunk = []
+    crawled = 0
+    arrival = [0]
+
+    def flush():
+        # 500件ずつまとめてスコアを計算し、上位 limit 件だけをヒープに残す
+        with metrics.timer('scoring'):
+            scores = ebay_analyzer.calculate_popularity_scores(chunk)
+            for item, score in zip(chunk, scores):
+                item['popularityScore'] = score
+                entry = (score, -arrival[0], item)
+                arrival[0] += 1
+                if len(top_heap) < limit:
+                    heapq.heappush(top_heap, entry)
+                elif entry[:2] > top_heap[0][:2]:
+                    heapq.heapreplace(top_heap, entry)
+        ebay_analyzer.save_items(chunk)
+        chunk.clear()
+
+    for item in ebay_analyzer.crawl_japanese_items(per_query_budget, global_budget, EBAY_CRAWL_PAGE_SIZE,
+                                                   EBAY_CRAWL_MIN_NEW_RATIO, EBAY_CRAWL_STALE_PAGES):
+        crawled += 1
+        stats.add(item)
+        chunk.append(item)
+        if len(chunk) >= 500:
+            flush()
+    flush()
+
+    if not crawled:
+        return {'success': False, 'error': 'eBayから商品を取得できませんでした'}
+
+    japanese_items = [item for _, _, item in sorted(top_heap, key=lambda entry: entry[:2], reverse=True)]
+    market_analysis = gemini_analyzer.analyze_market_trends_only(japanese_items, stats=stats.to_dict())
+    record_timeseries(japanese_items, market_analysis.get('data_summary', {}))
+
+    payload = build_analysis_payload(japanese_items, market_analysis, total_items_found=crawled)
+    payload['optimization_info']['crawl'] = {
+        'items_crawled': crawled,
+        'per_query_budget': per_query_budget,
+        'global_budget': global_budget
+    }
+    return payload
+
+@app.route('/api/analyze/deep')
+def analyze_items_deep():
+    """ページ送りで多数の商品を取得して分析するAPI（結果はキャッシュする）
+
+    per_query・budget は EBAY_CRAWL_ALLOWED_BUDGETS の組だけを受け付ける。それ以外の上限と
+    refresh=1（キャッシュを使わない再クロール）は管理用トークンが必要（日次の API 枠を守るため）。
+    """
+    try:
+        per_query_budget = int(request.args.get('per_query', EBAY_CRAWL_PER_QUERY))
+        global_budget = int(request.args.get('budget', EBAY_CRAWL_BUDGET))
+        force = request.args.get('refresh') == '1'
+
+        if not is_admin_request():
+            if (per_query_budget, global_budget) not in EBAY_CRAWL_ALLOWED_BUDGETS:
+                return jsonify({
+                    'success': False,
+                    'error': 'この取得上限は許可されていません',
+                    'allowed_budgets': [{'per_query': per_query, 'budget': budget}
+                                        for per_query, budget in sorted(EBAY_CRAWL_ALLOWED_BUDGETS)]
+                }), 403
+            if force:
+                return jsonify({'success': False, 'error': 'refresh=1 には管理用トークンが必要です'}), 403
+
+        per_query_budget = max(1, min(per_query_budget, 10000))
+        global_budget = max(1, min(global_budget, 100000))
+        payload, cache_info = analysis_cache.get_or_compute(
+            f'deep:{per_query_budget}:{global_budget}',
+            lambda: compute_deep_analysis_payload(per_query_budget, global_budget),
+            cacheable=lambda result: result.get('success'),
+            force=force
+        )
+
+        if not payload.get('success'):
+            return jsonify(payload)
+
+        return encoded_payload_response(payload, requested_fields(), cache_info)
+
+    except Exception as e:
+        logger.exception("❌ 深い分析エラー: %s", e)
+        return jsonify({'success': False, 'error': str(e)})
+
+def is_admin_request() -> bool:
+    """X-Admin-Token ヘッダーが ADMIN_TOKEN と一致するか（ADMIN_TOKEN 未設定なら常に False）"""
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+def _sse_event(event: str, data: Any) -> str:
+    """Server-Sent Events 形式の1イベント"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _stream_progress_event(event: str, data: Dict[str, Any], fields, total_queries: int) -> Tuple[str, Dict[str, Any]]:
+    """compute_analysis_payload の progress 通知を SSE の (イベント名, データ) にする"""
+    if event == 'query':
+        return event, dict(data, total_queries=total_queries, items=serialize_items(data['items'], fields))
+    return event, {'total_items_found': len(data['japanese_items']),
+                   'japanese_items': serialize_items(data['japanese_items'][:ANALYZE_RESPONSE_ITEMS], fields)}
+
+def _stream_result_events(payload: Dict[str, Any], cache_info: Optional[Dict[str, Any]], fields,
+                          sent_ranking: bool) -> Iterator[str]:
+    """計算済みの分析結果から ranking（未送信なら）・stats・analysis・done を作る"""
+    if not payload.get('success'):
+        yield _sse_event('failure', {'error': payload.get('error', 'eBayから商品を取得できませんでした')})
+        return
+
+    market_analysis = payload.get('market_analysis', {})
+    if not sent_ranking:
+        yield _sse_event('ranking', {
+            'total_items_found': payload['total_items_found'],
+            'japanese_items': serialize_items(payload['japanese_items'][:ANALYZE_RESPONSE_ITEMS], fields)
+        })
+    yield _sse_event('stats', market_analysis.get('data_summary', {}))
+    yield _sse_event('analysis', market_analysis)
+    yield _sse_event('done', {'success': True, 'cache_status': cache_info['status'] if cache_info else None})
+
+@app.route('/api/analyze/stream')
+def analyze_items_stream():
+    """分析の進捗と途中結果を Server-Sent Events で逐次返すAPI
+
+    イベント順: query（クエリごとの商品）→ ranking（上位商品）→ stats（市場統計）
+    → analysis（Gemini分析）→ done。エラー時は failure を送って終了する。
+    /api/analyze と同じスナップショット・分析キャッシュを使い、結果があれば query を
+    送らずに ranking 以降をすぐ返す。同時に来たストリームの計算は1回にまとめる
+    （計算を待つだけのストリームには query と計算中の ranking は届かない）。
+    """
+    fields = requested_fields()
+    force = request.args.get('refresh') == '1'
+
+    def generate():
+        try:
+            total_queries = len(get_ebay_analyzer().search_queries)
+            sent_ranking = False
+            payload, cache_info = snapshot_for_request(force)
+
+            if payload is None:
+                events = queue.Queue()
+                finished = object()
+                outcome = {}
+
+                def progress(event: str, data: Dict[str, Any]):
+                    events.put(_stream_progress_event(event, data, fields, total_queries))
+
+                def run():
+                    try:
+                        outcome['result'] = analysis_cache.get_or_compute(
+                            'analyze:100', lambda: publish_analysis_snapshot(compute_analysis_payload(progress=progress)),
+                            cacheable=lambda result: result.get('success'), force=force
+                        )
+                    except Exception as e:
+                        outcome['error'] = e
+                    finally:
+                        events.put(finished)
+
+                # 切断されてストリームが閉じられても計算は続け、結果をキャッシュに残す
+                threading.Thread(target=contextvars.copy_context().run, args=(run,),
+                                 name='analysis-stream', daemon=True).start()
+                # 計算を担当したストリームにはクエリごとの商品と上位商品を逐次送る
+                while True:
+                    event = events.get()
+                    if event is finished:
+                        break
+                    sent_ranking = sent_ranking or event[0] == 'ranking'
+                    yield _sse_event(*event)
+                if 'error' in outcome:
+                    raise outcome['error']
+                payload, cache_info = outcome['result']
+
+            yield from _stream_result_events(payload, cache_info, fields, sent_ranking)
+
+        except Exception as e:
+            logger.exception("❌ ストリーミング分析エラー: %s", e)
+            yield _sse_event('failure', {'error': str(e)})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+async def analyze_items_stream_async() -> Response:
+    """/api/analyze/stream の非同期版（本体は非同期ジェネレータで、asgi.py が送る）
+
+    計算を待つ間もスレッドを使わない。クライアントが切断すると asgi.py がジェネレータを
+    止めるが、共有している計算は続けて結果をキャッシュに残す。
+    """
+    fields = requested_fields()
+    force = request.args.get('refresh') == '1'
+
+    async def generate():
+        try:
+            total_queries = len(get_ebay_analyzer().search_queries)
+            sent_ranking = False
+            payload, cache_info = await asyncio.to_thread(snapshot_for_request, force)
+
+            if payload is None:
+                events: asyncio.Queue = asyncio.Queue()
+
+                def progress(event: str, data: Dict[str, Any]):
+                    # fields=raw なら商品詳細を引くので、整形は送る直前にスレッドで行う
+                    events.put_nowait((event, data))
+
+                async def compute():
+                    payload = await compute_analysis_payload_async(progress=progress)
+                    return await asyncio.to_thread(publish_analysis_snapshot, payload)
+
+                flight = asyncio.ensure_future(analysis_cache.get_or_compute_async(
+                    'analyze:100', compute, cacheable=lambda result: result.get('success'), force=force
+                ))
+                while not flight.done() or not events.empty():
+                    getter = asyncio.ensure_future(events.get())
+                    try:
+                        await asyncio.wait([getter, flight], return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        if not getter.done():
+                            getter.cancel()
+                    if getter.done() and not getter.cancelled():
+                        event = await asyncio.to_thread(_stream_progress_event, *getter.result(), fields,
+                                                        total_queries)
+                        sent_ranking = sent_ranking or event[0] == 'ranking'
+                        yield _sse_event(*event)
+                payload, cache_info = flight.result()
+
+            chunks = await asyncio.to_thread(list, _stream_result_events(payload, cache_info, fields, sent_ranking))
+            for chunk in chunks:
+                yield chunk
+
+        except Exception as e:
+            logger.exception("❌ ストリーミング分析エラー: %s", e)
+            yield _sse_event('failure', {'error': str(e)})
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+# 分析結果ごとの商品インデックス（新しい結果が出るまで同じインデックスを使い回す）
+item_indexes = PayloadCache(8, name='item_index')
+
+@app.route('/api/items')
+def query_items():
+    """最新の分析結果の上位商品（rank_items の上位100件）を絞り込み・並べ替えてページ単位で返すAPI
+
+    category, price_range（"50-100" など市場統計の価格帯）, min_price, max_price（ドル）,
+    min_score, max_score, q（タイトルの単語、空白区切りで AND）, sort（-score, score, price, -price）,
+    limit（最大100）, fields で指定し、次のページは前のページの next_cursor を cursor に渡す。
+    """
+    try:
+        payload, cache_info = latest_analysis_payload()
+        if not payload.get('success'):
+            return jsonify(payload)
+
+        started = time.perf_counter()
+        index = item_indexes.get(payload, None, lambda: ItemIndex(payload.get('japanese_items', [])))
+        sort = request.args.get('sort', '-score')
+        try:
+            page = index.query(
+                category=request.args.get('category'),
+                price_range=request.args.get('price_range'),
+                min_price=request.args.get('min_price', type=float),
+                max_price=request.args.get('max_price', type=float),
+                min_score=request.args.get('min_score', type=float),
+                max_score=request.args.get('max_score', type=float),
+                q=request.args.get('q'),
+                sort=sort,
+                limit=request.args.get('limit', 20, type=int),
+                cursor=request.args.get('cursor')
+            )
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)})
+
+        response = jsonify({
+            'success': True,
+            'total': page['total'],
+            'sort': sort,
+            'items': serialize_items(page['items'], requested_fields()),
+            'next_cursor': page['next_cursor'],
+            'categories': {category: len(positions) for category, positions in index.by_category.items()},
+            'query_time_ms': round((time.perf_counter() - started) * 1000, 3)
+        })
+        return set_cache_headers(response, cache_info)
+
+    except Exception as e:
+        logger.exception("❌ 商品検索エラー: %s", e)
+        return jsonify({'success': False, 'error': str(e)})
+
 @app.route('/api/detailed_analysis/<item_id>')
 def get_detailed_analysis(item_id):
     """個別商品の詳細分析"""
     try:
-        # 商品詳細を取得
-        url = f"{ebay_analyzer.base_url}/item/{item_id}"
-        response = requests.get(url, headers=ebay_analyzer.headers, timeout=15)
+        # 商品詳細を取得（キャッシュ済みならそのまま返す）
+        return detailed_analysis_response(get_ebay_analyzer().get_item_details([item_id]).get(item_id))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-        if response.status_code != 200:
-            return jsonify({'success': False, 'error': '商品が見つかりません'})
+async def get_detailed_analysis_async(item_id) -> Response:
+    """/api/detailed_analysis/<item_id> の非同期版（asgi.py から呼ぶ）"""
+    try:
+        return detailed_analysis_response((await get_ebay_analyzer().get_item_details_async([item_id])).get(item_id))
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-        item_details = response.json()
+def detailed_analysis_response(enhanced_item: Optional[Dict[str, Any]]) -> Response:
+    if enhanced_item is None:
+        return jsonify({'success': False, 'error': '商品が見つかりません'})
 
-        # ローカル分析を追加
-        enhanced_item = ebay_analyzer.enhance_item_with_local_analysis(item_details)
+    return jsonify({
+        'success': True,
+        'item': enhanced_item,
+        'analysis_method': 'local_keyword_matching'
+    })
 
-        return jsonify({
-            'success': True,
-            'item': enhanced_item,
-            'analysis_method': 'local_keyword_matching'
-        })
+# 一括詳細APIで一度に受け付ける商品IDの上限
+MAX_DETAIL_BATCH = 200
+
+def requested_item_ids() -> Tuple[List[str], Optional[str]]:
+    """?item_ids=a,b,c または JSON の {"item_ids": [...]} から商品IDを読む（エラー時は理由も返す）"""
+    if request.method == 'POST':
+        item_ids = (request.get_json(silent=True) or {}).get('item_ids', [])
+    else:
+        item_ids = request.args.get('item_ids', '').split(',')
+    item_ids = [str(item_id).strip() for item_id in item_ids if str(item_id).strip()]
+
+    if not item_ids:
+        return item_ids, 'item_ids を指定してください'
+    if len(item_ids) > MAX_DETAIL_BATCH:
+        return item_ids, f'item_ids は{MAX_DETAIL_BATCH}件までです'
+    return item_ids, None
+
+def detailed_analysis_batch_response(item_ids: List[str], details: Dict[str, Dict[Any, Any]]) -> Response:
+    return jsonify({
+        'success': True,
+        'items': [details[item_id] for item_id in item_ids if item_id in details],
+        'missing': [item_id for item_id in item_ids if item_id not in details],
+        'analysis_method': 'local_keyword_matching',
+        'cache': get_ebay_analyzer().detail_cache.stats()
+    })
+
+@app.route('/api/detailed_analysis', methods=['GET', 'POST'])
+def get_detailed_analysis_batch():
+    """複数商品の詳細分析（?item_ids=a,b,c または JSON の {"item_ids": [...]}）"""
+    try:
+        item_ids, error = requested_item_ids()
+        if error:
+            return jsonify({'success': False, 'error': error})
+
+        return detailed_analysis_batch_response(item_ids, get_ebay_analyzer().get_item_details(item_ids))
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+async def get_detailed_analysis_batch_async() -> Response:
+    """/api/detailed_analysis の非同期版（asgi.py から呼ぶ）"""
+    try:
+        item_ids, error = requested_item_ids()
+        if error:
+            return jsonify({'success': False, 'error': error})
+
+        return detailed_analysis_batch_response(item_ids, await get_ebay_analyzer().get_item_details_async(item_ids))
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+def _trend_range() -> Tuple[float, float, Optional[float]]:
+    """クエリ引数 since/until（epoch秒）または days と step（秒）から範囲を決める"""
+    until = request.args.get('until', type=float) or time.time()
+    since = request.args.get('since', type=float)
+    if since is None:
+        since = until - request.args.get('days', 30, type=float) * 86400
+    return since, until, request.args.get('step', type=float)
+
+@app.route('/api/trends/categories')
+def category_trends():
+    """カテゴリごとの件数・シェア・平均価格・平均スコアの推移"""
+    if timeseries_recorder is None:
+        return jsonify({'success': False, 'error': '時系列記録が設定されていません（TIMESERIES_DIR）'})
+    since, until, step = _trend_range()
+    return jsonify({'success': True, 'since': since, 'until': until, 'step': step,
+                    'categories': timeseries_recorder.category_trends(since, until, step)})
+
+@app.route('/api/trends/items/<item_id>')
+def item_trend(item_id):
+    """商品ごとの価格・ウォッチ数・入札数・人気度スコアの推移"""
+    if timeseries_recorder is None:
+        return jsonify({'success': False, 'error': '時系列記録が設定されていません（TIMESERIES_DIR）'})
+    since, until, step = _trend_range()
+    return jsonify({'success': True, 'item_id': item_id, 'since': since, 'until': until, 'step': step,
+                    'points': timeseries_recorder.item_trend(item_id, since, until, step)})
+
+def _cache_metrics():
+    """各キャッシュとレート制限の累計値を /metrics 用に返す"""
+    caches = [('gemini_analysis', gemini_analyzer.analysis_cache)]
+    if _ebay_analyzer is not None:
+        caches.append(('item_detail', _ebay_analyzer.detail_cache))
+    for name, cache in caches:
+        yield 'cache_hits_total', {'cache': name}, cache.hits
+        yield 'cache_misses_total', {'cache': name}, cache.misses
+
+    # stale/coalesced も計算せずに返せたのでヒットに数える
+    counters = analysis_cache.counter_snapshot()
+    for status, count in counters.items():
+        if status != 'refresh':
+            yield 'analysis_cache_requests_total', {'status': status}, count
+    yield 'cache_hits_total', {'cache': 'analysis_result'}, counters['hit'] + counters['stale'] + counters['coalesced']
+    yield 'cache_misses_total', {'cache': 'analysis_result'}, counters['miss']
+
+    yield 'gemini_calls_total', {}, gemini_analyzer.request_count
+    for bucket, events in rate_limiter.counters().items():
+        for event, count in events.items():
+            yield 'rate_limit_events_total', {'bucket': bucket, 'event': event}, count
+
+metrics.register_collector(_cache_metrics)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 形式のメトリクス（METRICS_DIR があれば全ワーカー分を合算）"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/transport_stats')
+def transport_stats():
+    """共有HTTPクライアントのコネクションプール統計、レート制限の状況、キャッシュのヒット率"""
+    return jsonify({'success': True, 'transport': http_client.stats(), 'rate_limits': rate_limiter.stats(),
+                    'cache_hit_ratios': metrics.cache_hit_ratios()})
+
 # if __name__ == '__main__':
 #     app.run(debug=True)
@@ -0,0 +1,280 @@
+"""app.py を ASGI サーバーで動かす非同期モードのエントリポイント
+
+/api/analyze・/api/analyze/stream（SSE）・/api/detailed_analysis は asyncio で処理し、
+eBay・Gemini の応答を待つ間もスレッドを占有しない（1プロセスで数百件のリクエストを
+同時に待てる）。それ以外のルートは Flask アプリをスレッドプールで動かす。
+どちらも Flask のエラーハンドラー・after_request・teardown を通常どおり通し、
+クライアントが切断したら送信を止める。httpx と ASGI サーバー（uvicorn）が必要
+（requirements-optional.txt に入っている）:
+
+    pip install -r requirements-optional.txt
+    uvicorn asgi:application --workers 2 --port 8000
+"""
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from flask import request_started
+from werkzeug.exceptions import HTTPException
+
+import app as flask_module
+
+if flask_module.httpx is None:
+    raise RuntimeError('非同期モードには httpx が必要です（pip install -r requirements-optional.txt）')
+
+flask_app = flask_module.app
+
+# 同期の Flask ルートを動かすスレッド数（非同期版の無いリクエストの同時実行数）
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '32'))
+
+# asyncio で処理するルート（Flask のエンドポイント名 → 同じ引数で呼ぶコルーチン関数）
+ASYNC_VIEWS: Dict[str, Callable[..., Awaitable[Any]]] = {
+    'analyze_items': flask_module.analyze_items_async,
+    'analyze_items_stream': flask_module.analyze_items_stream_async,
+    'get_detailed_analysis': flask_module.get_detailed_analysis_async,
+    'get_detailed_analysis_batch': flask_module.get_detailed_analysis_batch_async,
+}
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+
+def build_environ(scope: Dict[str, Any], body: bytes) -> Dict[str, Any]:
+    """ASGI の scope とリクエスト本体から WSGI の environ を作る"""
+    script_name = scope.get('root_path', '')
+    path = scope['path']
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def _encode_headers(headers) -> List[List[bytes]]:
+    return [[name.lower().encode('latin-1'), value.encode('latin-1')] for name, value in headers]
+
+
+def match_async_view(environ: Dict[str, Any]):
+    """非同期版のあるルートなら (コルーチン関数, URL 引数) を返す（404・405 は Flask に任せる）"""
+    try:
+        endpoint, view_args = flask_app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        return None, None
+    return ASYNC_VIEWS.get(endpoint), view_args
+
+
+async def full_dispatch_async(view, view_args: Dict[str, Any]):
+    """Flask.full_dispatch_request と同じ流れでコルーチンのビューを呼ぶ"""
+    try:
+        request_started.send(flask_app, _async_wrapper=flask_app.ensure_sync)
+        rv = flask_app.preprocess_request()
+        if rv is None:
+            rv = await view(**view_args)
+    except Exception as e:
+        rv = flask_app.handle_user_exception(e)
+    return flask_app.finalize_request(rv)
+
+
+async def dispatch_async(view, view_args: Dict[str, Any], environ: Dict[str, Any]):
+    """Flask.wsgi_app と同じくリクエストコンテキストを積み、例外は handle_exception に渡す
+
+    コンテキストを外すときに teardown_request・teardown_appcontext が呼ばれる。
+    """
+    ctx = flask_app.request_context(environ)
+    error: Optional[BaseException] = None
+    try:
+        try:
+            ctx.push()
+            return await full_dispatch_async(view, view_args)
+        except Exception as e:
+            error = e
+            return flask_app.handle_exception(e)
+        except BaseException:
+            error = sys.exc_info()[1]
+            raise
+    finally:
+        if error is not None and flask_app.should_ignore_error(error):
+            error = None
+        ctx.pop(error)
+
+
+async def wait_for_disconnect(receive):
+    """本体を読み終えた後の receive() は切断時に http.disconnect を返す"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def send_until_disconnect(body: Awaitable[None], receive) -> bool:
+    """body（送信処理）を実行し、先にクライアントが切断したら取り消す。最後まで送れたら True"""
+    sender = asyncio.ensure_future(body)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait([sender, watcher], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if sender.done():
+        sender.result()
+        return True
+    sender.cancel()
+    try:
+        await sender
+    except asyncio.CancelledError:
+        pass
+    return False
+
+
+async def run_async_view(view, view_args: Dict[str, Any], environ: Dict[str, Any], send, receive):
+    """コルーチンのビューを実行し、本体が非同期イテレータならチャンクごとに送る"""
+    response = await dispatch_async(view, view_args, environ)
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': _encode_headers(response.headers.items())})
+
+    body = response.response
+    if environ['REQUEST_METHOD'] == 'HEAD' or not hasattr(body, '__aiter__'):
+        try:
+            data = b'' if environ['REQUEST_METHOD'] == 'HEAD' else response.get_data()
+            await send({'type': 'http.response.body', 'body': data})
+        finally:
+            response.close()
+        return
+
+    async def stream():
+        async for chunk in body:
+            if chunk:
+                data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    try:
+        if not await send_until_disconnect(stream(), receive):
+            flask_module.logger.info("🔌 クライアントが切断したためストリームを止めました: %s", environ['PATH_INFO'])
+    finally:
+        await body.aclose()
+        response.close()
+
+
+async def run_wsgi_route(environ: Dict[str, Any], send, receive):
+    """同期の Flask ルートを1つのスレッドで実行し、レスポンスをチャンクごとに送る
+
+    stream_with_context はコンテキストをスレッドに結び付けるので、
+    アプリの呼び出しから本体の読み切りまでを同じスレッドで行う。
+    クライアントが切断したら、スレッドは次のチャンクで読むのをやめて本体を閉じる。
+    """
+    loop = asyncio.get_running_loop()
+    messages: asyncio.Queue = asyncio.Queue()
+    cancelled = threading.Event()
+    done = object()
+
+    def put(message):
+        loop.call_soon_threadsafe(messages.put_nowait, message)
+
+    def run():
+        started = {}
+
+        def start_response(status: str, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        try:
+            iterable = flask_app.wsgi_app(environ, start_response)
+            try:
+                put({'type': 'http.response.start', 'status': started['status'],
+                     'headers': _encode_headers(started['headers'])})
+                for chunk in iterable:
+                    if cancelled.is_set():
+                        return
+                    if chunk:
+                        put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                put({'type': 'http.response.body', 'body': b''})
+            finally:
+                close = getattr(iterable, 'close', None)
+                if close is not None:
+                    close()
+        finally:
+            put(done)
+
+    async def relay():
+        while True:
+            message = await messages.get()
+            if message is done:
+                return
+            await send(message)
+
+    future = loop.run_in_executor(_wsgi_executor, run)
+    if await send_until_disconnect(relay(), receive):
+        await future
+    else:
+        cancelled.set()
+        flask_module.logger.info("🔌 クライアントが切断したため応答を止めました: %s", environ['PATH_INFO'])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            _wsgi_executor.shutdown(wait=False)
+            await flask_module.async_http_client.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI アプリケーション"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    environ = build_environ(scope, await read_body(receive))
+    view, view_args = match_async_view(environ)
+    if view is not None:
+        await run_async_view(view, view_args, environ, send, receive)
+    else:
+        await run_wsgi_route(environ, send, receive)
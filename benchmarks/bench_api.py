@@ -0,0 +1,205 @@
+"""スタブサーバーを相手にした /api/analyze・/api/detailed_analysis の負荷ベンチマーク
+
+スタブ（benchmarks/stub_server.py）と app をこのプロセス内で起動し、同時接続数を
+指定してリクエストを投げ、レイテンシのパーセンタイルとスループットを表示する。
+--target を指定すると、別途起動した app（gunicorn など）を計測する。
+--conditional を付けると前回の ETag を If-None-Match で送り、304 を含めた転送量を比べられる。
+
+使い方:
+    python benchmarks/bench_api.py --requests 50 --concurrency 8 --latency-ms 300
+    python benchmarks/bench_api.py --target http://127.0.0.1:8000 --endpoint analyze
+    python benchmarks/bench_api.py --endpoint analyze --keep-analyze-cache --conditional
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import requests
+from werkzeug.serving import make_server
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from stub_server import StubConfig, create_stub_app  # noqa: E402
+
+
+def serve_in_thread(wsgi_app) -> str:
+    """WSGI アプリを空きポートでスレッド起動し、ベースURLを返す"""
+    server = make_server('127.0.0.1', 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def start_local_app(stub_url: str, keep_analyze_cache: bool, rate_limits: str = '') -> str:
+    """スタブに向けた環境変数で app を import して起動する（既定ではレート制限を外す）"""
+    os.environ.update({
+        'EBAY_API_BASE_URL': stub_url,
+        'GEMINI_API_BASE_URL': stub_url,
+        'EBAY_APP_ID': 'stub-app-id',
+        'EBAY_CLIENT_SECRET': 'stub-client-secret',
+        'GEMINI_API_KEY': 'stub-gemini-key',
+        'RATE_LIMITS': rate_limits,
+    })
+    if not keep_analyze_cache:
+        os.environ['ANALYZE_CACHE_TTL'] = '0'
+        os.environ['ANALYZE_CACHE_STALE_TTL'] = '0'
+
+    import app
+    return serve_in_thread(app.app)
+
+
+def wait_until_ready(base_url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{base_url}/readyz", timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{base_url} が {timeout:.0f} 秒以内に ready になりませんでした")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def run_load(urls: List[str], concurrency: int, conditional: bool = False) -> Dict[str, Any]:
+    """urls を同時接続数 concurrency で順に叩き、レイテンシ統計を返す
+
+    conditional なら接続ごとに前回の ETag を覚えて If-None-Match を送る（304 も成功とみなす）。
+    """
+    local = threading.local()
+
+    def fetch(url: str):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+            local.etags = {}
+        headers = {'If-None-Match': local.etags[url]} if conditional and url in local.etags else {}
+        start = time.perf_counter()
+        status, size = None, 0
+        try:
+            response = session.get(url, headers=headers, timeout=120)
+            status = response.status_code
+            # 圧縮されていれば転送されたバイト数（Content-Length）を数える
+            size = int(response.headers.get('Content-Length', len(response.content)))
+            ok = status == 304 or (status == 200 and response.json().get('success', False))
+            if response.headers.get('ETag'):
+                local.etags[url] = response.headers['ETag']
+        except (requests.RequestException, ValueError):
+            ok = False
+        return time.perf_counter() - start, ok, status, size
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, urls))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(result[0] for result in results)
+    return {
+        'requests': len(results),
+        'errors': sum(1 for result in results if not result[1]),
+        'not_modified': sum(1 for result in results if result[2] == 304),
+        'bytes_received': sum(result[3] for result in results),
+        'concurrency': concurrency,
+        'wall_seconds': round(wall, 3),
+        'throughput_rps': round(len(results) / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p90_ms': round(percentile(latencies, 0.90) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'max_ms': round(latencies[-1] * 1000, 1) if latencies else 0.0,
+    }
+
+
+def print_report(name: str, report: Dict[str, Any]):
+    print(f"[{name}] {report['requests']} req, concurrency={report['concurrency']}, errors={report['errors']}, "
+          f"304={report['not_modified']}, received={report['bytes_received'] / 1024:.1f} KB")
+    print(f"  throughput: {report['throughput_rps']:.2f} req/s (wall {report['wall_seconds']:.2f}s)")
+    print(f"  latency   : p50 {report['p50_ms']:.1f} ms | p90 {report['p90_ms']:.1f} ms | "
+          f"p99 {report['p99_ms']:.1f} ms | max {report['max_ms']:.1f} ms")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', help='計測する app のURL（省略時はこのプロセス内で起動）')
+    parser.add_argument('--endpoint', choices=['analyze', 'detail', 'batch', 'both'], default='both')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--keep-analyze-cache', action='store_true',
+                        help='/api/analyze の結果キャッシュを有効のまま計測する')
+    parser.add_argument('--conditional', action='store_true',
+                        help='前回の ETag を If-None-Match で送る（304 になれば本体は転送されない）')
+    parser.add_argument('--rate-limits', default='',
+                        help="app 側のレート制限（RATE_LIMITS の書式、例 'ebay_search=5/10/5000'）")
+    parser.add_argument('--latency-ms', type=float, default=StubConfig.latency_ms)
+    parser.add_argument('--jitter-ms', type=float, default=StubConfig.jitter_ms)
+    parser.add_argument('--gemini-latency-ms', type=float, default=StubConfig.gemini_latency_ms)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--auth-failure-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    stub_url = None
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        stub = create_stub_app(StubConfig(
+            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, gemini_latency_ms=args.gemini_latency_ms,
+            error_rate=args.error_rate, auth_failure_rate=args.auth_failure_rate,
+            rate_limit_rate=args.rate_limit_rate
+        ))
+        stub_url = serve_in_thread(stub)
+        base_url = start_local_app(stub_url, args.keep_analyze_cache, args.rate_limits)
+
+    wait_until_ready(base_url)
+    reports = {}
+
+    if args.endpoint in ('analyze', 'both'):
+        reports['analyze'] = run_load([f"{base_url}/api/analyze"] * args.requests, args.concurrency,
+                                      conditional=args.conditional)
+
+    if args.endpoint in ('detail', 'batch', 'both'):
+        items = requests.get(f"{base_url}/api/analyze", timeout=120).json().get('japanese_items', [])
+        item_ids = [item['itemId'] for item in items] or ['v1|200000000|0']
+
+    if args.endpoint in ('detail', 'both'):
+        urls = [f"{base_url}/api/detailed_analysis/{item_ids[i % len(item_ids)]}" for i in range(args.requests)]
+        reports['detail'] = run_load(urls, args.concurrency)
+
+    if args.endpoint in ('batch', 'both'):
+        # 分析結果の商品IDを50件ずつまとめて問い合わせる
+        batches = [','.join(item_ids[start:start + 50]) for start in range(0, len(item_ids), 50)]
+        urls = [f"{base_url}/api/detailed_analysis?item_ids={batches[i % len(batches)]}" for i in range(args.requests)]
+        reports['batch'] = run_load(urls, args.concurrency)
+
+    if stub_url:
+        reports['upstream_calls'] = requests.get(f"{stub_url}/_stub/stats", timeout=10).json()
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return
+
+    for name in ('analyze', 'detail', 'batch'):
+        if name in reports:
+            print_report(name, reports[name])
+    if 'upstream_calls' in reports:
+        print(f"[upstream] {reports['upstream_calls']}")
+
+
+if __name__ == '__main__':
+    main()
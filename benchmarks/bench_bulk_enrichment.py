@@ -0,0 +1,105 @@
+"""ローカル分析の一括処理（プロセスプール）のワーカー数別スループット
+
+同じ商品をこのプロセス内で1チャンクずつ分析した場合と、BulkEnricher のワーカー数を
+変えて分析した場合の items/sec を比べる。プールの起動時間は別に表示し、どの場合も
+分析結果とスコアが一致し、入力順に返ることも確認する。
+
+使い方:
+    python benchmarks/bench_bulk_enrichment.py [--items 50000] [--workers 1,2,4] [--chunk-size 500]
+"""
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+TITLES = ['vintage kimono obi silk', 'anime figure naruto uzumaki', 'japanese pottery tea set',
+          'samurai katana sword tsuba', 'nintendo switch japan edition', 'zen garden bonsai tree',
+          'studio ghibli totoro plush', 'lot of stuff', 'matcha whisk bamboo chasen', 'seiko watch automatic']
+DESCRIPTIONS = ['', 'ships from tokyo', 'hand made in kyoto, urushi lacquer finish',
+                'authentic sencha and gyoza set', 'used, good condition', '着物 帯 正絹']
+
+
+def build_items(n, rng):
+    items = []
+    for i in range(n):
+        item = {'itemId': f'v1|{i}|0', 'title': ' '.join(rng.sample(TITLES, 2)),
+                'shortDescription': rng.choice(DESCRIPTIONS)}
+        if rng.random() < 0.9:
+            item['price'] = {'value': f'{rng.uniform(1, 900):.2f}', 'currency': 'USD'}
+        for key in ('watchCount', 'bidCount', 'quantitySold'):
+            if rng.random() < 0.6:
+                item[key] = rng.randint(0, 50)
+        if rng.random() < 0.7:
+            item['shippingOptions'] = [{'shippingCost': {'value': rng.choice(['0', '5.99'])}}]
+        items.append(item)
+    return items
+
+
+def run_inline(analyzer, items, chunk_size):
+    start = time.perf_counter()
+    for chunk in app.iter_chunks(items, chunk_size):
+        for item, (_, score) in zip(chunk, analyzer.enrich_chunk(chunk)):
+            item['popularityScore'] = score
+    return time.perf_counter() - start
+
+
+def run_pool(analyzer, items, workers, chunk_size, start_method):
+    enricher = app.BulkEnricher(workers, chunk_size, start_method)
+    try:
+        # ワーカーを全部起動させてから計る
+        start = time.perf_counter()
+        list(enricher.enrich(analyzer, copy.deepcopy(items[:chunk_size * workers])))
+        startup = time.perf_counter() - start
+
+        start = time.perf_counter()
+        enriched = list(enricher.enrich(analyzer, items))
+        elapsed = time.perf_counter() - start
+    finally:
+        enricher.shutdown()
+    assert [item['itemId'] for item in enriched] == [item['itemId'] for item in items], 'order differs'
+    return elapsed, startup
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--workers', default=None, help='比べるワーカー数（既定は 1,2,4,… とコア数）')
+    parser.add_argument('--chunk-size', type=int, default=app.BULK_ENRICH_CHUNK_SIZE)
+    parser.add_argument('--start-method', default=app.BULK_ENRICH_START_METHOD)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cores = os.cpu_count() or 1
+    if args.workers:
+        worker_counts = [int(count) for count in args.workers.split(',') if count.strip()]
+    else:
+        worker_counts = sorted({1 << i for i in range(cores.bit_length()) if 1 << i <= cores} | {cores})
+
+    analyzer = app.SmarteBayAnalyzer()
+    items = build_items(args.items, random.Random(args.seed))
+
+    expected = copy.deepcopy(items)
+    inline_time = run_inline(analyzer, expected, args.chunk_size)
+    print(f"items={args.items} chunk_size={args.chunk_size} cores={cores} start_method={args.start_method}")
+    print(f"  inline      : {args.items / inline_time:10.0f} items/s ({inline_time:.2f}s)")
+
+    for workers in worker_counts:
+        enriched = copy.deepcopy(items)
+        elapsed, startup = run_pool(analyzer, enriched, workers, args.chunk_size, args.start_method)
+        assert all(a['local_analysis'] == b['local_analysis'] and a['popularityScore'] == b['popularityScore']
+                   for a, b in zip(enriched, expected)), 'pool results differ from inline'
+        print(f"  workers={workers:<3}: {args.items / elapsed:10.0f} items/s ({elapsed:.2f}s, "
+              f"{inline_time / elapsed:.1f}x inline, pool startup {startup:.2f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""KeywordMatcher と従来のキーワード総当たりループの比較ベンチマーク
+
+使い方:
+    python benchmarks/bench_keyword_matcher.py [--keywords 3000] [--items 2000]
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import KeywordMatcher, SmarteBayAnalyzer  # noqa: E402
+
+
+def legacy_match(keywords, combined_text):
+    """変更前の enhance_item_with_local_analysis と同じ照合ループ"""
+    categories_found = []
+    keyword_score = 0
+    for category, words in keywords.items():
+        category_matches = 0
+        for keyword in words:
+            if keyword.lower() in combined_text:
+                category_matches += 1
+                keyword_score += 1
+        if category_matches > 0:
+            categories_found.append({
+                'category': category,
+                'matches': category_matches,
+                'keywords': [k for k in words if k.lower() in combined_text]
+            })
+    return categories_found, keyword_score
+
+
+def build_keywords(base, total, rng):
+    """実際の辞書に合成キーワードを足して total 語程度に増やす"""
+    keywords = {category: list(words) for category, words in base.items()}
+    categories = list(keywords)
+    count = sum(len(words) for words in keywords.values())
+    while count < total:
+        word = ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(4, 10)))
+        keywords[rng.choice(categories)].append(word)
+        count += 1
+    return keywords
+
+
+def build_texts(keywords, n, rng):
+    vocabulary = [w for words in keywords.values() for w in words]
+    filler = ['vintage', 'japan', 'rare', 'lot', 'new', 'used', 'set', 'old', 'antique', 'collection']
+    texts = []
+    for _ in range(n):
+        words = rng.choices(filler, k=12) + rng.choices(vocabulary, k=3)
+        rng.shuffle(words)
+        texts.append(' '.join(words).lower())
+    return texts
+
+
+def run(n_keywords, n_items, seed):
+    rng = random.Random(seed)
+    analyzer = SmarteBayAnalyzer()  # 既定の辞書を使う（コンストラクタは通信しない）
+    keywords = build_keywords(analyzer.japanese_keywords, n_keywords, rng)
+    texts = build_texts(keywords, n_items, rng)
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher(keywords)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy = [legacy_match(keywords, text) for text in texts]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = [matcher.match(text) for text in texts]
+    compiled_time = time.perf_counter() - start
+
+    for text, (expected, expected_score), (matches, score) in zip(texts, legacy, compiled):
+        got = [{'category': c, 'matches': len(k), 'keywords': k} for c, k in matches.items()]
+        assert got == expected and score == expected_score, text
+
+    keyword_total = sum(len(words) for words in keywords.values())
+    print(f"keywords={keyword_total} items={n_items}")
+    print(f"  matcher build : {build_time * 1000:8.1f} ms")
+    print(f"  legacy loop   : {legacy_time * 1000:8.1f} ms ({n_items / legacy_time:,.0f} items/s)")
+    print(f"  KeywordMatcher: {compiled_time * 1000:8.1f} ms ({n_items / compiled_time:,.0f} items/s)")
+    print(f"  speedup       : {legacy_time / compiled_time:8.1f}x (results identical)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keywords', type=int, default=3000)
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for n_keywords in sorted({73, args.keywords}):
+        run(n_keywords, args.items, args.seed)
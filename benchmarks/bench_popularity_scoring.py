@@ -0,0 +1,77 @@
+"""人気度スコアの一括計算と1件ずつの計算の比較ベンチマーク
+
+一括計算（NumPy/array）と上位選択が、calculate_popularity_score による
+従来の計算・全件ソートと同じスコア・同じ並びになることも確認する。
+
+使い方:
+    python benchmarks/bench_popularity_scoring.py [--items 20000] [--limit 100]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def build_items(n, rng):
+    analyzer = app.SmarteBayAnalyzer()
+    titles = ['vintage kimono obi', 'anime figure naruto', 'japanese pottery tea set',
+              'samurai katana sword', 'nintendo switch japan', 'zen garden bonsai', 'lot of stuff']
+    items = []
+    for i in range(n):
+        item = {'itemId': f'v1|{i}|0', 'title': rng.choice(titles)}
+        if rng.random() < 0.9:
+            item['price'] = {'value': rng.choice([f'{rng.uniform(1, 900):.2f}', '100.00', '100', 'n/a'])}
+        for key in ('watchCount', 'bidCount', 'quantitySold'):
+            if rng.random() < 0.6:
+                item[key] = rng.randint(0, 50)
+        if rng.random() < 0.7:
+            item['shippingOptions'] = [{'shippingCost': {'value': rng.choice(['0', '0.00', '5.99'])}}]
+        items.append(analyzer.enhance_item_with_local_analysis(item))
+    return analyzer, items
+
+
+def check_and_time(analyzer, items, limit):
+    start = time.perf_counter()
+    expected = [analyzer.calculate_popularity_score(item) for item in items]
+    order = sorted(range(len(items)), key=expected.__getitem__, reverse=True)[:limit]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = analyzer.calculate_popularity_scores(items)
+    top = analyzer.select_top_items(items, scores, limit)
+    batch_time = time.perf_counter() - start
+
+    assert scores == expected, 'batch scores differ from calculate_popularity_score'
+    assert [item['itemId'] for item in top] == [items[i]['itemId'] for i in order], 'top-k order differs'
+    return reference_time, batch_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    analyzer, items = build_items(args.items, random.Random(args.seed))
+    numpy_module = app.np
+    backends = [('numpy', numpy_module)] if numpy_module is not None else []
+    backends.append(('array', None))
+
+    for name, module in backends:
+        app.np = module
+        reference_time, batch_time = check_and_time(analyzer, items, args.limit)
+        print(f"backend={name} items={args.items} limit={args.limit}")
+        print(f"  per-item + sort : {reference_time * 1000:8.1f} ms")
+        print(f"  batch + top-k   : {batch_time * 1000:8.1f} ms")
+        print(f"  speedup         : {reference_time / batch_time:8.1f}x (scores and order identical)")
+    app.np = numpy_module
+
+
+if __name__ == '__main__':
+    main()
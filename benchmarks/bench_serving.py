@@ -0,0 +1,130 @@
+"""同期モード（gunicorn の sync ワーカー）と非同期モード（asgi.py を uvicorn）の負荷比較
+
+スタブ（benchmarks/stub_server.py）をこのプロセス内で起動し、各モードの app を別プロセスで
+同じワーカー数で起動して /api/analyze を多数同時に叩く。上流の遅延が大きいほど、
+同期モードはワーカーが塞がって待ち行列ができ、/healthz の応答も遅れる。
+
+使い方:
+    python benchmarks/bench_serving.py --workers 2 --requests 100 --concurrency 50 --latency-ms 300
+    python benchmarks/bench_serving.py --modes async --concurrency 300 --requests 300
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_api import percentile, print_report, run_load, serve_in_thread, wait_until_ready  # noqa: E402
+from stub_server import StubConfig, create_stub_app  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode: str, port: int, workers: int, threads: int) -> List[str]:
+    if mode == 'sync':
+        return [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+                '-b', f'127.0.0.1:{port}', '--timeout', '120', 'app:app']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--workers', str(workers),
+            '--host', '127.0.0.1', '--port', str(port), '--no-access-log']
+
+
+def probe_health(base_url: str, stop: threading.Event, latencies: List[float]):
+    """負荷をかけている間、/healthz の応答時間を測り続ける"""
+    session = requests.Session()
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            session.get(f"{base_url}/healthz", timeout=60)
+            latencies.append(time.perf_counter() - start)
+        except requests.RequestException:
+            latencies.append(float('inf'))
+        stop.wait(0.1)
+
+
+def run_mode(mode: str, stub_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    port = free_port()
+    env = dict(os.environ, **{
+        'EBAY_API_BASE_URL': stub_url,
+        'GEMINI_API_BASE_URL': stub_url,
+        'EBAY_APP_ID': 'stub-app-id',
+        'EBAY_CLIENT_SECRET': 'stub-client-secret',
+        'GEMINI_API_KEY': 'stub-gemini-key',
+        'RATE_LIMITS': '',
+        # 毎回計算させる（同時に来たリクエストはプロセス内で1回の計算にまとまる）
+        'ANALYZE_CACHE_TTL': '0',
+        'ANALYZE_CACHE_STALE_TTL': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    process = subprocess.Popen(server_command(mode, port, args.workers, args.threads), cwd=REPO_DIR, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(base_url, timeout=60)
+        stop = threading.Event()
+        health: List[float] = []
+        prober = threading.Thread(target=probe_health, args=(base_url, stop, health), daemon=True)
+        prober.start()
+        report = run_load([f"{base_url}/api/analyze"] * args.requests, args.concurrency)
+        stop.set()
+        prober.join()
+        health.sort()
+        report['healthz_p50_ms'] = round(percentile(health, 0.50) * 1000, 1)
+        report['healthz_max_ms'] = round(health[-1] * 1000, 1) if health else 0.0
+        return report
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='sync,async', help='比較するモード（sync,async）')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=1, help='同期モードのワーカーあたりスレッド数')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency-ms', type=float, default=300.0)
+    parser.add_argument('--jitter-ms', type=float, default=StubConfig.jitter_ms)
+    parser.add_argument('--gemini-latency-ms', type=float, default=StubConfig.gemini_latency_ms)
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stub_url = serve_in_thread(create_stub_app(StubConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, gemini_latency_ms=args.gemini_latency_ms
+    )))
+
+    reports = {}
+    for mode in [mode.strip() for mode in args.modes.split(',') if mode.strip()]:
+        reports[mode] = run_mode(mode, stub_url, args)
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return
+
+    for mode, report in reports.items():
+        print_report(mode, report)
+        print(f"  /healthz  : p50 {report['healthz_p50_ms']:.1f} ms | max {report['healthz_max_ms']:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
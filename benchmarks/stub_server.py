@@ -0,0 +1,247 @@
+"""eBay Browse API / OAuth / Gemini のオフライン用スタブサーバー
+
+記録済みレスポンス（benchmarks/fixtures）を返し、遅延・5xx・401・429 を
+指定した割合で注入する。app.py の接続先を環境変数で差し替えて使う:
+
+    python benchmarks/stub_server.py --port 8081 --latency-ms 300 --error-rate 0.02
+    EBAY_API_BASE_URL=http://127.0.0.1:8081 GEMINI_API_BASE_URL=http://127.0.0.1:8081 \\
+        EBAY_APP_ID=stub EBAY_CLIENT_SECRET=stub GEMINI_API_KEY=stub gunicorn app:app
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Dict
+from urllib.parse import urlencode
+
+from flask import Flask, jsonify, request
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# マーケットプレイスごとの通貨と、記録済みのドル価格からの換算レート（1ドルあたり）
+MARKETPLACE_CURRENCIES = {
+    'EBAY_US': ('USD', 1.0),
+    'EBAY_GB': ('GBP', 0.79),
+    'EBAY_DE': ('EUR', 0.93),
+    'EBAY_AU': ('AUD', 1.52),
+}
+
+
+@dataclass
+class StubConfig:
+    """スタブの振る舞い（遅延はミリ秒、各 rate は 0〜1 の確率）"""
+    latency_ms: float = 200.0
+    jitter_ms: float = 50.0
+    gemini_latency_ms: float = 800.0
+    error_rate: float = 0.0
+    auth_failure_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: int = 1
+    token_ttl: int = 7200
+    results_per_query: int = 1000
+    fixtures_dir: str = FIXTURES_DIR
+    seed: int = 0
+
+
+@dataclass
+class StubState:
+    counts: Dict[str, int] = field(default_factory=dict)
+    tokens_issued: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+def _load_fixture(config: StubConfig, name: str) -> Any:
+    with open(os.path.join(config.fixtures_dir, name), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def create_stub_app(config: StubConfig = None) -> Flask:
+    """スタブサーバーの Flask アプリを作る"""
+    config = config or StubConfig()
+    rng = random.Random(config.seed)
+    rng_lock = threading.Lock()
+    state = StubState()
+
+    recorded_items = _load_fixture(config, 'item_summary_search.json')['itemSummaries']
+    recorded_token = _load_fixture(config, 'oauth_token.json')
+    recorded_generation = _load_fixture(config, 'generate_content.json')
+
+    stub = Flask(__name__)
+    stub.config['STUB_STATE'] = state
+
+    def sleep_latency(mean_ms: float):
+        with rng_lock:
+            delay = max(0.0, rng.gauss(mean_ms, config.jitter_ms)) / 1000
+        time.sleep(delay)
+
+    def injected_fault(check_auth: bool = True):
+        """注入するエラーレスポンス（無ければ None）"""
+        with rng_lock:
+            roll = rng.random()
+        if roll < config.rate_limit_rate:
+            state.count('injected_429')
+            response = jsonify({'errors': [{'errorId': 2001, 'message': 'Too many requests'}]})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(config.retry_after)
+            return response
+        roll -= config.rate_limit_rate
+        if roll < config.error_rate:
+            state.count('injected_5xx')
+            return jsonify({'errors': [{'errorId': 10001, 'message': 'Service unavailable'}]}), 503
+        roll -= config.error_rate
+        if check_auth:
+            authorization = request.headers.get('Authorization', '')
+            if not authorization.startswith('Bearer ') or roll < config.auth_failure_rate:
+                state.count('injected_401')
+                return jsonify({'errors': [{'errorId': 1001, 'message': 'Invalid access token'}]}), 401
+        return None
+
+    def virtual_item(query: str, position: int, marketplace: str = 'EBAY_US') -> Dict[str, Any]:
+        """クエリ内の position 番目の商品（記録済み商品をもとに ID を振り直し、現地通貨にする）"""
+        key = query if marketplace == 'EBAY_US' else f"{marketplace}:{query}"
+        seed = zlib.crc32(key.encode('utf-8'))
+        template = recorded_items[(seed + position) % len(recorded_items)]
+        item = copy.deepcopy(template)
+        currency, rate = MARKETPLACE_CURRENCIES.get(marketplace, MARKETPLACE_CURRENCIES['EBAY_US'])
+        if rate != 1.0 and 'price' in item:
+            item['price'] = {'value': f"{float(item['price']['value']) * rate:.2f}", 'currency': currency}
+        # クエリ間で一部の商品が重複するよう、ID 空間をずらして重ねる
+        number = (seed % 97) * 50 + position
+        item['itemId'] = f"v1|2{number:09d}|0"
+        item['itemWebUrl'] = f"https://www.ebay.com/itm/2{number:09d}"
+        return item
+
+    @stub.route('/identity/v1/oauth2/token', methods=['POST'])
+    def oauth_token():
+        state.count('oauth_token')
+        sleep_latency(config.latency_ms)
+        fault = injected_fault(check_auth=False)
+        if fault is not None:
+            return fault
+        if not request.headers.get('Authorization', '').startswith('Basic '):
+            return jsonify({'error': 'invalid_client'}), 401
+        with state.lock:
+            state.tokens_issued += 1
+            issued = state.tokens_issued
+        token = dict(recorded_token, expires_in=config.token_ttl)
+        token['access_token'] = f"{recorded_token['access_token']}-{issued}"
+        return jsonify(token)
+
+    @stub.route('/buy/browse/v1/item_summary/search')
+    def item_summary_search():
+        state.count('item_summary_search')
+        sleep_latency(config.latency_ms)
+        fault = injected_fault()
+        if fault is not None:
+            return fault
+
+        query = request.args.get('q', '')
+        limit = max(1, min(200, int(request.args.get('limit', 50))))
+        offset = max(0, int(request.args.get('offset', 0)))
+        total = config.results_per_query
+        positions = range(offset, min(offset + limit, total))
+
+        base = f"{request.host_url.rstrip('/')}/buy/browse/v1/item_summary/search"
+        params = {k: v for k, v in request.args.items() if k not in ('limit', 'offset')}
+        body = {
+            'href': f"{base}?{urlencode(dict(params, limit=limit, offset=offset))}",
+            'total': total,
+            'limit': limit,
+            'offset': offset,
+            'itemSummaries': [virtual_item(query, p, request.headers.get('X-EBAY-C-MARKETPLACE-ID', 'EBAY_US'))
+                              for p in positions]
+        }
+        if offset + limit < total:
+            body['next'] = f"{base}?{urlencode(dict(params, limit=limit, offset=offset + limit))}"
+        if offset > 0:
+            body['prev'] = f"{base}?{urlencode(dict(params, limit=limit, offset=max(0, offset - limit)))}"
+        return jsonify(body)
+
+    def item_detail(item_id: str) -> Dict[str, Any]:
+        index = zlib.crc32(item_id.encode('utf-8')) % len(recorded_items)
+        item = copy.deepcopy(recorded_items[index])
+        item['itemId'] = item_id
+        item['description'] = f"<p>{item['title']}</p>"
+        item.setdefault('shortDescription', item['title'])
+        return item
+
+    @stub.route('/buy/browse/v1/item/')
+    def get_items():
+        state.count('get_items')
+        sleep_latency(config.latency_ms)
+        fault = injected_fault()
+        if fault is not None:
+            return fault
+
+        item_ids = [item_id for item_id in request.args.get('item_ids', '').split(',') if item_id]
+        if not item_ids or len(item_ids) > 20:
+            return jsonify({'errors': [{'errorId': 12001, 'message': 'item_ids must list 1 to 20 items'}]}), 400
+        return jsonify({'items': [item_detail(item_id) for item_id in item_ids]})
+
+    @stub.route('/buy/browse/v1/item/<path:item_id>')
+    def get_item(item_id):
+        state.count('item')
+        sleep_latency(config.latency_ms)
+        fault = injected_fault()
+        if fault is not None:
+            return fault
+        return jsonify(item_detail(item_id))
+
+    @stub.route('/v1/models/<path:model_action>', methods=['POST'])
+    def generate_content(model_action):
+        state.count('generate_content')
+        sleep_latency(config.gemini_latency_ms)
+        fault = injected_fault(check_auth=False)
+        if fault is not None:
+            return fault
+        if not model_action.endswith(':generateContent') or not request.args.get('key'):
+            return jsonify({'error': {'code': 400, 'message': 'invalid request'}}), 400
+        return jsonify(recorded_generation)
+
+    @stub.route('/_stub/stats')
+    def stub_stats():
+        with state.lock:
+            return jsonify({'counts': dict(state.counts), 'tokens_issued': state.tokens_issued})
+
+    return stub
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=StubConfig.latency_ms)
+    parser.add_argument('--jitter-ms', type=float, default=StubConfig.jitter_ms)
+    parser.add_argument('--gemini-latency-ms', type=float, default=StubConfig.gemini_latency_ms)
+    parser.add_argument('--error-rate', type=float, default=StubConfig.error_rate)
+    parser.add_argument('--auth-failure-rate', type=float, default=StubConfig.auth_failure_rate)
+    parser.add_argument('--rate-limit-rate', type=float, default=StubConfig.rate_limit_rate)
+    parser.add_argument('--retry-after', type=int, default=StubConfig.retry_after)
+    parser.add_argument('--token-ttl', type=int, default=StubConfig.token_ttl)
+    parser.add_argument('--results-per-query', type=int, default=StubConfig.results_per_query)
+    parser.add_argument('--fixtures-dir', default=FIXTURES_DIR)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def config_from_args(args: argparse.Namespace) -> StubConfig:
+    return StubConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, gemini_latency_ms=args.gemini_latency_ms,
+        error_rate=args.error_rate, auth_failure_rate=args.auth_failure_rate,
+        rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after, token_ttl=args.token_ttl,
+        results_per_query=args.results_per_query, fixtures_dir=args.fixtures_dir, seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    cli_args = parse_args()
+    create_stub_app(config_from_args(cli_args)).run(host=cli_args.host, port=cli_args.port, threaded=True)
@@ -0,0 +1,160 @@
+"""asgi.py（非同期モードの ASGI ブリッジ）のテスト（サーバーを立てずに ASGI を直接呼ぶ）"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('httpx')
+
+import app  # noqa: E402
+import asgi  # noqa: E402
+from flask import Response, appcontext_tearing_down, jsonify, stream_with_context  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def no_warmup(monkeypatch):
+    # before_request で eBay へのウォームアップを始めないようにする
+    monkeypatch.setitem(app._warmup_state, 'ready', True)
+    monkeypatch.setattr(app, 'refresh_scheduler', None)
+
+
+def make_scope(path, method='GET', query_string=b''):
+    return {'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+            'root_path': '', 'query_string': query_string, 'headers': [(b'host', b'testserver')],
+            'client': ('127.0.0.1', 50000), 'server': ('testserver', 80)}
+
+
+async def call(path, method='GET', body=b'', disconnect_after=None):
+    """ASGI アプリを呼び、送られたメッセージを返す
+
+    disconnect_after を渡すと、本体のチャンクをその数だけ受け取った時点で切断する。
+    """
+    sent = []
+    request_read = False
+    disconnected = asyncio.Event()
+
+    async def receive():
+        nonlocal request_read
+        if not request_read:
+            request_read = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+        chunks = [m for m in sent if m['type'] == 'http.response.body' and m.get('body')]
+        if disconnect_after is not None and len(chunks) >= disconnect_after:
+            disconnected.set()
+
+    await asyncio.wait_for(asgi.application(make_scope(path, method), receive, send), timeout=10)
+    return sent
+
+
+def status_of(sent):
+    return next(m['status'] for m in sent if m['type'] == 'http.response.start')
+
+
+def body_of(sent):
+    return b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+
+
+def test_async_view_is_dispatched_with_url_args(monkeypatch):
+    calls = []
+
+    async def view(item_id):
+        calls.append((item_id, app.request.path))
+        return jsonify({'success': True, 'item_id': item_id})
+
+    monkeypatch.setitem(asgi.ASYNC_VIEWS, 'get_detailed_analysis', view)
+    sent = asyncio.run(call('/api/detailed_analysis/v1|123'))
+
+    assert status_of(sent) == 200
+    assert json.loads(body_of(sent)) == {'success': True, 'item_id': 'v1|123'}
+    assert calls == [('v1|123', '/api/detailed_analysis/v1|123')]
+
+
+def test_async_view_error_goes_through_handlers_and_teardown(monkeypatch):
+    torn_down = []
+
+    async def view(item_id):
+        raise RuntimeError('boom')
+
+    def on_teardown(sender, exc=None, **kwargs):
+        torn_down.append(exc)
+
+    monkeypatch.setitem(asgi.ASYNC_VIEWS, 'get_detailed_analysis', view)
+    appcontext_tearing_down.connect(on_teardown, app.app)
+    try:
+        sent = asyncio.run(call('/api/detailed_analysis/x'))
+    finally:
+        appcontext_tearing_down.disconnect(on_teardown, app.app)
+
+    assert status_of(sent) == 500
+    assert len(torn_down) == 1 and isinstance(torn_down[0], RuntimeError)
+
+
+def test_unknown_path_falls_through_to_flask():
+    sent = asyncio.run(call('/no/such/path'))
+    assert status_of(sent) == 404
+
+
+def test_sync_route_runs_in_thread():
+    sent = asyncio.run(call('/healthz'))
+    assert status_of(sent) == 200
+    assert json.loads(body_of(sent)) == {'status': 'ok'}
+
+
+def test_async_stream_stops_on_disconnect(monkeypatch):
+    state = {'sent': 0, 'closed': False}
+
+    async def view():
+        async def generate():
+            try:
+                while True:
+                    state['sent'] += 1
+                    yield 'data: x\n\n'
+                    await asyncio.sleep(0.01)
+            finally:
+                state['closed'] = True
+
+        return Response(generate(), mimetype='text/event-stream')
+
+    monkeypatch.setitem(asgi.ASYNC_VIEWS, 'analyze_items_stream', view)
+    sent = asyncio.run(call('/api/analyze/stream', disconnect_after=3))
+
+    assert status_of(sent) == 200
+    assert state['closed']
+    # 切断後はチャンクを送らない（終端の空チャンクも送らない）
+    assert not any(m['type'] == 'http.response.body' and not m.get('more_body', False) for m in sent)
+    assert state['sent'] < 10
+
+
+def test_wsgi_stream_stops_on_disconnect(monkeypatch):
+    state = {'sent': 0, 'closed': threading.Event()}
+
+    def view():
+        def generate():
+            try:
+                while True:
+                    state['sent'] += 1
+                    yield 'data: x\n\n'
+                    time.sleep(0.01)
+            finally:
+                state['closed'].set()
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+    monkeypatch.setitem(app.app.view_functions, 'healthz', view)
+    sent = asyncio.run(call('/healthz', disconnect_after=3))
+
+    assert status_of(sent) == 200
+    # スレッドは次のチャンクで読むのをやめて本体を閉じる
+    assert state['closed'].wait(5)
+    assert state['sent'] < 20
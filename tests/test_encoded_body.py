@@ -0,0 +1,66 @@
+"""エンコード済みの本体にリクエストごとの optimization_info を継ぎ足したレスポンスのテスト"""
+import gzip
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+DECODERS = {'identity': lambda body: body, 'gzip': gzip.decompress}
+if app.brotli is not None:
+    DECODERS['br'] = app.brotli.decompress
+
+
+def fetch(body, encoding, overlay, headers=None):
+    with app.app.test_request_context(headers=dict({'Accept-Encoding': encoding}, **(headers or {}))):
+        response = body.response(0, overlay)
+    if response.status_code == 304:
+        return response, None
+    assert response.headers.get('Content-Encoding', 'identity') == encoding
+    return response, json.loads(DECODERS[encoding](response.get_data()))
+
+
+@pytest.fixture
+def payload():
+    return {
+        'success': True,
+        'japanese_items': [{'itemId': str(i), 'title': f'着物 {i}' * 20} for i in range(200)],
+        'optimization_info': {'analysis_method': 'smart_keyword_matching + minimal_ai',
+                              'gemini_cache': {'hits': 1}},
+    }
+
+
+@pytest.mark.parametrize('encoding', sorted(DECODERS))
+def test_overlay_is_added_to_optimization_info(payload, encoding):
+    body = app.EncodedBody.from_payload(payload)
+    overlay = {'cache': {'status': 'hit', 'age_seconds': 3.0}, 'gemini_cache': {'hits': 2}}
+
+    _, document = fetch(body, encoding, overlay)
+
+    assert document['japanese_items'] == payload['japanese_items']
+    # 本体側の gemini_cache は捨て、リクエストごとの値だけを返す
+    assert document['optimization_info'] == dict(analysis_method='smart_keyword_matching + minimal_ai', **overlay)
+
+
+@pytest.mark.parametrize('encoding', sorted(DECODERS))
+def test_large_overlay_and_empty_info(encoding):
+    body = app.EncodedBody.from_payload({'success': True})
+    # 無圧縮ブロックの上限（64KiB）を超える継ぎ足し
+    overlay = {'cache': {'note': 'x' * 150000}}
+
+    assert fetch(body, encoding, overlay)[1] == {'success': True, 'optimization_info': overlay}
+    assert fetch(body, encoding, None)[1] == {'success': True, 'optimization_info': {}}
+
+
+def test_etag_ignores_overlay(payload):
+    body = app.EncodedBody.from_payload(payload)
+    first, _ = fetch(body, 'gzip', {'cache': {'status': 'miss'}})
+    second, _ = fetch(body, 'gzip', {'cache': {'status': 'hit'}})
+    assert first.headers['ETag'] == second.headers['ETag']
+
+    response, _ = fetch(body, 'gzip', {'cache': {'status': 'hit'}}, {'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304
@@ -0,0 +1,162 @@
+"""ItemIndex（/api/items の絞り込み・並べ替え・カーソルでのページ送り）のテスト"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+CATEGORIES = ['着物・和服', 'アニメ・マンガ', '陶磁器', 'その他']
+WORDS = ['vintage', 'kimono', 'anime', 'figure', 'tea', 'set', 'sword', 'silk']
+
+
+def make_items(n, seed=0):
+    rng = random.Random(seed)
+    items = []
+    for i in range(n):
+        price = None if rng.random() < 0.1 else round(rng.uniform(1, 800), 2)
+        items.append({
+            'itemId': f'v1|{i}|0',
+            'title': ' '.join(rng.sample(WORDS, 3)),
+            'price': {'value': str(price), 'currency': 'USD'} if price is not None else None,
+            # 同点を多くしてキーの一意化（itemId 順）も確かめる
+            'popularityScore': rng.choice([0, 5, 10, 12.5, 20, 40]),
+            'local_analysis': {'primary_category': rng.choice(CATEGORIES), 'price_value': price},
+        })
+    return items
+
+
+def sort_key(sort, item):
+    price = item['local_analysis']['price_value']
+    if sort == '-score':
+        return (-item['popularityScore'], item['itemId'])
+    if sort == 'score':
+        return (item['popularityScore'], item['itemId'])
+    if sort == 'price':
+        return (price is None, price or 0.0, item['itemId'])
+    return (price is None, -(price or 0.0), item['itemId'])
+
+
+def expected(items, sort, category=None, price_range=None, min_price=None, max_price=None,
+             min_score=None, max_score=None, q=None):
+    """全件を走査して求めた正解"""
+    bounds = app.MarketStatsAccumulator.price_bounds(price_range) if price_range else None
+    tokens = app.ItemIndex.tokenize(q or '')
+    result = []
+    for item in items:
+        price = item['local_analysis']['price_value']
+        score = item['popularityScore']
+        if category and item['local_analysis']['primary_category'] != category:
+            continue
+        if bounds and (price is None or price <= bounds[0] or (bounds[1] is not None and price > bounds[1])):
+            continue
+        if (min_price is not None or max_price is not None) and (
+                price is None or (min_price is not None and price < min_price)
+                or (max_price is not None and price > max_price)):
+            continue
+        if (min_score is not None and score < min_score) or (max_score is not None and score > max_score):
+            continue
+        if any(token not in app.ItemIndex.tokenize(item['title']) for token in tokens):
+            continue
+        result.append(item)
+    return sorted(result, key=lambda item: sort_key(sort, item))
+
+
+def page_through(index, limit, **filters):
+    """next_cursor をたどって全ページを集める"""
+    collected, cursor, pages = [], None, 0
+    while True:
+        page = index.query(limit=limit, cursor=cursor, **filters)
+        assert len(page['items']) <= limit
+        collected.extend(page['items'])
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            return collected, page['total'], pages
+        assert len(page['items']) == limit
+
+
+QUERIES = [
+    {},
+    {'category': 'アニメ・マンガ'},
+    {'q': 'kimono'},
+    {'q': 'vintage silk'},
+    {'price_range': '100-300'},
+    {'price_range': '500+'},
+    {'min_price': 50, 'max_price': 400},
+    {'min_score': 10},
+    {'category': '着物・和服', 'min_price': 100},
+    {'category': '陶磁器', 'q': 'tea', 'max_score': 20},
+    {'category': '存在しないカテゴリ'},
+    {'q': 'nothing'},
+]
+
+
+@pytest.fixture(scope='module')
+def items():
+    return make_items(500)
+
+
+@pytest.fixture(scope='module')
+def index(items):
+    return app.ItemIndex(items)
+
+
+@pytest.mark.parametrize('sort', app.ItemIndex.SORTS)
+@pytest.mark.parametrize('limit', [1, 7, 100])
+@pytest.mark.parametrize('filters', QUERIES, ids=[repr(query) for query in QUERIES])
+def test_pages_match_full_scan(items, index, sort, limit, filters):
+    want = expected(items, sort, **filters)
+    got, total, pages = page_through(index, limit, sort=sort, **filters)
+    assert [item['itemId'] for item in got] == [item['itemId'] for item in want]
+    assert total == len(want)
+    assert pages == max(1, -(-len(want) // limit))
+
+
+def test_cursor_is_stable_across_rebuilt_index(items):
+    first = app.ItemIndex(items).query(sort='price', limit=10)
+    # 結果が作り直されても、カーソルは前のページ末尾のキーの次から続ける
+    rebuilt = app.ItemIndex(list(reversed(items)))
+    second = rebuilt.query(sort='price', limit=10, cursor=first['next_cursor'])
+    want = expected(items, 'price')[10:20]
+    assert [item['itemId'] for item in second['items']] == [item['itemId'] for item in want]
+
+    # カーソルより前に入った商品は次のページに出てこない（重複も飛ばしもしない）
+    cheaper = dict(items[0], itemId='v1|new|0', local_analysis=dict(items[0]['local_analysis'], price_value=0.5))
+    grown = app.ItemIndex(items + [cheaper])
+    assert grown.query(sort='price', limit=10, cursor=first['next_cursor'])['items'] == second['items']
+
+
+def test_exact_last_page_has_no_cursor():
+    index = app.ItemIndex(make_items(20))
+    page = index.query(limit=20)
+    assert len(page['items']) == 20 and page['next_cursor'] is None
+    page = index.query(limit=10)
+    assert index.query(limit=10, cursor=page['next_cursor'])['next_cursor'] is None
+
+
+def test_limit_is_clamped(index):
+    assert len(index.query(limit=0)['items']) == 1
+    assert len(index.query(limit=1000)['items']) == app.ItemIndex.MAX_LIMIT
+
+
+def test_empty_match(index):
+    page = index.query(category='存在しないカテゴリ', limit=5)
+    assert page == {'items': [], 'total': 0, 'next_cursor': None}
+    # 索引に無い値は作り置きしない
+    assert not any(key[2] == '存在しないカテゴリ' for key in index._ranked)
+
+
+def test_invalid_arguments(index):
+    cursor = index.query(sort='price', limit=5)['next_cursor']
+    with pytest.raises(ValueError):
+        index.query(sort='-score', cursor=cursor)
+    with pytest.raises(ValueError):
+        index.query(cursor='not-a-cursor')
+    with pytest.raises(ValueError):
+        index.query(sort='name')
+    with pytest.raises(ValueError):
+        index.query(price_range='1-2')
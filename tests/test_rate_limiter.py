@@ -0,0 +1,190 @@
+"""RateLimiter（トークンバケット・共有状態・429・1日のクォータ）と PooledHTTPClient のリトライのテスト"""
+import asyncio
+import io
+import os
+import sys
+import time
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_limiter(request, tmp_path):
+    """同じ設定の RateLimiter を作る（sqlite なら同じファイルを共有する＝別ワーカー相当）"""
+    path = str(tmp_path / 'rate_limits.db') if request.param == 'sqlite' else None
+
+    def make(rate=100.0, burst=2, daily=0, max_wait=1.0):
+        return app.RateLimiter({'up': (rate, burst, daily)}, path=path, max_wait=max_wait)
+
+    return make
+
+
+def test_burst_then_refill(make_limiter):
+    limiter = make_limiter(rate=20.0, burst=2)
+    assert limiter.acquire('up') == 0.0
+    assert limiter.acquire('up') == 0.0
+    # バーストを使い切ったら補充（1/20秒）を待つ
+    waited = limiter.acquire('up')
+    assert 0.0 < waited <= 0.1
+    counters = limiter.counters()['up']
+    assert counters['granted'] == 3 and counters['queued'] == 1
+
+
+def test_wait_over_max_wait_is_rejected(make_limiter):
+    limiter = make_limiter(rate=0.1, burst=1, max_wait=0.5)
+    limiter.acquire('up')
+    started = time.monotonic()
+    with pytest.raises(app.RateLimitExceeded) as excinfo:
+        limiter.acquire('up')
+    # 待ちきれないことが分かった時点で眠らずに断る
+    assert time.monotonic() - started < 0.2
+    assert excinfo.value.retry_after == pytest.approx(10, abs=0.5)
+    assert limiter.counters()['up']['rejected'] == 1
+
+
+def test_unknown_bucket_is_not_limited(make_limiter):
+    assert make_limiter().acquire('other') == 0.0
+
+
+def test_state_is_shared_between_workers(make_limiter):
+    first, second = make_limiter(rate=0.01, burst=2), make_limiter(rate=0.01, burst=2)
+    first.acquire('up')
+    second.acquire('up')
+    if first.path:
+        with pytest.raises(app.RateLimitExceeded):
+            first.acquire('up')
+        assert second.stats()['buckets']['up']['used_today'] == 2
+    else:
+        # メモリ上の状態はインスタンス（プロセス）ごと
+        first.acquire('up')
+        assert second.stats()['buckets']['up']['used_today'] == 1
+
+
+def test_penalize_blocks_and_halves_rate(make_limiter):
+    first, second = make_limiter(rate=100.0, burst=5), make_limiter(rate=100.0, burst=5)
+    first.penalize('up', 30)
+
+    limiter = second if first.path else first
+    with pytest.raises(app.RateLimitExceeded) as excinfo:
+        limiter.acquire('up')
+    assert excinfo.value.retry_after == pytest.approx(30, abs=1)
+
+    bucket = limiter.stats()['buckets']['up']
+    assert bucket['effective_rate'] == 50.0
+    assert 29 < bucket['blocked_for'] <= 30
+    assert first.counters()['up']['throttled'] == 1
+
+
+def test_daily_quota(make_limiter):
+    limiter = make_limiter(rate=100.0, burst=10, daily=2)
+    limiter.acquire('up')
+    limiter.acquire('up')
+    with pytest.raises(app.RateLimitExceeded) as excinfo:
+        limiter.acquire('up')
+    assert excinfo.value.retry_after is None
+    # 日付が変わればまた使える
+    assert limiter._reserve('up', time.time() + 86400) == 0.0
+
+
+def test_acquire_async(make_limiter):
+    limiter = make_limiter(rate=20.0, burst=1)
+
+    async def run():
+        return [await limiter.acquire_async('up') for _ in range(2)]
+
+    first, second = asyncio.run(run())
+    assert first == 0.0 and 0.0 < second <= 0.1
+
+
+class FakeSession:
+    """決めたステータスを順に返す requests.Session の代わり"""
+
+    def __init__(self, *statuses, headers=None):
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(method)
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.headers.update(self.headers)
+        response._content = b'{}'
+        response.raw = io.BytesIO()
+        return response
+
+
+def make_client(session, limiter=None):
+    client = app.PooledHTTPClient({'http://api.test/': 2}, max_retries=2, backoff_base=0.0, backoff_max=0.0,
+                                  rate_limiter=limiter, rate_limit_routes=[('http://api.test/', 'up')])
+    client._session = session
+    return client
+
+
+def test_get_is_retried():
+    session = FakeSession(503, 503, 200)
+    assert make_client(session).get('http://api.test/x').status_code == 200
+    assert session.calls == ['GET'] * 3
+
+
+def test_post_is_retried_only_when_asked():
+    session = FakeSession(503, 200)
+    assert make_client(session).post('http://api.test/x').status_code == 503
+    assert session.calls == ['POST']
+
+    session = FakeSession(503, 200)
+    assert make_client(session).post('http://api.test/x', retry=True).status_code == 200
+    assert session.calls == ['POST', 'POST']
+
+
+def test_long_retry_after_fails_fast(make_limiter):
+    limiter = make_limiter(max_wait=1.0)
+    session = FakeSession(429, 200, headers={'Retry-After': '60'})
+    started = time.monotonic()
+    with pytest.raises(app.RateLimitExceeded) as excinfo:
+        make_client(session, limiter).get('http://api.test/x')
+    assert time.monotonic() - started < 0.5
+    assert excinfo.value.retry_after == 60
+    assert session.calls == ['GET']
+    assert limiter.stats()['buckets']['up']['blocked_for'] > 50
+
+
+def test_short_retry_after_waits_in_bucket(make_limiter):
+    limiter = make_limiter(max_wait=1.0)
+    session = FakeSession(429, 200, headers={'Retry-After': '0.2'})
+    started = time.monotonic()
+    assert make_client(session, limiter).get('http://api.test/x').status_code == 200
+    # バケットの停止だけ待つ（バックオフと二重には待たない）
+    assert 0.15 <= time.monotonic() - started < 0.4
+    assert session.calls == ['GET', 'GET']
+
+
+def test_non_retried_429_is_returned(make_limiter):
+    limiter = make_limiter(max_wait=1.0)
+    session = FakeSession(429, headers={'Retry-After': '60'})
+    # リトライしないなら 429 をそのまま呼び出し側に返す（バケットは止める）
+    assert make_client(session, limiter).post('http://api.test/x').status_code == 429
+    assert limiter.stats()['buckets']['up']['blocked_for'] > 50
+
+
+def test_gemini_calls_are_counted_after_response(monkeypatch):
+    analyzer = app.EfficientGeminiAnalyzer()
+    items = [{'itemId': str(i), 'title': f'japanese kimono {i}', 'price': {'value': str(10 + i), 'currency': 'USD'}}
+             for i in range(5)]
+
+    def rejected(*args, **kwargs):
+        raise app.RateLimitExceeded('gemini', 'レート制限の待ち時間上限を超えました', 30)
+
+    monkeypatch.setattr(app.http_client, 'post', rejected)
+    result = analyzer.analyze_market_trends_only(items)
+    assert result['analysis_method'] == 'statistics_only'
+    assert analyzer.request_count == 0
+
+    monkeypatch.setattr(app.http_client, 'post', lambda *args, **kwargs: FakeSession(503).request('POST', ''))
+    analyzer.analyze_market_trends_only(items)
+    assert analyzer.request_count == 1
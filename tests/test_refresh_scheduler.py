@@ -0,0 +1,79 @@
+"""RefreshScheduler（定期更新のリーダー）の失敗時の振る舞いのテスト"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class FailingSnapshot(app.AnalysisSnapshot):
+    """最初の publish だけディスクフルで失敗する"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.attempts = 0
+
+    def publish(self, payload):
+        self.attempts += 1
+        if self.attempts == 1:
+            raise OSError(28, 'No space left on device')
+        super().publish(payload)
+
+
+def make_scheduler(snapshot, compute=None):
+    return app.RefreshScheduler(compute or (lambda: {'success': True, 'japanese_items': [], 'optimization_info': {}}),
+                                snapshot, interval=60, jitter=0, backoff_base=0.05, backoff_max=0.05)
+
+
+def test_publish_failure_is_counted_and_retried(tmp_path):
+    snapshot = FailingSnapshot(str(tmp_path / 'snapshot.json'))
+    scheduler = make_scheduler(snapshot)
+    scheduler.start()
+
+    assert wait_until(lambda: scheduler.state['last_success'] is not None)
+    assert snapshot.attempts == 2
+    assert scheduler.state['runs'] == 2 and scheduler.state['failures'] == 0
+    assert scheduler._thread.is_alive() and scheduler.state['leader']
+    assert snapshot.read()[0]['success']
+
+
+@pytest.mark.skipif(app.fcntl is None, reason='fcntl がありません')
+def test_thread_exit_releases_leadership(tmp_path, monkeypatch):
+    snapshot = app.AnalysisSnapshot(str(tmp_path / 'snapshot.json'))
+    scheduler = make_scheduler(snapshot)
+    crashed = threading.Event()
+
+    def broken_read():
+        crashed.set()
+        raise RuntimeError('unexpected')
+
+    monkeypatch.setattr(snapshot, 'read', broken_read)
+    scheduler.start()
+
+    assert crashed.wait(5)
+    assert wait_until(lambda: scheduler._thread is None)
+    assert not scheduler.state['leader']
+
+    # ロックが外れているので別のワーカーがリーダーになれる
+    other = make_scheduler(snapshot)
+    assert other._try_lead()
+    other._resign()
+
+    # 次の start() で起動し直せる
+    monkeypatch.undo()
+    scheduler.start()
+    assert wait_until(lambda: scheduler.state['last_success'] is not None)
@@ -0,0 +1,124 @@
+"""人気度スコアの一括計算（NumPy/array）と上位選択が1件ずつの計算と一致することのテスト"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+BACKENDS = ['numpy', 'array']
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    """app.np を切り替えて、NumPy 版と array 版の両方で実行する"""
+    if request.param == 'numpy':
+        if app.np is None:
+            pytest.skip('NumPy がありません')
+    else:
+        monkeypatch.setattr(app, 'np', None)
+    return request.param
+
+
+@pytest.fixture(scope='module')
+def analyzer():
+    return app.SmarteBayAnalyzer()
+
+
+def make_item(item_id, title='vintage kimono obi', price=None, shipping=None, **counts):
+    item = {'itemId': item_id, 'title': title, **counts}
+    if price is not None:
+        item['price'] = {'value': price, 'currency': 'USD'}
+    if shipping is not None:
+        item['shippingOptions'] = [{'shippingCost': {'value': value}} for value in shipping]
+    return item
+
+
+EDGE_CASES = {
+    'no_price': make_item('v1|1|0', watchCount=3),
+    'unparsable_price': make_item('v1|2|0', price='n/a', bidCount=2),
+    'price_over_100': make_item('v1|3|0', price='150.00', watchCount=4, bidCount=1),
+    'price_over_500': make_item('v1|4|0', price='800', quantitySold=2),
+    'price_exactly_100': make_item('v1|5|0', price='100', watchCount=1),
+    'free_shipping': make_item('v1|6|0', price='20', shipping=['5.99', '0']),
+    'free_shipping_decimal': make_item('v1|7|0', price='20', shipping=['0.00']),
+    'paid_shipping': make_item('v1|8|0', price='20', shipping=['5.99']),
+    'missing_counts': make_item('v1|9|0', title='anime figure naruto', price='45'),
+    'no_keywords': make_item('v1|10|0', title='lot of stuff'),
+}
+
+
+@pytest.mark.parametrize('enhanced', [True, False], ids=['enhanced', 'raw'])
+@pytest.mark.parametrize('case', sorted(EDGE_CASES))
+def test_batch_scores_match_single_item(analyzer, backend, case, enhanced):
+    item = dict(EDGE_CASES[case])
+    if enhanced:
+        analyzer.enhance_item_with_local_analysis(item)
+
+    assert analyzer.calculate_popularity_scores([item]) == [analyzer.calculate_popularity_score(item)]
+
+
+def test_edge_case_values(analyzer, backend):
+    items = [dict(EDGE_CASES[case]) for case in ('no_price', 'price_over_100', 'price_over_500',
+                                                 'free_shipping', 'paid_shipping', 'missing_counts')]
+    no_price, over_100, over_500, free, paid, missing = analyzer.calculate_popularity_scores(items)
+
+    # local_analysis が無ければ確信度 0.5・キーワードスコア 0 として計算する
+    assert no_price == 3 * 2 + 5
+    assert over_100 == pytest.approx((4 * 2 + 1 * 5) * 1.3 + 5)
+    # 500ドル超も100ドル超と同じ倍率になる
+    assert over_500 == pytest.approx(2 * 10 * 1.3 + 5)
+    assert free == paid + 5
+    assert missing == 5
+
+
+def test_batch_scores_match_random_items(analyzer, backend):
+    rng = random.Random(0)
+    titles = ['vintage kimono obi', 'anime figure naruto', 'japanese pottery tea set',
+              'samurai katana sword', 'lot of stuff']
+    items = []
+    for i in range(500):
+        item = {'itemId': f'v1|{i}|0', 'title': rng.choice(titles)}
+        if rng.random() < 0.9:
+            item['price'] = {'value': rng.choice([f'{rng.uniform(1, 900):.2f}', '100.00', '100', 'n/a'])}
+        for key in ('watchCount', 'bidCount', 'quantitySold'):
+            if rng.random() < 0.6:
+                item[key] = rng.randint(0, 50)
+        if rng.random() < 0.7:
+            item['shippingOptions'] = [{'shippingCost': {'value': rng.choice(['0', '0.00', '5.99'])}}]
+        items.append(analyzer.enhance_item_with_local_analysis(item))
+
+    expected = [analyzer.calculate_popularity_score(item) for item in items]
+    assert analyzer.calculate_popularity_scores(items) == expected
+
+
+def test_empty_batch(analyzer, backend):
+    assert analyzer.calculate_popularity_scores([]) == []
+    assert analyzer.select_top_items([], [], 10) == []
+
+
+@pytest.mark.parametrize('limit', [0, 1, 3, 5, 8, 20])
+def test_select_top_items_keeps_input_order_for_ties(backend, limit):
+    items = [{'itemId': str(i)} for i in range(8)]
+    scores = [5.0, 7.0, 5.0, 1.0, 7.0, 5.0, 1.0, 5.0]
+
+    top = app.SmarteBayAnalyzer.select_top_items(items, scores, limit)
+
+    # 全件を安定ソートした先頭 limit 件と同じ並び（同点は元の順序）
+    order = sorted(range(len(items)), key=lambda i: -scores[i])[:limit]
+    assert [item['itemId'] for item in top] == [str(i) for i in order]
+
+
+def test_select_top_items_matches_full_sort(analyzer, backend):
+    rng = random.Random(1)
+    items = [{'itemId': str(i)} for i in range(1000)]
+    # 同点が多くなるように少ない種類のスコアにする
+    scores = [float(rng.randint(0, 20)) for _ in items]
+
+    top = analyzer.select_top_items(items, scores, 100)
+
+    order = sorted(range(len(items)), key=scores.__getitem__, reverse=True)[:100]
+    assert [item['itemId'] for item in top] == [str(i) for i in order]
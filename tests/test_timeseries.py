@@ -0,0 +1,149 @@
+"""TimeSeriesRecorder（追記型の時系列ストア・集約・ワーカー間の共有）のテスト"""
+import math
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+HOUR = 3600
+BASE = 1_700_000_000 // HOUR * HOUR  # 区間の境目に揃えた基準時刻
+
+
+def make_recorder(directory):
+    return app.TimeSeriesRecorder(str(directory), raw_retention_days=1, retention_days=5, rollup_seconds=HOUR)
+
+
+def make_item(item_id, category, price, score, watch=0, bids=0):
+    return {'itemId': item_id, 'popularityScore': score, 'watchCount': watch, 'bidCount': bids,
+            'local_analysis': {'primary_category': category, 'price_value': price}}
+
+
+def record(recorder, items, timestamp, total=None):
+    categories = {}
+    for item in items:
+        category = item['local_analysis']['primary_category']
+        categories[category] = categories.get(category, 0) + 1
+    recorder.record_run(items, {'total_items': total or len(items), 'categories': categories}, timestamp)
+
+
+def test_category_stats(tmp_path):
+    recorder = make_recorder(tmp_path)
+    record(recorder, [make_item('a', '陶磁器', 10.0, 20.0), make_item('b', '陶磁器', None, 40.0),
+                      make_item('c', '着物・和服', 30.0, 5.0)], BASE, total=6)
+
+    trends = recorder.category_trends(0, BASE + 1)
+    assert trends['陶磁器'] == [{'timestamp': BASE, 'count': 2.0, 'share': 0.3333, 'avg_price': 10.0, 'avg_score': 30.0}]
+    assert trends['着物・和服'] == [{'timestamp': BASE, 'count': 1.0, 'share': 0.1667, 'avg_price': 30.0, 'avg_score': 5.0}]
+    assert recorder.item_trend('b', 0, BASE + 1) == [
+        {'timestamp': BASE, 'price': None, 'watch_count': 0.0, 'bid_count': 0.0, 'popularity_score': 40.0}]
+
+
+def test_item_series_are_read_from_disk(tmp_path):
+    recorder = make_recorder(tmp_path)
+    for i in range(3):
+        record(recorder, [make_item('a', '陶磁器', 10.0 + i, 1.0, watch=i)], BASE + i * 60)
+
+    # メモリに列で持つのはカテゴリだけ。商品はレコードの位置だけ持つ
+    item_id = recorder._series_ids['item:a']
+    assert item_id not in recorder._columns
+    size = app.TimeSeriesRecorder.RECORD.size
+    assert list(recorder._offsets[item_id]) == [(i * 2 + 1) * size for i in range(3)]
+    assert [point['price'] for point in recorder.item_trend('a', 0, BASE + 1000)] == [10.0, 11.0, 12.0]
+    assert [point['watch_count'] for point in recorder.item_trend('a', BASE + 30, BASE + 60)] == [1.0]
+
+
+def test_points_are_shared_between_workers(tmp_path):
+    first, second = make_recorder(tmp_path), make_recorder(tmp_path)
+    record(first, [make_item('a', '陶磁器', 10.0, 1.0)], BASE)
+    record(second, [make_item('b', 'アニメ・マンガ', 20.0, 2.0)], BASE + 60)
+    record(first, [make_item('a', '陶磁器', 12.0, 3.0)], BASE + 120)
+
+    # 系列IDの割り当ても共有される（同じ名前が別のIDにならない）
+    assert first._series_ids == second._series_ids
+    for recorder in (first, second):
+        assert [point['price'] for point in recorder.item_trend('a', 0, BASE + 1000)] == [10.0, 12.0]
+        assert [point['price'] for point in recorder.item_trend('b', 0, BASE + 1000)] == [20.0]
+        assert set(recorder.category_trends(0, BASE + 1000)) == {'陶磁器', 'アニメ・マンガ'}
+
+
+def _record_in_child(directory, timestamp):
+    record(make_recorder(directory), [make_item('a', '陶磁器', 99.0, 1.0)], timestamp)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='fork がありません')
+def test_append_from_another_process(tmp_path):
+    recorder = make_recorder(tmp_path)
+    record(recorder, [make_item('a', '陶磁器', 10.0, 1.0)], BASE)
+
+    process = multiprocessing.get_context('fork').Process(target=_record_in_child, args=(str(tmp_path), BASE + 60))
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+
+    assert [point['price'] for point in recorder.item_trend('a', 0, BASE + 1000)] == [10.0, 99.0]
+
+
+def test_compact_rolls_up_and_drops_old_points(tmp_path):
+    recorder = make_recorder(tmp_path)
+    recorder._last_compaction = math.inf  # 自動の集約を止めて、compact を明示的に呼ぶ
+    now = BASE + 10 * 86400
+    old = now - 8 * 86400  # 保持期間（5日）の外
+    hour = now - 3 * 86400  # 生データ保持期間（1日）の外 → 1時間の平均にまとめる
+    record(recorder, [make_item('a', '陶磁器', 1.0, 1.0)], old)
+    record(recorder, [make_item('a', '陶磁器', 10.0, 2.0, watch=1)], hour + 60)
+    record(recorder, [make_item('a', '陶磁器', None, 4.0, watch=3)], hour + 1800)
+    record(recorder, [make_item('a', '陶磁器', 30.0, 6.0, watch=5)], hour + 3000)
+    record(recorder, [make_item('a', '陶磁器', 50.0, 8.0)], now - 60)
+
+    recorder.compact(now)
+
+    # 欠けた値（NaN）は平均に入れない
+    assert recorder.item_trend('a', 0, now) == [
+        {'timestamp': hour, 'price': 20.0, 'watch_count': 3.0, 'bid_count': 0.0, 'popularity_score': 4.0},
+        {'timestamp': now - 60, 'price': 50.0, 'watch_count': 0.0, 'bid_count': 0.0, 'popularity_score': 8.0},
+    ]
+    assert [point['timestamp'] for point in recorder.category_trends(0, now)['陶磁器']] == [hour, now - 60]
+    assert os.path.getsize(recorder.points_path) == 4 * app.TimeSeriesRecorder.RECORD.size
+
+    # 別のワーカーも置き換わったファイルを読み直す
+    assert make_recorder(tmp_path).item_trend('a', 0, now) == recorder.item_trend('a', 0, now)
+
+
+def test_compaction_runs_once_across_workers(tmp_path):
+    first, second = make_recorder(tmp_path), make_recorder(tmp_path)
+    record(first, [make_item('a', '陶磁器', 10.0, 1.0)], BASE)
+    compacted_at = float(open(first.compaction_path).read())
+    inode = os.stat(first.points_path).st_ino
+    assert compacted_at == BASE
+
+    # 別のワーカーは最終集約時刻をファイルから読み、間隔内なら集約しない
+    record(second, [make_item('a', '陶磁器', 11.0, 1.0)], BASE + HOUR / 2)
+    assert os.stat(second.points_path).st_ino == inode
+    assert second._last_compaction == BASE
+
+    # 間隔を過ぎたら、どちらか1つのワーカーだけが集約する
+    record(second, [make_item('a', '陶磁器', 12.0, 1.0)], BASE + HOUR * 2)
+    inode = os.stat(second.points_path).st_ino
+    record(first, [make_item('a', '陶磁器', 13.0, 1.0)], BASE + HOUR * 2 + 60)
+    assert os.stat(first.points_path).st_ino == inode
+    assert float(open(first.compaction_path).read()) == BASE + HOUR * 2
+    assert [point['price'] for point in first.item_trend('a', 0, BASE + HOUR * 3)] == [10.0, 11.0, 12.0, 13.0]
+
+
+def test_query_step_buckets_are_aligned(tmp_path):
+    recorder = make_recorder(tmp_path)
+    recorder._last_compaction = math.inf
+    for offset, price in [(100, 10.0), (1700, None), (1799, 20.0), (1800, 40.0), (3599, 60.0), (3600, 7.0)]:
+        record(recorder, [make_item('a', '陶磁器', price, 1.0)], BASE + offset)
+
+    # 区間は問い合わせ範囲ではなく floor(時刻 / step) * step に揃える（欠けた値は平均に入れない）
+    points = recorder.item_trend('a', BASE + 100, BASE + 3600, step=1800)
+    assert [(point['timestamp'], point['price']) for point in points] == [
+        (BASE, 15.0), (BASE + 1800, 50.0), (BASE + 3600, 7.0)]
+    points = recorder.category_trends(BASE + 1000, BASE + 4000, step=HOUR)['陶磁器']
+    assert [(point['timestamp'], point['count']) for point in points] == [(BASE, 1.0), (BASE + HOUR, 1.0)]
@@ -0,0 +1,86 @@
+"""商品ストアの分類済み商品から HashedNgramClassifier を学習して保存するオフラインのスクリプト
+
+ラベルは保存済みの主カテゴリ（キーワード分類の結果）を使い、--labels に
+「商品ID<TAB>カテゴリ」の TSV を渡すと、その商品だけ人手のラベルで置き換える。
+一部を検証用に取り分け、キーワード分類との一致率と予測のスループットを表示する。
+
+使い方:
+    ITEM_STORE_PATH=items.db python train_classifier.py --output classifier.npz
+    LOCAL_CLASSIFIER_PATH=classifier.npz gunicorn app:app
+"""
+import argparse
+import random
+import time
+from typing import Dict
+
+import app
+
+
+def load_labels(path: str) -> Dict[str, str]:
+    labels = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) == 2 and parts[0] and parts[1]:
+                labels[parts[0]] = parts[1]
+    return labels
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--store', default=app.ITEM_STORE_PATH, help='商品ストアの SQLite ファイル（既定は ITEM_STORE_PATH）')
+    parser.add_argument('--output', required=True, help='学習した分類器の保存先（.npz）')
+    parser.add_argument('--labels', help='人手のラベル（商品ID<TAB>カテゴリ の TSV）')
+    parser.add_argument('--feature-bits', type=int, default=18, help='特徴ハッシュの列数（2のべき乗の指数）')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--learning-rate', type=float, default=0.5)
+    parser.add_argument('--holdout', type=float, default=0.1, help='検証用に取り分ける割合')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if app.np is None:
+        raise SystemExit('分類器の学習には NumPy が必要です')
+    if not args.store:
+        raise SystemExit('--store か ITEM_STORE_PATH を指定してください')
+
+    overrides = load_labels(args.labels) if args.labels else {}
+    examples = []
+    for item in app.ItemStore(args.store).iter_items():
+        label = overrides.get(item.get('itemId')) or (item.get('local_analysis') or {}).get('primary_category')
+        if label:
+            examples.append((f"{item.get('title', '')} {item.get('shortDescription', '')}", label))
+    if not examples:
+        raise SystemExit('ラベル付きの商品がありません')
+
+    random.Random(args.seed).shuffle(examples)
+    holdout = int(len(examples) * args.holdout)
+    train, test = examples[holdout:], examples[:holdout]
+    counts = {}
+    for _, label in train:
+        counts[label] = counts.get(label, 0) + 1
+    print(f"train={len(train)} test={len(test)} classes={dict(sorted(counts.items(), key=lambda x: -x[1]))}")
+
+    start = time.perf_counter()
+    classifier = app.HashedNgramClassifier.fit(
+        [text for text, _ in train], [label for _, label in train], n_features=1 << args.feature_bits,
+        epochs=args.epochs, learning_rate=args.learning_rate, seed=args.seed
+    )
+    print(f"trained in {time.perf_counter() - start:.1f}s")
+
+    if test:
+        start = time.perf_counter()
+        probabilities = classifier.predict_proba([text for text, _ in test])
+        elapsed = time.perf_counter() - start
+        predicted = [classifier.classes[index] for index in probabilities.argmax(axis=1).tolist()]
+        accuracy = sum(1 for p, (_, label) in zip(predicted, test) if p == label) / len(test)
+        print(f"holdout accuracy={accuracy:.3f} predict={len(test) / elapsed:,.0f} items/s")
+
+    classifier.save(args.output)
+    print(f"saved {args.output} (version {classifier.version})")
+
+
+if __name__ == '__main__':
+    main()